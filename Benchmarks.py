@@ -0,0 +1,725 @@
+#
+#   Timing comparisons of alternative implementations of the same operation, used during
+#   development to decide which version the program should use.  Not used by the program itself.
+#   Each benchmark first confirms the alternatives give the same answer, then times them.
+#   Run from the command line, for example:
+#
+#       python Benchmarks.py header-scan "Darks Near -5"/*.fit
+#
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Callable, Optional
+
+import numpy
+from astropy.io import fits
+from numpy import ma, ndarray
+
+from CalibrationIndex import CalibrationIndex
+from Calibrator import Calibrator
+from Console import Console
+from ConsoleSilent import ConsoleSilent
+from Constants import Constants
+from DataModel import DataModel
+from FileDescriptor import FileDescriptor
+from FrameReadAhead import FrameReadAhead
+from ImageMath import ImageMath
+from Preferences import Preferences
+from RmFitsUtil import RmFitsUtil
+from SessionController import SessionController
+from SharedUtils import SharedUtils
+from StreamingMath import StreamingMath
+from ThreadedCombiner import ThreadedCombiner
+
+
+class Benchmarks:
+
+    # Run the given function the given number of times, and return the fastest time, in seconds.
+    # The fastest (rather than the mean) is the best estimate of the cost of the code itself,
+    # since everything that makes a run slower is interference from something else.
+    # If a setup function is given, it is run, untimed, before each run.
+
+    @classmethod
+    def best_time(cls, function: Callable[[], object], repetitions: int,
+                  setup: Optional[Callable[[], object]] = None) -> float:
+        best = sys.float_info.max
+        for _ in range(repetitions):
+            if setup is not None:
+                setup()
+            time_before = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - time_before)
+        return best
+
+    @classmethod
+    def report(cls, label: str, seconds: float, reference_seconds: float):
+        print(f"   {label:<32} {seconds * 1000.0:10.2f} ms   {reference_seconds / seconds:6.2f}x")
+
+    # The original version of RmFitsUtil.categorize_file, reading the header with astropy rather than
+    # with the fast header scanner.  The results are identical.
+
+    @classmethod
+    def categorize_file_astropy(cls, file_name: str) -> (int, int, int, int, int, str, float, float):
+        with fits.open(file_name) as file:
+            return RmFitsUtil.categorize_header(file_name, file[0].header,
+                                                ("light", "lum", "red", "green", "blue", "ha"))
+
+    # Reading the header values that describe a file:  astropy Header versus the fast header scanner
+
+    @classmethod
+    def header_scan(cls, file_names: [str], repetitions: int):
+        print(f"Describing {len(file_names)} files, best of {repetitions}")
+        for name in file_names:
+            if RmFitsUtil.categorize_file(name) != cls.categorize_file_astropy(name):
+                print(f"   Results differ for {name}")
+                return
+        astropy_time = cls.best_time(lambda: [cls.categorize_file_astropy(n) for n in file_names],
+                                     repetitions)
+        scanner_time = cls.best_time(lambda: [RmFitsUtil.categorize_file(n) for n in file_names],
+                                     repetitions)
+        cls.report("astropy Header", astropy_time, astropy_time)
+        cls.report("FitsHeaderScanner", scanner_time, astropy_time)
+
+    # Read the whole stack of the given files, as combined:  a (files, rows, columns) array of doubles
+
+    @classmethod
+    def read_stack(cls, file_names: [str]) -> ndarray:
+        read_ahead = FrameReadAhead(file_names, numpy.float64, 256 * 1024 * 1024)
+        (rows, columns) = read_ahead.get_frame_shape()
+        stack = numpy.empty((len(file_names), rows, columns))
+        for _ in read_ahead.frames(out=stack):
+            pass
+        return stack
+
+    # Combining a stack with each combine method on 1, 2, 4, ... threads (up to the number of cores,
+    # and at least 4), to show how each method scales.  The stack is copied before each run,
+    # untimed, since some methods change their input.
+
+    @classmethod
+    def tile_threads(cls, file_names: [str], repetitions: int):
+        stack = cls.read_stack(file_names)
+        thread_counts = [1]
+        while thread_counts[-1] * 2 <= max(4, os.cpu_count() or 1):
+            thread_counts.append(thread_counts[-1] * 2)
+        print(f"Combining {stack.shape} stack on {thread_counts} threads, best of {repetitions}")
+        methods = [("Mean", Constants.COMBINE_MEAN, ()),
+                   ("Median", Constants.COMBINE_MEDIAN, ()),
+                   ("Min-max clip 2", Constants.COMBINE_MINMAX, (2, Constants.MINMAX_CLIP_TIES)),
+                   ("Sigma clip 2.0", Constants.COMBINE_SIGMA_CLIP,
+                    (2.0, 2.0, Constants.SIGMA_CENTER_MEAN, Constants.SIGMA_SCALE_STD, 1))]
+        for (label, method, parameters) in methods:
+            print(f" {label}")
+            work = {"strip": stack}
+
+            def fresh_strip():
+                work["strip"] = stack.copy()
+
+            def combine(thread_count: int) -> ndarray:
+                result = numpy.empty(stack.shape[1:])
+                with ThreadedCombiner(thread_count, ConsoleSilent(), SessionController()) as combiner:
+                    combiner.combine_tiles(ImageMath.combine_tile, method, parameters, work["strip"], result, 0)
+                return result
+
+            fresh_strip()
+            reference = combine(1)
+            for thread_count in thread_counts[1:]:
+                fresh_strip()
+                if not numpy.array_equal(combine(thread_count), reference):
+                    print(f"   Results differ with {thread_count} threads")
+                    return
+            one_thread_time = 0.0
+            for thread_count in thread_counts:
+                seconds = cls.best_time(lambda: combine(thread_count), repetitions, setup=fresh_strip)
+                one_thread_time = seconds if thread_count == 1 else one_thread_time
+                cls.report(f"{thread_count} threads", seconds, one_thread_time)
+
+    # Min-max clipped mean, version 5, moved here from ImageMath (where versions 0 to 4 remain, commented out)
+    #   when version 6 replaced it, as the reference version 6 is checked and timed against.  Minor modification
+    #   of version-4.  It still uses full matrix operations to calculate the mean.
+    #
+    #   However, method (4) can produce different results than the cell-by-cell methods above in the case where
+    #   a column has no data left after eliminating the minimums and maximums; because in that algorithm the entire
+    #   matrix is re-calculated with fewer dropped points, while in the above methods only the offending columns
+    #   are recalculated.
+    #
+    #   This method, (5), is designed to produce identical results to (0) through (3) (and different from 4).
+    #   If columns are entirely masked, only those columns are re-calculated with a lower drop quotient, not
+    #   the entire matrix.
+
+    @classmethod
+    def min_max_clip_version_5(cls, file_data: ndarray, number_dropped_values: int,
+                               console: Console, session_controller: SessionController):
+        console.push_level()
+        console.message(f"Using min-max clip with {number_dropped_values} iterations", +1)
+        masked_array = ma.MaskedArray(file_data)
+        drop_counter = 1
+        while drop_counter <= number_dropped_values:
+            ImageMath.check_cancellation(session_controller)
+            console.push_level()
+            console.message(f"Iteration {drop_counter} of {number_dropped_values}.", +1)
+            drop_counter += 1
+            # Find the minimums in all columns.  This will give a 2d matrix the same size as the images
+            # with the column-minimum in each position
+            minimum_values = masked_array.min(axis=0)
+            ImageMath.check_cancellation(session_controller)
+
+            # Now compare that matrix of minimums down the layers, so we get Trues where
+            # each minimum exists in its column (minimums might exist more than once, and
+            # we want to find all of them)
+            masked_array = ma.masked_where(masked_array == minimum_values, masked_array)
+            ImageMath.check_cancellation(session_controller)
+            console.message("Masked minimums.", +1, temp=True)
+
+            # Now find and mask the maximums, same approach
+            maximum_values = masked_array.max(axis=0)
+            masked_array = ma.masked_where(masked_array == maximum_values, masked_array)
+            ImageMath.check_cancellation(session_controller)
+            console.message("Masked maximums.", +1, temp=True)
+            console.pop_level()
+
+        console.message(f"Calculating mean of remaining data.", 0)
+        masked_means = numpy.mean(masked_array, axis=0, dtype=numpy.float64)
+        ImageMath.check_cancellation(session_controller)
+        # If the means matrix contains any masked values, that means that in that column the clipping
+        # eliminated *all* the data.  We will find the offending columns and re-calculate those with
+        # fewer dropped extremes.  This should exactly reproduce the results of the cell-by-cell methods
+        if ma.is_masked(masked_means):
+            console.message("Some columns lost all their values; reducing drops for those columns.", 0)
+            #  Get the mask, and get a 2D matrix showing which columns were entirely masked
+            the_mask = masked_array.mask
+            eliminated_columns_map = ndarray.all(the_mask, axis=0)
+            ImageMath.check_cancellation(session_controller)
+            repairs = numpy.count_nonzero(eliminated_columns_map)
+            cp = "s" if repairs > 1 else ""
+            np = "" if repairs > 1 else "s"
+            console.message(f"{repairs} column{cp} need{np} repair.", +1)
+            masked_means[eliminated_columns_map] = ImageMath.repair_columns(file_data, eliminated_columns_map,
+                                                                      number_dropped_values - 1)
+            ImageMath.check_cancellation(session_controller)
+            # We've replaced the problematic columns, now the mean should calculate cleanly
+            assert not ma.is_masked(masked_means)
+        console.pop_level()
+        return masked_means.round()
+
+    # Min-max clipping of 2 values:  masked arrays (version 5) versus sorting in place (version 6), which
+    # must agree exactly when clipping ties;  and, for interest, version 6 clipping an exact count
+
+    @classmethod
+    def min_max_clip(cls, file_names: [str], repetitions: int):
+        stack = cls.read_stack(file_names)
+        print(f"Min-max clipping {stack.shape} stack, best of {repetitions}")
+        work = {"stack": stack}
+
+        def fresh_stack():
+            work["stack"] = stack.copy()
+
+        def version_5() -> ndarray:
+            return cls.min_max_clip_version_5(work["stack"], 2, ConsoleSilent(), SessionController()).filled()
+
+        def version_6(clip_mode: int) -> ndarray:
+            return ImageMath.min_max_clip_version_6(work["stack"], 2, clip_mode, ConsoleSilent(), SessionController())
+
+        fresh_stack()
+        reference = version_5()
+        fresh_stack()
+        if not numpy.array_equal(version_6(Constants.MINMAX_CLIP_TIES), reference):
+            print("   Results differ")
+            return
+        masked_time = cls.best_time(version_5, repetitions, setup=fresh_stack)
+        ties_time = cls.best_time(lambda: version_6(Constants.MINMAX_CLIP_TIES), repetitions, setup=fresh_stack)
+        exact_time = cls.best_time(lambda: version_6(Constants.MINMAX_CLIP_EXACT), repetitions, setup=fresh_stack)
+        cls.report("Masked array (version 5)", masked_time, masked_time)
+        cls.report("Sorted, ties (version 6)", ties_time, masked_time)
+        cls.report("Sorted, exact (version 6)", exact_time, masked_time)
+
+    # Repairing the columns that clipping has emptied:  one column at a time with calc_mm_clipped_mean,
+    # as it was done, versus all at once with repair_columns.  The columns repaired are those that
+    # min-max clipping 4 values with ties would empty, usually a good many.
+
+    @classmethod
+    def column_repair(cls, file_names: [str], repetitions: int):
+        stack = cls.read_stack(file_names)
+        sorted_stack = numpy.sort(stack, axis=0)
+        distinct_counts = 1 + numpy.count_nonzero(sorted_stack[1:] != sorted_stack[:-1], axis=0)
+        columns_map = distinct_counts <= 2 * 4
+        print(f"Repairing {numpy.count_nonzero(columns_map):,} columns of {stack.shape} stack, "
+              f"best of {repetitions}")
+
+        def one_at_a_time() -> ndarray:
+            (x_coordinates, y_coordinates) = numpy.where(columns_map)
+            return numpy.array([round(ImageMath.calc_mm_clipped_mean(stack[:, x, y], 3, ConsoleSilent(),
+                                                                     SessionController()))
+                                for (x, y) in zip(x_coordinates, y_coordinates)])
+
+        def all_at_once() -> ndarray:
+            return ImageMath.repair_columns(stack, columns_map, 3)
+
+        if not numpy.array_equal(one_at_a_time(), all_at_once()):
+            print("   Results differ")
+            return
+        loop_time = cls.best_time(one_at_a_time, repetitions)
+        batch_time = cls.best_time(all_at_once, repetitions)
+        cls.report("Column at a time", loop_time, loop_time)
+        cls.report("All columns at once", batch_time, loop_time)
+
+    # A stack of the given number of frames made from the given (frames, rows, columns) stack, by using each
+    # frame more than once if need be, each time shifted along its rows so the copies aren't identical, and
+    # from only as many rows as keep the stack to about 64 MB
+
+    @classmethod
+    def stack_of_depth(cls, frames: ndarray, number_of_frames: int) -> ndarray:
+        (_, rows, columns) = frames.shape
+        stack_rows = max(1, min(rows, (64 * 1024 * 1024) // (number_of_frames * columns * 8)))
+        return numpy.array([numpy.roll(frames[index % len(frames), :stack_rows], index // len(frames), axis=1)
+                            for index in range(number_of_frames)])
+
+    # Median:  numpy.median of the floating-point stack versus sorting blocks of it as 16-bit integers
+    # (median_stack, without sorting networks), for stacks of 20, 100 and 500 frames made from the given files
+
+    @classmethod
+    def median(cls, file_names: [str], repetitions: int):
+        frames = cls.read_stack(file_names)
+        default_max_values = ImageMath.SORTING_NETWORK_MAX_VALUES.copy()
+        try:
+            ImageMath.SORTING_NETWORK_MAX_VALUES[Constants.COMBINE_MEDIAN] = 0
+            for number_of_frames in [20, 100, 500]:
+                stack = cls.stack_of_depth(frames, number_of_frames)
+                print(f"Median of {stack.shape} stack, best of {repetitions}")
+                work = {"stack": stack}
+
+                def fresh_stack():
+                    work["stack"] = stack.copy()
+
+                def floating_point() -> ndarray:
+                    return numpy.median(work["stack"], axis=0, overwrite_input=True)
+
+                def integer_blocks() -> ndarray:
+                    return ImageMath.median_stack(work["stack"], ConsoleSilent(), SessionController())
+
+                fresh_stack()
+                reference = floating_point()
+                fresh_stack()
+                if not numpy.array_equal(integer_blocks(), reference):
+                    print("   Results differ")
+                    return
+                floating_time = cls.best_time(floating_point, repetitions, setup=fresh_stack)
+                integer_time = cls.best_time(integer_blocks, repetitions, setup=fresh_stack)
+                cls.report("numpy.median", floating_time, floating_time)
+                cls.report("Sorted 16-bit blocks", integer_time, floating_time)
+        finally:
+            ImageMath.SORTING_NETWORK_MAX_VALUES.update(default_max_values)
+
+    # Sorting networks versus numpy's sort, in median_stack and in min-max clipping 2 values with ties
+    # (min_max_clip_version_6), for stacks of 4 to 64 frames made from the given files, to show the depth
+    # up to which the networks are faster (ImageMath.SORTING_NETWORK_MAX_VALUES)
+
+    @classmethod
+    def sorting_network(cls, file_names: [str], repetitions: int):
+        frames = cls.read_stack(file_names)
+        default_max_values = ImageMath.SORTING_NETWORK_MAX_VALUES.copy()
+        kernels = [("Median", Constants.COMBINE_MEDIAN,
+                    lambda stack: ImageMath.median_stack(stack, ConsoleSilent(), SessionController())),
+                   ("Min-max clip 2", Constants.COMBINE_MINMAX,
+                    lambda stack: ImageMath.min_max_clip_version_6(stack, 2, Constants.MINMAX_CLIP_TIES,
+                                                                   ConsoleSilent(), SessionController()))]
+        # Deepest stack for which the network was faster, and faster for every shallower stack
+        faster_up_to = {label: 0 for (label, _, _) in kernels}
+        slower_seen = set()
+        try:
+            for number_of_frames in [4, 8, 12, 16, 20, 24, 28, 32, 40, 48, 64]:
+                stack = cls.stack_of_depth(frames, number_of_frames)
+                print(f"Sorting {stack.shape} stack, best of {repetitions}")
+                work = {"stack": stack}
+
+                def fresh_stack():
+                    work["stack"] = stack.copy()
+
+                for (label, method, kernel) in kernels:
+                    results = []
+                    seconds = []
+                    for max_values in [0, number_of_frames]:
+                        ImageMath.SORTING_NETWORK_MAX_VALUES[method] = max_values
+                        fresh_stack()
+                        results.append(kernel(work["stack"]))
+                        seconds.append(cls.best_time(lambda: kernel(work["stack"]), repetitions, setup=fresh_stack))
+                    if not numpy.array_equal(results[0], results[1]):
+                        print(f"   {label}:  results differ")
+                        return
+                    cls.report(f"{label}, numpy sort", seconds[0], seconds[0])
+                    cls.report(f"{label}, sorting network", seconds[1], seconds[0])
+                    if seconds[1] >= seconds[0]:
+                        slower_seen.add(label)
+                    elif label not in slower_seen:
+                        faster_up_to[label] = number_of_frames
+        finally:
+            ImageMath.SORTING_NETWORK_MAX_VALUES.update(default_max_values)
+        for (label, method, _) in kernels:
+            print(f"{label}:  sorting network faster up to {faster_up_to[label]} frames "
+                  f"(SORTING_NETWORK_MAX_VALUES is {default_max_values[method]})")
+
+    # Memory, in bytes, allocated at the peak of a call of the given function (numpy's allocations are
+    # included), beyond what was allocated before it
+
+    @classmethod
+    def peak_memory(cls, function: Callable[[], object]) -> int:
+        tracemalloc.start()
+        function()
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+    # Write the given number of synthetic dark frames, of the given shape, into the given directory, and
+    # return their names.  Each pixel has a bias level, read noise, and a dark current level (a few pixels
+    # hot), with the dark current's shot noise in each frame;  a few values in each frame are cosmic ray hits.
+    # The same seed always gives the same frames.
+
+    @classmethod
+    def write_synthetic_darks(cls, directory: str, number_of_frames: int, shape: (int, int), seed: int) -> [str]:
+        generator = numpy.random.default_rng(seed)
+        dark_levels = generator.exponential(50.0, shape)
+        hot_pixels = generator.random(shape) < 0.001
+        dark_levels[hot_pixels] = generator.uniform(2000.0, 20000.0, numpy.count_nonzero(hot_pixels))
+        file_names = []
+        for index in range(number_of_frames):
+            frame = 1000.0 + generator.poisson(dark_levels) + generator.normal(0.0, 10.0, shape)
+            cosmic_rays = generator.random(shape) < 0.0005
+            frame[cosmic_rays] = generator.uniform(3000.0, 30000.0, numpy.count_nonzero(cosmic_rays))
+            file_name = os.path.join(directory, f"synthetic-dark-{index:04d}.fit")
+            RmFitsUtil.create_combined_fits_file(file_name, numpy.clip(frame, 0.0, 32767.0),
+                                                 FileDescriptor.FILE_TYPE_DARK, "Dark Frame", 300.0, -5.0,
+                                                 "", 1, "Synthetic dark frame")
+            file_names.append(file_name)
+        return file_names
+
+    # The approximate median's error:  the streamed histogram median (StreamingMath.combine_median_approximate)
+    # compared with the exact median of the whole stack (ImageMath.median_stack), on synthetic stacks of
+    # 20, 100 and 400 frames, written to a temporary directory (the files given are not used), with the time
+    # and memory each takes, including reading the files (with 16 MB read ahead when streaming)
+
+    @classmethod
+    def approximate_median(cls, _: [str], repetitions: int):
+        data_model = DataModel(Preferences())
+        data_model.set_precalibration_type(Constants.CALIBRATION_NONE)
+        data_model.set_read_ahead_megabytes(16)
+        shape = (256, 512)
+        for number_of_frames in [20, 100, 400]:
+            with tempfile.TemporaryDirectory() as directory:
+                file_names = cls.write_synthetic_darks(directory, number_of_frames, shape, number_of_frames)
+                print(f"Median of {number_of_frames} synthetic {shape} darks, best of {repetitions}")
+
+                def exact() -> ndarray:
+                    return ImageMath.median_stack(cls.read_stack(file_names), ConsoleSilent(), SessionController())
+
+                def approximate() -> ndarray:
+                    return StreamingMath.combine_median_approximate(file_names, numpy.float64, data_model,
+                                                                    Calibrator(data_model), ConsoleSilent(),
+                                                                    SessionController())
+
+                errors = numpy.abs(approximate() - exact())
+                print(f"   Error:  largest {errors.max():g} ADU, mean {errors.mean():.4f} ADU, "
+                      f"{100.0 * numpy.count_nonzero(errors == 0.0) / errors.size:.2f}% of pixels exact")
+                exact_time = cls.best_time(exact, repetitions)
+                approximate_time = cls.best_time(approximate, repetitions)
+                cls.report("Exact, whole stack", exact_time, exact_time)
+                cls.report("Approximate, streamed", approximate_time, exact_time)
+                for (label, function) in [("Exact, whole stack", exact), ("Approximate, streamed", approximate)]:
+                    print(f"   {label:<32} {cls.peak_memory(function) / (1024 * 1024):10.1f} MB working memory")
+
+    # Check the approximate median's error against its documented bound (see
+    # StreamingMath.median_error_bounds):  on synthetic stacks of odd and even numbers of frames, written to a
+    # temporary directory (the files given are not used), every pixel's streamed histogram median must be
+    # within the bound of the exact median of the whole stack.  Exits with status 1 if any pixel is not.
+
+    @classmethod
+    def approximate_median_check(cls, _: [str], __: int):
+        data_model = DataModel(Preferences())
+        data_model.set_precalibration_type(Constants.CALIBRATION_NONE)
+        data_model.set_read_ahead_megabytes(16)
+        shape = (128, 256)
+        failed = False
+        for number_of_frames in [5, 20, 21, 100, 101]:
+            with tempfile.TemporaryDirectory() as directory:
+                file_names = cls.write_synthetic_darks(directory, number_of_frames, shape, number_of_frames)
+                calibrator = Calibrator(data_model)
+                read_ahead = StreamingMath.open_stream(file_names, numpy.float64, data_model, calibrator,
+                                                       ConsoleSilent(), SessionController())
+                (means, sum_of_squares) = StreamingMath.means_and_sums_of_squares(read_ahead, calibrator,
+                                                                                 number_of_frames, ConsoleSilent())
+                bounds = StreamingMath.median_error_bounds(means, numpy.sqrt(sum_of_squares / number_of_frames))
+                errors = numpy.abs(StreamingMath.combine_median_approximate(file_names, numpy.float64, data_model,
+                                                                            calibrator, ConsoleSilent(),
+                                                                            SessionController())
+                                   - ImageMath.median_stack(cls.read_stack(file_names), ConsoleSilent(),
+                                                            SessionController()))
+                over_bound = numpy.count_nonzero(errors > bounds)
+                print(f"{number_of_frames:4d} frames:  largest error {errors.max():g} ADU, largest bound "
+                      f"{bounds.max():g} ADU, {over_bound} pixels over their bound")
+                failed = failed or over_bound > 0
+        if failed:
+            print("FAILED:  the approximate median's error exceeds its bound")
+            sys.exit(1)
+        print("Passed")
+
+    # The linear search of a calibration directory for the auto-calibration file, as Calibrator did it
+    # before CalibrationIndex:  read the descriptors of all the FITS files in the directory (reporting and
+    # skipping unreadable ones), keep those the size of the sample file, and take the one closest to the
+    # sample file's temperature.
+
+    @classmethod
+    def all_descriptors_from_directory(cls, directory_path: str, recursive: bool, data_model: DataModel,
+                                       console: Console,
+                                       session_controller: SessionController) -> [FileDescriptor]:
+        paths: [str] = SharedUtils.files_in_directory(directory_path, recursive)
+        (descriptors, failures) = RmFitsUtil.scan_file_descriptions(paths,
+                                                                    data_model.get_scan_worker_count(),
+                                                                    session_controller)
+        for (path, message) in failures:
+            console.message(f"Ignoring unreadable calibration file {path}: {message}", 0, temp=True)
+        return descriptors
+
+    @classmethod
+    def filter_to_correct_size(cls, all_descriptors: [FileDescriptor], sample_file: FileDescriptor) \
+            -> [FileDescriptor]:
+        x_dimension = sample_file.get_x_dimension()
+        y_dimension = sample_file.get_y_dimension()
+        binning = sample_file.get_binning()
+        d: FileDescriptor
+        filtered = [d for d in all_descriptors
+                    if d.get_x_dimension() == x_dimension
+                    and d.get_y_dimension() == y_dimension
+                    and d.get_binning() == binning]
+        return filtered
+
+    @classmethod
+    def closest_temperature_match(cls, descriptors: [FileDescriptor],
+                                  target_temperature: float) -> FileDescriptor:
+        best_file_so_far: FileDescriptor = FileDescriptor("dummy-not-used")
+        best_difference_so_far = sys.float_info.max
+        for descriptor in descriptors:
+            this_difference = abs(descriptor.get_temperature() - target_temperature)
+            if this_difference < best_difference_so_far:
+                best_difference_so_far = this_difference
+                best_file_so_far = descriptor
+        return best_file_so_far
+
+    # Choosing the auto-calibration file for each of 40 groups of frames from a synthetic library of 2,000
+    # bias files (tiny ones, in 3 sizes, at temperatures in steps of 0.5 so there are ties), written to a
+    # temporary directory (the files given are not used):  listing and reading the library and searching
+    # it for every group, as was done, versus the session's CalibrationIndex.  Then one more file is added,
+    # and the time for the index to take it in, reading only its header, is shown.
+
+    @classmethod
+    def calibration_lookup(cls, _: [str], repetitions: int):
+        data_model = DataModel(Preferences())
+        data_model.set_auto_directory_recursive(False)
+        generator = numpy.random.default_rng(2000)
+        sizes = [(1, 16, 12), (2, 8, 6), (4, 4, 3)]
+        with tempfile.TemporaryDirectory() as directory:
+            for index in range(2000):
+                (binning, x_size, y_size) = sizes[index % len(sizes)]
+                RmFitsUtil.create_combined_fits_file(os.path.join(directory, f"bias-{index:04d}.fit"),
+                                                     numpy.zeros((y_size, x_size)), FileDescriptor.FILE_TYPE_BIAS,
+                                                     "Bias Frame", 0.0, generator.integers(-40, 21) / 2.0,
+                                                     "", binning, "Synthetic bias frame")
+            samples = []
+            for index in range(40):
+                (binning, x_size, y_size) = sizes[index % len(sizes)]
+                sample = FileDescriptor(f"group-{index}.fit")
+                sample.set_binning(binning, binning)
+                sample.set_dimensions(x_size, y_size)
+                sample.set_temperature(generator.integers(-50, 31) / 4.0)
+                samples.append(sample)
+            print(f"Choosing calibration files for {len(samples)} groups from 2,000 files, best of {repetitions}")
+
+            def linear_search() -> [str]:
+                chosen = []
+                for sample in samples:
+                    descriptors = cls.all_descriptors_from_directory(directory, False, data_model, ConsoleSilent(),
+                                                                     SessionController())
+                    correct_size = cls.filter_to_correct_size(descriptors, sample)
+                    chosen.append(cls.closest_temperature_match(correct_size, sample.get_temperature())
+                                  .get_absolute_path())
+                return chosen
+
+            def indexed() -> [str]:
+                CalibrationIndex.forget_all()
+                return [CalibrationIndex.for_directory(directory, False, 1, ConsoleSilent(), SessionController())
+                        .closest_match(sample, sample.get_temperature(), False).get_absolute_path()
+                        for sample in samples]
+
+            if linear_search() != indexed():
+                print("   Results differ")
+                return
+            linear_time = cls.best_time(linear_search, repetitions)
+            indexed_time = cls.best_time(indexed, repetitions)
+            cls.report("Read and search each time", linear_time, linear_time)
+            cls.report("Calibration index", indexed_time, linear_time)
+
+            # Warmer than any file in the library, so it is the only match at that temperature
+            RmFitsUtil.create_combined_fits_file(os.path.join(directory, "bias-added.fit"), numpy.zeros((12, 16)),
+                                                 FileDescriptor.FILE_TYPE_BIAS, "Bias Frame", 0.0, 25.0,
+                                                 "", 1, "Synthetic bias frame")
+            time_before = time.perf_counter()
+            index = CalibrationIndex.for_directory(directory, False, 1, ConsoleSilent(), SessionController())
+            refresh_time = time.perf_counter() - time_before
+            added = index.closest_match(samples[0], 25.0, False).get_absolute_path()
+            print(f"   Index updated with one added file in {refresh_time * 1000.0:.2f} ms;  "
+                  f"{'it is' if added.endswith('bias-added.fit') else 'it is NOT'} chosen for its temperature")
+
+    # Calibrating with a pedestal of 100 and combining by mean, median, and min-max clipping, with the stack
+    # held as doubles versus as the files' 16-bit integers (see ImageMath.strip_dtype), which must agree
+    # exactly.  The stack is copied before each run, untimed, since calibration changes it.
+
+    @classmethod
+    def integer_combine(cls, file_names: [str], repetitions: int):
+        data_model = DataModel(Preferences())
+        data_model.set_precalibration_type(Constants.CALIBRATION_PEDESTAL)
+        data_model.set_precalibration_pedestal(100)
+        calibrator = Calibrator(data_model)
+        stacks = {"double": cls.read_stack(file_names)}
+        stacks["uint16"] = stacks["double"].astype(numpy.uint16)
+        print(f"Calibrating and combining {stacks['double'].shape} stack, best of {repetitions}")
+        for (label, stack) in stacks.items():
+            print(f"   {label:<32} {stack.nbytes / (1024 * 1024):10.1f} MB stack")
+        methods = [("Mean", Constants.COMBINE_MEAN, ()),
+                   ("Median", Constants.COMBINE_MEDIAN, ()),
+                   ("Min-max clip 2", Constants.COMBINE_MINMAX, (2, Constants.MINMAX_CLIP_TIES))]
+        for (label, method, parameters) in methods:
+            print(f" {label}")
+            work = {}
+
+            def fresh_stacks():
+                work.update({name: stack.copy() for (name, stack) in stacks.items()})
+
+            def combine(name: str) -> ndarray:
+                stack = work[name]
+                for frame in stack:
+                    calibrator.calibrate_rows(frame, 0, frame.shape)
+                return ImageMath.combine_tile(method, parameters, stack, ConsoleSilent(), SessionController())
+
+            fresh_stacks()
+            if not numpy.array_equal(combine("double"), combine("uint16")):
+                print("   Results differ")
+                return
+            double_time = cls.best_time(lambda: combine("double"), repetitions, setup=fresh_stacks)
+            integer_time = cls.best_time(lambda: combine("uint16"), repetitions, setup=fresh_stacks)
+            cls.report("Doubles", double_time, double_time)
+            cls.report("16-bit integers", integer_time, double_time)
+
+    # The previous version of ImageMath.sigma_clip_stack, masking the rejected data and taking the mean of the
+    # masked stack:  the reference sigma_clip_stack is checked against, and timed against.
+
+    @classmethod
+    def sigma_clip_masked(cls, file_data: ndarray, sigma_threshold: float,
+                          console: Console, session_controller: SessionController) -> ndarray:
+        console.push_level()
+        console.message("Calculating unclipped means", +1)
+        column_means = numpy.mean(file_data, axis=0, dtype=numpy.float64)
+        ImageMath.check_cancellation(session_controller)
+
+        # The statistics and z-scores are computed one frame at a time, in double precision whatever the
+        # working precision, so only frame-sized temporaries are needed, and values that fall right at the
+        # threshold are kept or rejected exactly as they would be in double precision.  Summing the squared
+        # deviations frame by frame adds them in the same order numpy.std does, so gives the same result.
+        console.message("Calculating standard deviations", 0)
+        sum_of_squares = numpy.zeros(column_means.shape)
+        for frame in file_data:
+            deviations = frame - column_means
+            sum_of_squares += deviations * deviations
+        column_stdevs = numpy.sqrt(sum_of_squares / len(file_data))
+        ImageMath.check_cancellation(session_controller)
+        console.message("Calculating z-scores", 0)
+        # Now what we'd like to do is just:
+        #    z_scores = abs(file_data - column_means) / column_stdevs
+        # Unfortunately, standard deviations can be zero, so that simplistic
+        # statement would generate division-by-zero errors.
+        # Std for a column would be zero if all the values in the column were identical.
+        # In that case we wouldn't want to eliminate any anyway, so we'll set the
+        # zero stdevs to a large number, which causes the z-scores to be small, which
+        # causes no values to be eliminated.
+        column_stdevs[column_stdevs == 0.0] = sys.float_info.max
+        exceeds_threshold = numpy.empty(file_data.shape, dtype=bool)
+        for (index, frame) in enumerate(file_data):
+            z_scores = abs(frame - column_means) / column_stdevs
+            exceeds_threshold[index] = z_scores > sigma_threshold
+        ImageMath.check_cancellation(session_controller)
+        console.message("Eliminated data outside threshold", 0)
+
+        # Calculate and display how much data we are ignoring
+        dimensions = exceeds_threshold.shape
+        total_pixels = dimensions[0] * dimensions[1] * dimensions[2]
+        number_masked = numpy.count_nonzero(exceeds_threshold)
+        percentage_masked = 100.0 * number_masked / total_pixels
+        console.message(f"Discarded {number_masked:,} pixels of {total_pixels:,} "
+                        f"({percentage_masked:.3f}% of data)", +1)
+
+        masked_array = ma.masked_array(file_data, exceeds_threshold)
+        ImageMath.check_cancellation(session_controller)
+        console.message("Calculating adjusted means", -1)
+        masked_means = ma.mean(masked_array, axis=0, dtype=numpy.float64)
+        ImageMath.check_cancellation(session_controller)
+
+        # If the means matrix contains any masked values, that means that in that column the clipping
+        # eliminated *all* the data.  We will find the offending columns and re-calculate those using
+        # simple min-max clipping.
+        if ma.is_masked(masked_means):
+            console.message("Some columns lost all their values; min-max clipping those columns.", 0)
+            #  Get the mask, and get a 2D matrix showing which columns were entirely masked
+            eliminated_columns_map = ndarray.all(exceeds_threshold, axis=0)
+            masked_means[eliminated_columns_map] = ImageMath.repair_columns(file_data, eliminated_columns_map, 2)
+            # We've replaced the problematic columns, now the mean should calculate cleanly
+            assert not ma.is_masked(masked_means)
+        ImageMath.check_cancellation(session_controller)
+        console.pop_level()
+        result = masked_means.round().filled()
+        return result
+
+    # Sigma clipping at 2.0:  masking the rejected data (sigma_clip_masked) versus running sums and counts
+    # of the data kept (sigma_clip_stack)
+
+    @classmethod
+    def sigma_clip(cls, file_names: [str], repetitions: int):
+        stack = cls.read_stack(file_names)
+        print(f"Sigma clipping {stack.shape} stack ({stack.nbytes / (1024 * 1024):.0f} MB), best of {repetitions}")
+
+        def masked() -> ndarray:
+            return cls.sigma_clip_masked(stack, 2.0, ConsoleSilent(), SessionController())
+
+        def accumulated() -> ndarray:
+            return ImageMath.sigma_clip_stack(stack, 2.0, ConsoleSilent(), SessionController())
+
+        if not numpy.array_equal(masked(), accumulated()):
+            print("   Results differ")
+            return
+        masked_time = cls.best_time(masked, repetitions)
+        accumulated_time = cls.best_time(accumulated, repetitions)
+        cls.report("Masked array", masked_time, masked_time)
+        cls.report("Sums and counts", accumulated_time, masked_time)
+        for (label, function) in [("Masked array", masked), ("Sums and counts", accumulated)]:
+            print(f"   {label:<32} {cls.peak_memory(function) / (1024 * 1024):10.1f} MB working memory")
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        "approximate-median": Benchmarks.approximate_median,
+        "approximate-median-check": Benchmarks.approximate_median_check,
+        "calibration-lookup": Benchmarks.calibration_lookup,
+        "column-repair": Benchmarks.column_repair,
+        "header-scan": Benchmarks.header_scan,
+        "integer-combine": Benchmarks.integer_combine,
+        "median": Benchmarks.median,
+        "min-max-clip": Benchmarks.min_max_clip,
+        "sigma-clip": Benchmarks.sigma_clip,
+        "sorting-network": Benchmarks.sorting_network,
+        "tile-threads": Benchmarks.tile_threads,
+    }
+    arg_parser = ArgumentParser(description="Time alternative implementations of MasterDarkMaker operations")
+    arg_parser.add_argument("benchmark", choices=sorted(benchmarks.keys()))
+    arg_parser.add_argument("-r", "--repetitions", type=int, default=5,
+                            help="Number of timed runs of each alternative; the fastest is reported")
+    arg_parser.add_argument("filenames", nargs="*")
+    args = arg_parser.parse_args()
+    benchmarks[args.benchmark](args.filenames, args.repetitions)
@@ -0,0 +1,71 @@
+#
+#   Cache of calibration images read from files, so a bias file chosen for several groups of frames
+#   in a session (usually the same one or two, nearest in temperature) is read and decoded only once.
+#
+#   Images are kept by file path, size, and modification time, and the data type read as, so a
+#   file that changes is read again.  The images kept are limited to a given number of bytes;  when
+#   adding one would exceed that, the least recently used are dropped.  The images are read-only,
+#   since they are shared.  One cache is shared by all threads, serialized with a lock, and is cleared
+#   when each session starts (see FileCombiner).
+#
+import os
+import threading
+from collections import OrderedDict
+
+import numpy
+from numpy import ndarray
+
+from RmFitsUtil import RmFitsUtil
+
+
+class CalibrationImageCache:
+    # Images kept, least recently used first, keyed by (absolute path, size, modification time, data type)
+    _images: OrderedDict = OrderedDict()
+    _bytes_held = 0
+    _hits = 0
+    _misses = 0
+    _lock = threading.Lock()
+
+    # The image in the given file, read as the given data type, from the cache if it is there, otherwise
+    # read from the file and kept, if it fits within the given number of bytes.  The image is read-only.
+    #
+    #   Exceptions thrown:
+    #       (those of RmFitsUtil.fits_data_from_path)
+
+    @classmethod
+    def image(cls, file_path: str, dtype, budget_bytes: int) -> ndarray:
+        status = os.stat(file_path)
+        key = (os.path.abspath(file_path), status.st_size, status.st_mtime_ns, numpy.dtype(dtype).str)
+        with cls._lock:
+            if key in cls._images:
+                cls._images.move_to_end(key)
+                cls._hits += 1
+                return cls._images[key]
+            cls._misses += 1
+        image = RmFitsUtil.fits_data_from_path(file_path, dtype)
+        image.flags.writeable = False
+        with cls._lock:
+            if image.nbytes <= budget_bytes and key not in cls._images:
+                cls._images[key] = image
+                cls._bytes_held += image.nbytes
+                while cls._bytes_held > budget_bytes:
+                    (_, dropped) = cls._images.popitem(last=False)
+                    cls._bytes_held -= dropped.nbytes
+        return image
+
+    # Numbers of images found in the cache and read from files, and the bytes and number of images held
+
+    @classmethod
+    def statistics(cls) -> (int, int, int, int):
+        with cls._lock:
+            return cls._hits, cls._misses, cls._bytes_held, len(cls._images)
+
+    # Drop all the images kept, and reset the counts
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._images.clear()
+            cls._bytes_held = 0
+            cls._hits = 0
+            cls._misses = 0
@@ -0,0 +1,189 @@
+#
+#   Index of a directory of calibration files, for choosing the best one for a set of frames:  the
+#   files of each size and binning, sorted by temperature, so the one closest to a given temperature
+#   is found by a binary search rather than by reading every file's header and examining them all.
+#
+#   An index is made the first time a directory is used in a session, and kept for the rest of the session
+#   (see for_directory and forget_all).  Before each use, the modification times of the directory and its
+#   sub-directories are checked;  if any has changed, files have been added or removed, so the directory
+#   is listed again and the files that are gone are dropped.  The size and modification time of each file
+#   are checked too, and the headers of only the files that are new or have changed are read.
+#
+import bisect
+import os
+import threading
+from typing import Optional
+
+from Console import Console
+from FileDescriptor import FileDescriptor
+from RmFitsUtil import RmFitsUtil
+from SessionController import SessionController
+from SharedUtils import SharedUtils
+
+
+class CalibrationIndex:
+    # Indexes made so far, by (absolute directory path, recursive), and a lock on their use
+    _indexes: {(str, bool): "CalibrationIndex"} = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, directory_path: str, recursive: bool):
+        self._directory_path = directory_path
+        self._recursive = recursive
+        # Modification time of each directory searched, when the files were last listed
+        self._directory_times: {str: int} = {}
+        # Files in the last listing, and the size and modification time of each when its header was read
+        self._file_names: [str] = []
+        self._file_stats: {str: Optional[tuple]} = {}
+        # Descriptor of each file indexed, and the position of each file in the last listing
+        self._descriptors: {str: FileDescriptor} = {}
+        self._listing_order: {str: int} = {}
+        # Files whose headers could not be read, with the error message, so they aren't read again
+        self._unreadable: {str: str} = {}
+        # By (binning, x size, y size):  temperatures, ascending, and the descriptors with those
+        # temperatures, in the same order;  of all the files, and of the bias files only
+        self._all_by_size: {(int, int, int): ([float], [FileDescriptor])} = {}
+        self._bias_by_size: {(int, int, int): ([float], [FileDescriptor])} = {}
+
+    # The index of the given directory, made if it hasn't been already in this session, and brought up to
+    # date with the files now in the directory
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session was cancelled while reading file headers
+
+    @classmethod
+    def for_directory(cls, directory_path: str, recursive: bool, worker_count: int,
+                      console: Console, session_controller: SessionController) -> "CalibrationIndex":
+        key = (os.path.abspath(directory_path), recursive)
+        with cls._indexes_lock:
+            if key not in cls._indexes:
+                cls._indexes[key] = CalibrationIndex(directory_path, recursive)
+            index = cls._indexes[key]
+            index.refresh(worker_count, console, session_controller)
+            return index
+
+    # Forget all the indexes made, so directories are indexed again when next used
+
+    @classmethod
+    def forget_all(cls):
+        with cls._indexes_lock:
+            cls._indexes.clear()
+
+    # Modification times of the directory and, if recursive, all its sub-directories.
+    # A directory that can't be examined is left out, so its appearance or disappearance is a change.
+
+    def current_directory_times(self) -> {str: int}:
+        if self._recursive:
+            directories = [path for (path, _, _) in os.walk(self._directory_path)]
+        else:
+            directories = [self._directory_path]
+        times = {}
+        for directory in directories:
+            try:
+                times[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                pass
+        return times
+
+    # Size and modification time of the given file, or None if it can't be examined
+
+    @staticmethod
+    def file_stat(file_name: str) -> Optional[tuple]:
+        try:
+            status = os.stat(file_name)
+        except OSError:
+            return None
+        return status.st_size, status.st_mtime_ns
+
+    # If the directory's files may have been added or removed since they were last listed, list them
+    # again and drop the files no longer there.  Read the headers of the files not seen before, and of
+    # those whose size or modification time has changed (a file replaced under the same name doesn't
+    # always change the directory's modification time), and re-sort the files by temperature.
+    # A directory that doesn't exist, or can't be examined, is listed every time.
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session was cancelled while reading file headers
+
+    def refresh(self, worker_count: int, console: Console, session_controller: SessionController):
+        directory_times = self.current_directory_times()
+        listing_changed = len(directory_times) == 0 or directory_times != self._directory_times
+        if listing_changed:
+            file_names = SharedUtils.files_in_directory(self._directory_path, self._recursive)
+        else:
+            file_names = self._file_names
+        file_stats = {name: self.file_stat(name) for name in file_names}
+        changed_names = [name for name in file_names
+                         if name not in self._file_stats or self._file_stats[name] != file_stats[name]]
+        if len(changed_names) > 0:
+            console.message(f"Indexing {len(changed_names)} calibration files in {self._directory_path}", 0,
+                            temp=True)
+            for name in changed_names:
+                self._descriptors.pop(name, None)
+                self._unreadable.pop(name, None)
+            (descriptors, failures) = RmFitsUtil.scan_file_descriptions(changed_names, worker_count,
+                                                                        session_controller)
+            for descriptor in descriptors:
+                self._descriptors[descriptor.get_absolute_path()] = descriptor
+            for (name, message) in failures:
+                console.message(f"Ignoring unreadable calibration file {name}: {message}", 0, temp=True)
+                self._unreadable[name] = message
+            for name in changed_names:
+                self._file_stats[name] = file_stats[name]
+        if listing_changed:
+            self._file_names = file_names
+            self._listing_order = {name: position for (position, name) in enumerate(file_names)}
+            for gone in [name for name in self._file_stats if name not in self._listing_order]:
+                del self._file_stats[gone]
+                self._descriptors.pop(gone, None)
+                self._unreadable.pop(gone, None)
+        if listing_changed or len(changed_names) > 0:
+            self.sort_by_size_and_temperature()
+        self._directory_times = directory_times
+
+    # Group the descriptors by size and binning, each group sorted by temperature.  Files of the same
+    # temperature are left in the order they were listed in.
+
+    def sort_by_size_and_temperature(self):
+        self._all_by_size = {}
+        self._bias_by_size = {}
+        in_listing_order = sorted(self._descriptors.values(),
+                                  key=lambda d: self._listing_order[d.get_absolute_path()])
+        for descriptor in sorted(in_listing_order, key=lambda d: d.get_temperature()):
+            key = (descriptor.get_binning(), descriptor.get_x_dimension(), descriptor.get_y_dimension())
+            groups = [self._all_by_size]
+            if descriptor.get_type() == FileDescriptor.FILE_TYPE_BIAS:
+                groups.append(self._bias_by_size)
+            for group in groups:
+                (temperatures, descriptors) = group.setdefault(key, ([], []))
+                temperatures.append(descriptor.get_temperature())
+                descriptors.append(descriptor)
+
+    # Number of files indexed, and number of those that are bias files
+
+    def number_of_files(self) -> int:
+        return len(self._descriptors)
+
+    def number_of_bias_files(self) -> int:
+        return sum(len(descriptors) for (_, descriptors) in self._bias_by_size.values())
+
+    # The file of the same size and binning as the given sample file whose temperature is closest to
+    # the given temperature, only bias files if asked, or None if there is no such file.  Of files equally
+    # close, the one first in the directory listing is chosen, as examining the files in order would.
+
+    def closest_match(self, sample_file: FileDescriptor, target_temperature: float,
+                      bias_only: bool) -> Optional[FileDescriptor]:
+        key = (sample_file.get_binning(), sample_file.get_x_dimension(), sample_file.get_y_dimension())
+        group = (self._bias_by_size if bias_only else self._all_by_size).get(key)
+        if group is None:
+            return None
+        (temperatures, descriptors) = group
+        # The files at the nearest temperature below the target, and at or above it
+        above = bisect.bisect_left(temperatures, target_temperature)
+        candidates = []
+        if above > 0:
+            below_temperature = temperatures[above - 1]
+            candidates += descriptors[bisect.bisect_left(temperatures, below_temperature):above]
+        if above < len(temperatures):
+            above_temperature = temperatures[above]
+            candidates += descriptors[above:bisect.bisect_right(temperatures, above_temperature)]
+        return min(candidates, key=lambda d: (abs(d.get_temperature() - target_temperature),
+                                              self._listing_order[d.get_absolute_path()]))
@@ -1,19 +1,19 @@
 #
 #   Class to handle calibration of images using specified method (including none)
 #
-import sys
 from typing import Optional
 
+import numpy
 from numpy import ndarray
 
 import MasterMakerExceptions
+from CalibrationImageCache import CalibrationImageCache
+from CalibrationIndex import CalibrationIndex
 from Console import Console
 from Constants import Constants
 from DataModel import DataModel
 from FileDescriptor import FileDescriptor
-from RmFitsUtil import RmFitsUtil
 from SessionController import SessionController
-from SharedUtils import SharedUtils
 
 
 class Calibrator:
@@ -22,143 +22,116 @@ class Calibrator:
     #
     def __init__(self, data_model: DataModel):
         self._data_model = data_model
+        # Image subtracted from each frame, when calibrating with a file.  See prepare_calibration
+        self._calibration_image: Optional[ndarray] = None
 
-    def calibrate_images(self, file_data: [ndarray],
-                         sample_file: FileDescriptor,
-                         console: Console,
-                         session_controller: SessionController) -> [ndarray]:
+    # Get ready to calibrate frames like the given sample file, in the given data type.
+    # This finds and reads the calibration image, if one is used, once for all the frames;
+    # calibrate_rows then calibrates each frame, or part of one, as it is read.
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session was cancelled while selecting the calibration file
+    #       (and those of get_best_calibration_file)
+
+    def prepare_calibration(self, sample_file: FileDescriptor, dtype,
+                            console: Console,
+                            session_controller: SessionController):
+        self._calibration_image = None
         calibration_type = self._data_model.get_precalibration_type()
         if calibration_type == Constants.CALIBRATION_NONE:
-            return file_data
+            pass
         elif calibration_type == Constants.CALIBRATION_PEDESTAL:
-            return self.calibrate_with_pedestal(file_data,
-                                                self._data_model.get_precalibration_pedestal(),
-                                                console,
-                                                session_controller)
+            console.message(f"Calibrate with pedestal = {self._data_model.get_precalibration_pedestal()}", 0)
         elif calibration_type == Constants.CALIBRATION_FIXED_FILE:
-            return self.calibrate_with_file(file_data,
-                                            self._data_model.get_precalibration_fixed_path(),
-                                            console,
-                                            session_controller)
+            self.read_calibration_image(self._data_model.get_precalibration_fixed_path(), dtype, console)
         else:
             assert calibration_type == Constants.CALIBRATION_AUTO_DIRECTORY
-            return self.calibrate_with_auto_directory(file_data,
-                                                      self._data_model.get_precalibration_auto_directory(),
-                                                      sample_file,
-                                                      console,
-                                                      session_controller)
-
-    def calibrate_with_pedestal(self,
-                                file_data: [ndarray],
-                                pedestal: int,
-                                console: Console,
-                                session_controller: SessionController) -> [ndarray]:
-        result = file_data.copy()
-        console.message(f"Calibrate with pedestal = {pedestal}", 0)
-        for index in range(len(result)):
+            auto_directory_path = self._data_model.get_precalibration_auto_directory()
+            console.message(f"Selecting best calibration file from {auto_directory_path}", 0)
+            calibration_file = self.get_best_calibration_file(auto_directory_path, sample_file,
+                                                              console, session_controller)
             if session_controller.thread_cancelled():
-                break
-            reduced_by_pedestal: ndarray = result[index] - pedestal
-            result[index] = reduced_by_pedestal.clip(0, 0xFFFF)
-        return result
+                raise MasterMakerExceptions.SessionCancelled
+            # Should never come back None because an exception will have handled failure
+            assert calibration_file is not None
+            self.read_calibration_image(calibration_file, dtype, console)
+
+    # Get the calibration image from the given file, from the session's cache of them if it was read for an
+    # earlier group (see CalibrationImageCache), and report the cache's use so far
 
-    def calibrate_with_file(self, file_data: [ndarray], calibration_file_path: str, console: Console,
-                            session_controller: SessionController) -> [ndarray]:
+    def read_calibration_image(self, calibration_file_path: str, dtype, console: Console):
         console.message(f"Calibrate with file: {calibration_file_path}", 0)
-        result = file_data.copy()
-        calibration_image = RmFitsUtil.fits_data_from_path(calibration_file_path)
-        (calibration_x, calibration_y) = calibration_image.shape
-        for index in range(len(result)):
-            if session_controller.thread_cancelled():
-                break
-            (layer_x, layer_y) = result[index].shape
-            if (layer_x != calibration_x) or (layer_y != calibration_y):
-                raise MasterMakerExceptions.IncompatibleSizes
-            difference = result[index] - calibration_image
-            result[index] = difference.clip(0, 0xFFFF)
-        return result
+        self._calibration_image = CalibrationImageCache.image(
+            calibration_file_path, dtype, self._data_model.get_calibration_cache_megabytes() * 1024 * 1024)
+        (hits, misses, bytes_held, images_held) = CalibrationImageCache.statistics()
+        console.message(f"Calibration image cache: {hits} hit{'' if hits == 1 else 's'}, "
+                        f"{misses} miss{'' if misses == 1 else 'es'};  {images_held} image"
+                        f"{'' if images_held == 1 else 's'} ({bytes_held / (1024 * 1024):.1f} MB) kept", +1,
+                        temp=True)
+
+    # Calibrate, in place, some rows of a frame of the given (rows, columns) shape, starting at the given row,
+    # as set up by prepare_calibration:  subtract the pedestal or the same rows of the calibration image,
+    # keeping the result within the range of the 16-bit data.  The subtraction and the clipping both write
+    # into the rows themselves, so no temporary arrays are made;  the results are the same, operation for
+    # operation, as from subtracting into a new array and clipping that.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The calibration image is not the same size as the frame
 
-    def calibrate_with_auto_directory(self, file_data: [ndarray], auto_directory_path: str,
-                                      sample_file: FileDescriptor, console: Console,
-                                      session_controller: SessionController) -> [ndarray]:
-        console.message(f"Selecting best calibration file from {auto_directory_path}", 0)
-        calibration_file = self.get_best_calibration_file(auto_directory_path, sample_file,
-                                                          session_controller)
-        # Should never come back None because an exception will have handled failure
-        assert calibration_file is not None
-        if session_controller.thread_running():
-            return self.calibrate_with_file(file_data, calibration_file, console, session_controller)
+    def calibrate_rows(self, frame_rows: ndarray, first_row: int, frame_shape: (int, int)):
+        calibration_type = self._data_model.get_precalibration_type()
+        if calibration_type == Constants.CALIBRATION_NONE:
+            return
+        elif calibration_type == Constants.CALIBRATION_PEDESTAL:
+            pedestal = self._data_model.get_precalibration_pedestal()
+            if frame_rows.dtype == numpy.uint16:
+                # 16-bit integer data (see ImageMath.strip_dtype):  a subtraction that stops at zero,
+                # which is all the clipping would do
+                numpy.maximum(frame_rows, pedestal, out=frame_rows)
+                numpy.subtract(frame_rows, pedestal, out=frame_rows)
+                return
+            numpy.subtract(frame_rows, pedestal, out=frame_rows)
         else:
-            return None
+            assert self._calibration_image is not None
+            if frame_shape != self._calibration_image.shape:
+                raise MasterMakerExceptions.IncompatibleSizes
+            (rows, _) = frame_rows.shape
+            numpy.subtract(frame_rows, self._calibration_image[first_row:first_row + rows], out=frame_rows)
+        numpy.clip(frame_rows, 0, 0xFFFF, out=frame_rows)
 
     #
-    # Get the best matched calibration file in the auto directory.  Only BIAS files
-    # of the correct size will be selected
+    # Get the best matched calibration file in the auto directory:  of the correct size and binning,
+    # only BIAS files if so set, and closest in temperature to the sample file.  The directory's index
+    # (see CalibrationIndex) is made the first time it is used in the session, and kept up to date, so
+    # each group of files processed doesn't read all the calibration files' headers again.
     # If no suitable file, raise exception
     #
     #   Exceptions thrown:
+    #       AutoCalibrationDirectoryEmpty
+    #       AutoCalibrationNoBiasFiles
     #       NoSuitableAutoBias
+    #       SessionCancelled        The session was cancelled while indexing the directory
 
     def get_best_calibration_file(self, directory_path: str, sample_file: FileDescriptor,
+                                  console: Console,
                                   session_controller: SessionController) -> Optional[str]:
-        # Get all calibration files in the given directory
-        all_descriptors = self.all_descriptors_from_directory(directory_path,
-                                                              self._data_model.get_auto_directory_recursive())
-        if session_controller.thread_cancelled():
-            return None
-        if len(all_descriptors) == 0:
+        index = CalibrationIndex.for_directory(directory_path, self._data_model.get_auto_directory_recursive(),
+                                               self._data_model.get_scan_worker_count(),
+                                               console, session_controller)
+        if index.number_of_files() == 0:
             # No files in that directory, raise exception
             raise MasterMakerExceptions.AutoCalibrationDirectoryEmpty(directory_path)
-        # Filter to Bias files if option and give exception if none
-        if self._data_model.get_auto_directory_bias_only():
-            all_descriptors = list((d for d in all_descriptors if d.get_type() == FileDescriptor.FILE_TYPE_BIAS))
-            if len(all_descriptors) == 0:
-                raise MasterMakerExceptions.AutoCalibrationNoBiasFiles
+        bias_only = self._data_model.get_auto_directory_bias_only()
+        if bias_only and index.number_of_bias_files() == 0:
+            raise MasterMakerExceptions.AutoCalibrationNoBiasFiles
 
-        # Get the subset that are the correct size and binning
-        correct_size = self.filter_to_correct_size(all_descriptors, sample_file)
-        if session_controller.thread_cancelled():
-            return None
-        if len(correct_size) == 0:
+        # Of the correct-sized files, the one closest to the sample file temperature
+        closest_match = index.closest_match(sample_file, sample_file.get_temperature(), bias_only)
+        if closest_match is None:
             # No files in that directory are the correct size
             raise MasterMakerExceptions.NoSuitableAutoBias
-
-        # From the correct-sized files, find the one closest to the sample file temperature
-        closest_match = self.closest_temperature_match(correct_size, sample_file.get_temperature())
         return closest_match.get_absolute_path()
 
-    def all_descriptors_from_directory(self, directory_path: str,
-                                       recursive: bool) -> [FileDescriptor]:
-        paths: [str] = SharedUtils.files_in_directory(directory_path, recursive)
-        descriptors = RmFitsUtil.make_file_descriptions(paths)
-        return descriptors
-
-    def filter_to_correct_size(self, all_descriptors: [FileDescriptor], sample_file: FileDescriptor) \
-            -> [FileDescriptor]:
-        x_dimension = sample_file.get_x_dimension()
-        y_dimension = sample_file.get_y_dimension()
-        binning = sample_file.get_binning()
-        d: FileDescriptor
-        filtered = [d for d in all_descriptors
-                    if d.get_x_dimension() == x_dimension
-                    and d.get_y_dimension() == y_dimension
-                    and d.get_binning() == binning]
-        return filtered
-
-    def closest_temperature_match(self, descriptors: [FileDescriptor],
-                                  target_temperature: float) -> FileDescriptor:
-        best_file_so_far: FileDescriptor = FileDescriptor("dummy-not-used")
-        best_difference_so_far = sys.float_info.max
-        for descriptor in descriptors:
-            this_difference = abs(descriptor.get_temperature() - target_temperature)
-            if this_difference < best_difference_so_far:
-                best_difference_so_far = this_difference
-                best_file_so_far = descriptor
-        assert best_file_so_far is not None
-        # console.message(f"Selected calibration file {best_file_so_far.get_name()} "
-        #                 f"at temperature {best_file_so_far.get_temperature()}", +1, temp=True)
-        return best_file_so_far
-
     # Get a small text tag about calibration to include in the FITs file comment
 
     def fits_comment_tag(self) -> str:
@@ -29,6 +29,9 @@ class CommandLineHandler:
         single_output_path: str
         (valid, single_output_path, file_names) = self.validate_inputs()
         if valid:
+            RmFitsUtil.set_up_descriptor_cache(self._data_model.get_use_descriptor_cache(),
+                                               self._data_model.get_descriptor_cache_max_entries(),
+                                               rebuild=self._args.rebuildcache)
             groups_output_directory = self._args.outputdirectory
             if self.process_files(file_names, single_output_path, groups_output_directory):
                 print("Successful completion")
@@ -41,9 +44,23 @@ class CommandLineHandler:
     #   -   If a pedestal value is specified, it is > 0
     #   -   If a min-max clip value is specified, it is > 0
     #   -   If a sigma threshold is specified, it is > 0
+    #   -   If -si used, sigma clip iterations is > 0
+    #   -   If -sl or -sh used, the threshold is > 0
+    #   -   If -si, -sc, -ss, -sl or -sh used, -s is used
     #   -   If -ge used, bandwidth is 0.1 to 50
     #   -   If -gt used, bandwidth is 0.1 to 50
     #   -   If -mg used, group size is > 0
+    #   -   If -sw used, worker count is > 0
+    #   -   If -j used, process count is > 0
+    #   -   If -ct used, thread count is > 0
+    #   -   If -cm used, combine memory is > 0
+    #   -   If -ra used, read-ahead memory is > 0
+    #   -   If -cc used, calibration cache memory is >= 0
+    #   -   If -st used, streaming is auto, always or never (checked by the argument parser)
+    #   -   If -pr used, precision is single or double (checked by the argument parser)
+    #   -   If -mc used, min-max clip mode is ties or exact (checked by the argument parser), and -mm is used
+    #   -   If -nm used, median mode is exact or approximate (checked by the argument parser), and -n is used
+    #   -   If -sy used, the exposure is > 0, and no group-by options are used
     #   Returns:  validity flag, output path if specified, array of file names
 
     def validate_inputs(self) -> (bool, [str]):
@@ -127,6 +144,58 @@ class CommandLineHandler:
             else:
                 print(f"Sigma clipping threshold must be > 0, not {args.sigma}")
                 valid = False
+        sigma_options = [option for (option, value) in [("-si", args.sigmaiterations), ("-sc", args.sigmacenter),
+                                                        ("-ss", args.sigmascale), ("-sl", args.sigmalow),
+                                                        ("-sh", args.sigmahigh)]
+                         if value is not None]
+        if len(sigma_options) > 0 and args.sigma is None:
+            print(f"The {', '.join(sigma_options)} options can be used only with -s")
+            valid = False
+        if args.sigmaiterations is not None:
+            if args.sigmaiterations > 0:
+                print(f"   Sigma clipping up to {args.sigmaiterations} times")
+                self._data_model.set_sigma_clip_max_iterations(args.sigmaiterations)
+            else:
+                print(f"Sigma clipping iterations must be > 0, not {args.sigmaiterations}")
+                valid = False
+        if args.sigmacenter is not None:
+            print(f"   Sigma clipping from the {args.sigmacenter}")
+            self._data_model.set_sigma_clip_center(Constants.SIGMA_CENTER_MEDIAN if args.sigmacenter == "median"
+                                                   else Constants.SIGMA_CENTER_MEAN)
+        if args.sigmascale is not None:
+            print(f"   Sigma clipping in units of {args.sigmascale}")
+            self._data_model.set_sigma_clip_scale(Constants.SIGMA_SCALE_MAD if args.sigmascale == "mad"
+                                                  else Constants.SIGMA_SCALE_STD)
+        if args.sigmalow is not None:
+            if args.sigmalow > 0:
+                print(f"   Sigma clipping values below the center at z-threshold {args.sigmalow}")
+                self._data_model.set_sigma_clip_low_threshold(args.sigmalow)
+            else:
+                print(f"Sigma clipping low threshold must be > 0, not {args.sigmalow}")
+                valid = False
+        if args.sigmahigh is not None:
+            if args.sigmahigh > 0:
+                print(f"   Sigma clipping values above the center at z-threshold {args.sigmahigh}")
+                self._data_model.set_sigma_clip_high_threshold(args.sigmahigh)
+            else:
+                print(f"Sigma clipping high threshold must be > 0, not {args.sigmahigh}")
+                valid = False
+        if args.minmaxclip is not None:
+            if args.minmax is not None:
+                print(f"   Min-max clipping mode: {args.minmaxclip}")
+                self._data_model.set_min_max_clip_mode(Constants.MINMAX_CLIP_EXACT if args.minmaxclip == "exact"
+                                                       else Constants.MINMAX_CLIP_TIES)
+            else:
+                print("The -mc option can be used only with -mm")
+                valid = False
+        if args.medianmode is not None:
+            if args.median:
+                print(f"   Median is {args.medianmode}")
+                self._data_model.set_median_mode(Constants.MEDIAN_APPROXIMATE if args.medianmode == "approximate"
+                                                 else Constants.MEDIAN_EXACT)
+            else:
+                print("The -nm option can be used only with -n")
+                valid = False
 
         # Insist on same file type in all files?
         if args.ignoretype:
@@ -179,8 +248,80 @@ class CommandLineHandler:
                 print(f"   Minimum group size must be > 0, not {minimum_size}")
                 valid = False
 
+        # Performance tuning
+        if args.scanworkers is not None:
+            if args.scanworkers > 0:
+                print(f"   Read {args.scanworkers} file headers at once")
+                self._data_model.set_scan_worker_count(args.scanworkers)
+            else:
+                print(f"Scan worker count must be > 0, not {args.scanworkers}")
+                valid = False
+        if args.jobs is not None:
+            if args.jobs > 0:
+                print(f"   Combine with {args.jobs} processes")
+                self._data_model.set_combine_process_count(args.jobs)
+            else:
+                print(f"Number of processes must be > 0, not {args.jobs}")
+                valid = False
+        if args.combinethreads is not None:
+            if args.combinethreads > 0:
+                print(f"   Combine with {args.combinethreads} threads")
+                self._data_model.set_combine_thread_count(args.combinethreads)
+            else:
+                print(f"Number of threads must be > 0, not {args.combinethreads}")
+                valid = False
+        if args.combinememory is not None:
+            if args.combinememory > 0:
+                print(f"   Combine using up to {args.combinememory} MB")
+                self._data_model.set_combine_memory_megabytes(args.combinememory)
+            else:
+                print(f"Combine memory must be > 0, not {args.combinememory}")
+                valid = False
+        if args.readahead is not None:
+            if args.readahead > 0:
+                print(f"   Read ahead up to {args.readahead} MB of frames")
+                self._data_model.set_read_ahead_megabytes(args.readahead)
+            else:
+                print(f"Read-ahead memory must be > 0, not {args.readahead}")
+                valid = False
+        if args.calibrationcache is not None:
+            if args.calibrationcache >= 0:
+                print(f"   Keep up to {args.calibrationcache} MB of calibration images for re-use")
+                self._data_model.set_calibration_cache_megabytes(args.calibrationcache)
+            else:
+                print(f"Calibration cache memory must be >= 0, not {args.calibrationcache}")
+                valid = False
+        if args.streaming is not None:
+            print(f"   Streaming combine: {args.streaming}")
+            self._data_model.set_streaming_mode({"auto": Constants.STREAMING_AUTO,
+                                                 "always": Constants.STREAMING_ALWAYS,
+                                                 "never": Constants.STREAMING_NEVER}[args.streaming])
+        if args.precision is not None:
+            print(f"   Combine in {args.precision} precision")
+            self._data_model.set_working_precision(Constants.PRECISION_SINGLE if args.precision == "single"
+                                                   else Constants.PRECISION_DOUBLE)
+        if args.nocache:
+            print("   Not using file header cache")
+            self._data_model.set_use_descriptor_cache(False)
+        elif args.rebuildcache:
+            print("   Rebuilding file header cache")
+            self._data_model.set_use_descriptor_cache(True)
+
+        # Synthesizing a master from a dark current model of the given masters
+        if args.synthesize is not None:
+            (exposure, temperature) = args.synthesize
+            if exposure > 0:
+                print(f"   Synthesize master for {exposure} seconds at {temperature} degrees")
+            else:
+                print(f"Synthesized master exposure must be > 0, not {exposure}")
+                valid = False
+            if self._data_model.get_group_by_temperature() or self._data_model.get_group_by_exposure() \
+                    or self._data_model.get_group_by_size():
+                print("The group-by options can't be used when synthesizing a master")
+                valid = False
+
         # If any of the grouping options are in use, then the output directory is mandatory
-        if self._data_model.get_group_by_temperature() or self._data_model.get_group_by_exposure() \
+        elif self._data_model.get_group_by_temperature() or self._data_model.get_group_by_exposure() \
                 or self._data_model.get_group_by_size():
             if args.outputdirectory is None:
                 print("If any of the group-by options are used, then the output directory option is mandatory")
@@ -193,7 +334,13 @@ class CommandLineHandler:
     def process_files(self, file_names: [str], output_path: str, groups_output_directory: str) -> bool:
         """Process all the files listed in the command line, with the given combination settings"""
         success = True
-        file_descriptors = RmFitsUtil.make_file_descriptions(file_names)
+        try:
+            file_descriptors = RmFitsUtil.make_file_descriptions(file_names,
+                                                                 self._data_model.get_scan_worker_count())
+        except MasterMakerExceptions.UnreadableFiles as exception:
+            for (file_name, message) in exception.get_failures():
+                self.error_dialog("Unreadable file", f"\"{file_name}\": {message}")
+            return False
         # check types are all dark
         if self._data_model.get_ignore_file_type() \
                 or FileCombiner.all_of_type(file_descriptors, FileDescriptor.FILE_TYPE_DARK):
@@ -216,10 +363,15 @@ class CommandLineHandler:
         dummy_session_controller = SessionController()
         file_combiner = FileCombiner(dummy_session_controller, self.file_moved_callback)
 
-        # Do the file combination - two methods depending on whether we are processing by groups
+        # Do the file combination - two methods depending on whether we are processing by groups,
+        # unless the files are master darks from which to synthesize a new one
         try:
+            if self._args.synthesize is not None:
+                (exposure, temperature) = self._args.synthesize
+                file_combiner.synthesize_master(descriptors, self._data_model, exposure, temperature,
+                                                output_path, console)
             # Are we using grouped processing?
-            if self._data_model.get_group_by_exposure() \
+            elif self._data_model.get_group_by_exposure() \
                     or self._data_model.get_group_by_size() \
                     or self._data_model.get_group_by_temperature():
                 file_combiner.process_groups(self._data_model, descriptors,
@@ -266,6 +418,8 @@ class CommandLineHandler:
         except MasterMakerExceptions.AutoCalibrationNoBiasFiles:
             self.error_dialog("No Bias Files",
                               f"The auto-directory does not contain any Bias files")
+        except MasterMakerExceptions.DarkModelNotFittable as exception:
+            self.error_dialog("Can't fit dark current model", exception.get_reason())
         except MasterMakerExceptions.SessionCancelled:
             self.error_dialog("Session Cancelled", " (This should not be possible in the non-GUI version)")
 
@@ -278,10 +432,13 @@ class CommandLineHandler:
                          output_path_parameter,
                          file_descriptors: [FileDescriptor]) -> str:
         """Create a suitable output file name, fully-qualified"""
-        if output_path_parameter == "":
+        if output_path_parameter == "" and self._args.synthesize is not None:
+            (exposure, temperature) = self._args.synthesize
+            return self.create_synthesized_output_path(file_descriptors[0], exposure, temperature)
+        elif output_path_parameter == "":
             return self.create_output_path(file_descriptors[0],
                                            self._data_model.get_master_combine_method(),
-                                           self._data_model.get_sigma_clip_threshold(),
+                                           self._data_model.get_sigma_clip_name(),
                                            self._data_model.get_min_max_number_clipped_per_end())
         else:
             return output_path_parameter
@@ -290,18 +447,30 @@ class CommandLineHandler:
     #   of the form Dark-Mean-yyyymmddhhmm-temp-x-y-bin.fit
     @classmethod
     def create_output_path(cls, sample_input_file: FileDescriptor,
-                           combine_method: int, sigma_threshold: float, min_max_clipped: int):
+                           combine_method: int, sigma_clip_name: str, min_max_clipped: int):
         """Create an output file name in the case where one wasn't specified"""
         # Get directory of sample input file
         directory_prefix = os.path.dirname(sample_input_file.get_absolute_path())
         file_name = cls.get_file_name_portion(combine_method, sample_input_file,
-                                              sigma_threshold, min_max_clipped)
+                                              sigma_clip_name, min_max_clipped)
         file_path = f"{directory_prefix}/{file_name}"
         return file_path
 
+    # Create a file name for a synthesized master, in the same location as the given master from which it
+    # was synthesized, of the form Dark-Model-yyyymmddhhmm-exposure-temp-x-y-bin.fit
+    @classmethod
+    def create_synthesized_output_path(cls, sample_input_file: FileDescriptor, exposure: float, temperature: float):
+        """Create an output file name for a synthesized master, where one wasn't specified"""
+        directory_prefix = os.path.dirname(sample_input_file.get_absolute_path())
+        date_time_string = datetime.now().strftime("%Y%m%d-%H%M")
+        dimensions = f"{sample_input_file.get_x_dimension()}x{sample_input_file.get_y_dimension()}"
+        binning = f"{sample_input_file.get_binning()}x{sample_input_file.get_binning()}"
+        return f"{directory_prefix}/DARK-MODEL-{date_time_string}-{exposure:.3f}s-{temperature:.1f}C-" \
+               f"{dimensions}-{binning}.fit"
+
     @classmethod
     def get_file_name_portion(cls, combine_method, sample_input_file,
-                              sigma_threshold, min_max_clipped):
+                              sigma_clip_name, min_max_clipped):
         # Get other components of name
         now = datetime.now()
         date_time_string = now.strftime("%Y%m%d-%H%M")
@@ -311,7 +480,7 @@ class CommandLineHandler:
         binning = f"{sample_input_file.get_binning()}x{sample_input_file.get_binning()}"
         method = Constants.combine_method_string(combine_method)
         if combine_method == Constants.COMBINE_SIGMA_CLIP:
-            method += str(sigma_threshold)
+            method += sigma_clip_name
         elif combine_method == Constants.COMBINE_MINMAX:
             method += str(min_max_clipped)
         file_name = f"DARK-{method}-{date_time_string}-{exposure}s-{temperature}C-{dimensions}-{binning}.fit"
@@ -0,0 +1,14 @@
+from Console import Console
+
+
+#
+#   A console handler that discards all output.  Used where the combination math routines are run
+#   with no one to report to, such as in the worker processes of a ParallelCombiner.
+#
+class ConsoleSilent(Console):
+
+    def __init__(self):
+        Console.__init__(self)
+
+    def output_message(self, message: str):
+        pass
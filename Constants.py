@@ -23,6 +23,29 @@ class Constants:
 
     DEFAULT_CALIBRATION_PEDESTAL = 100
 
+    # What floating point precision is used for the image data while combining?
+    PRECISION_DOUBLE = -5531  # 64-bit floating point
+    PRECISION_SINGLE = -5537  # 32-bit floating point:  half the memory, with wider sums where needed
+
+    # How does min-max clipping treat values equal to one being clipped?
+    MINMAX_CLIP_TIES = -4411  # Clip every value equal to a clipped minimum or maximum (the original way)
+    MINMAX_CLIP_EXACT = -4417  # Clip exactly the given number of values from each end of each column
+
+    # What statistics does sigma clipping measure z-scores against?
+    SIGMA_CENTER_MEAN = -4423  # Centre of the data is its mean
+    SIGMA_CENTER_MEDIAN = -4427  # Centre of the data is its median
+    SIGMA_SCALE_STD = -4441  # Spread of the data is its standard deviation
+    SIGMA_SCALE_MAD = -4447  # Spread of the data is its median absolute deviation, scaled to match a std
+
+    # Are frames combined by streaming them, one at a time, rather than holding the whole stack?
+    STREAMING_AUTO = -4451  # Stream when the stack wouldn't fit in the combine memory (and the method can)
+    STREAMING_ALWAYS = -4457  # Stream whenever the combine method can
+    STREAMING_NEVER = -4463  # Always combine the stack, in strips if need be
+
+    # Is the median exact, or approximated from histograms of streamed frames?
+    MEDIAN_EXACT = -4481  # Exact median of the whole stack, in strips if need be
+    MEDIAN_APPROXIMATE = -4483  # Approximate median, within a reported error, streaming the frames
+
     CONSOLE_INDENTATION_SIZE = 5
 
     @classmethod
@@ -39,6 +62,56 @@ class Constants:
             print(f"combine_method_string({method}): Invalid method")
             assert False
 
+    @classmethod
+    def precision_string(cls, value: int) -> str:
+        if value == cls.PRECISION_SINGLE:
+            return "Single"
+        else:
+            assert value == cls.PRECISION_DOUBLE
+            return "Double"
+
+    @classmethod
+    def min_max_clip_mode_string(cls, value: int) -> str:
+        if value == cls.MINMAX_CLIP_EXACT:
+            return "Exact"
+        else:
+            assert value == cls.MINMAX_CLIP_TIES
+            return "Ties"
+
+    @classmethod
+    def sigma_center_string(cls, value: int) -> str:
+        if value == cls.SIGMA_CENTER_MEDIAN:
+            return "Median"
+        else:
+            assert value == cls.SIGMA_CENTER_MEAN
+            return "Mean"
+
+    @classmethod
+    def sigma_scale_string(cls, value: int) -> str:
+        if value == cls.SIGMA_SCALE_MAD:
+            return "MAD"
+        else:
+            assert value == cls.SIGMA_SCALE_STD
+            return "Std"
+
+    @classmethod
+    def streaming_mode_string(cls, value: int) -> str:
+        if value == cls.STREAMING_ALWAYS:
+            return "Always"
+        elif value == cls.STREAMING_NEVER:
+            return "Never"
+        else:
+            assert value == cls.STREAMING_AUTO
+            return "Auto"
+
+    @classmethod
+    def median_mode_string(cls, value: int) -> str:
+        if value == cls.MEDIAN_APPROXIMATE:
+            return "Approximate"
+        else:
+            assert value == cls.MEDIAN_EXACT
+            return "Exact"
+
     @classmethod
     def disposition_string(cls, value: int) -> str:
         if value == cls.INPUT_DISPOSITION_NOTHING:
@@ -0,0 +1,184 @@
+#
+#   Model of each pixel's dark signal, fitted to a library of master darks of different exposures (and
+#   temperatures), from which a master for any exposure and temperature is synthesized, without taking
+#   and combining a new set of dark frames.
+#
+#   Each pixel's value in a master exposed t seconds at temperature T is modelled as
+#
+#       offset + rate * t + rate change * t * (T - T0)
+#
+#   that is, the bias level, plus dark current accumulating at a rate that changes with temperature,
+#   T0 being the masters' mean temperature.  (Dark current grows about exponentially with temperature,
+#   so a straight-line change holds over the few degrees a library is usually spread over.)  The
+#   temperature term is left out if the masters' temperatures are too close together to fit it.
+#
+#   All the pixels share the masters' exposures and temperatures, so the least-squares fit of every
+#   pixel is the same linear combination of the masters:  each coefficient image is a weighted sum of the
+#   master images, the weights being the pseudo-inverse of the matrix of the masters' terms.  The sums are
+#   done in strips by the tiled combine engine (see ImageMath.reduce_in_strips), so the memory used stays
+#   within the combine memory budget.  The model is the coefficient images, one per term.
+#
+#   The model is checked against held-out masters:  each master is compared with the prediction of the
+#   model fitted to all the other masters.  That prediction's error is the full fit's residual divided
+#   by (1 - h), where h is the master's leverage (its diagonal element of the hat matrix), so every
+#   master is checked in one more pass over the files, without fitting the model again for each.
+#
+from typing import Optional
+
+import numpy
+from numpy import ndarray
+
+import MasterMakerExceptions
+from Calibrator import Calibrator
+from Console import Console
+from Constants import Constants
+from DataModel import DataModel
+from FileDescriptor import FileDescriptor
+from ImageMath import ImageMath
+from SessionController import SessionController
+from StreamingMath import StreamingMath
+
+
+class DarkCurrentModel:
+    # Degrees the masters' temperatures must span for the temperature term to be fitted
+    TEMPERATURE_SPREAD_NEEDED = 1.0
+
+    # A master whose leverage is this close to 1 is needed to determine some term, so can't be predicted
+    # from the other masters, and isn't checked against them
+    LEVERAGE_LIMIT = 1.0e-9
+
+    def __init__(self, coefficients: ndarray, exposures: [float], temperatures: [float],
+                 temperature_term: bool):
+        # (terms, rows, columns) coefficients:  offset, rate, and, if fitted, the rate's change with temperature
+        self._coefficients = coefficients
+        self._exposures = exposures
+        self._temperatures = temperatures
+        self._reference_temperature = float(numpy.mean(temperatures))
+        self._temperature_term = temperature_term
+
+    # Exposures and temperatures of the masters fitted, and whether the temperature term was fitted
+
+    def get_exposures(self) -> [float]:
+        return self._exposures
+
+    def get_temperatures(self) -> [float]:
+        return self._temperatures
+
+    def get_temperature_term(self) -> bool:
+        return self._temperature_term
+
+    # The model's terms, for a master of the given exposure and temperature, given the masters' mean temperature
+
+    @classmethod
+    def terms(cls, exposure: float, temperature: float, reference_temperature: float,
+              temperature_term: bool) -> [float]:
+        terms = [1.0, exposure]
+        if temperature_term:
+            terms.append(exposure * (temperature - reference_temperature))
+        return terms
+
+    # The (masters, terms) matrix of the terms of the given masters' exposures and temperatures
+
+    @classmethod
+    def design_matrix(cls, exposures: [float], temperatures: [float], temperature_term: bool) -> ndarray:
+        reference_temperature = float(numpy.mean(temperatures))
+        return numpy.array([cls.terms(exposure, temperature, reference_temperature, temperature_term)
+                            for (exposure, temperature) in zip(exposures, temperatures)])
+
+    # Fit the model to the given master darks, calibrated as set in the data model.  The temperature term
+    # is fitted if the masters' temperatures are spread widely enough and, with it, there are still more
+    # masters than terms, so there is a master to check the model against.
+    #
+    #   Exceptions thrown:
+    #       DarkModelNotFittable    The masters have only one exposure, or there are too few of them
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def fit(cls, masters: [FileDescriptor], data_model: DataModel, calibrator: Calibrator,
+            console: Console, session_controller: SessionController) -> "DarkCurrentModel":
+        exposures = [master.get_exposure() for master in masters]
+        temperatures = [master.get_temperature() for master in masters]
+        if len(set(exposures)) < 2:
+            raise MasterMakerExceptions.DarkModelNotFittable(
+                "The masters must have at least two different exposures, to fit the dark current rate.")
+        temperature_term = max(temperatures) - min(temperatures) >= cls.TEMPERATURE_SPREAD_NEEDED
+        if temperature_term:
+            design = cls.design_matrix(exposures, temperatures, True)
+            if len(masters) <= 3 or numpy.linalg.matrix_rank(design) < 3:
+                console.message("Too few masters at different exposures and temperatures to fit the change of "
+                                "dark current with temperature;  leaving it out", 0)
+                temperature_term = False
+        design = cls.design_matrix(exposures, temperatures, temperature_term)
+        (number_of_masters, number_of_terms) = design.shape
+        if number_of_masters <= number_of_terms:
+            raise MasterMakerExceptions.DarkModelNotFittable(
+                f"At least {number_of_terms + 1} masters are needed, to fit the model and check it against them.")
+        console.message(f"Fitting dark current model to {number_of_masters} masters, "
+                        f"exposed {min(exposures):g} to {max(exposures):g} seconds "
+                        f"at {min(temperatures):g} to {max(temperatures):g} degrees", 0)
+        # The fit is a weighted sum of the masters, so is done in strips as the mean is
+        coefficients = ImageMath.reduce_in_strips([master.get_absolute_path() for master in masters],
+                                                  data_model, calibrator, console, session_controller,
+                                                  cls.fit_tile, Constants.COMBINE_MEAN,
+                                                  (numpy.linalg.pinv(design),), number_of_terms)
+        return DarkCurrentModel(numpy.ascontiguousarray(coefficients.transpose(1, 0, 2)),
+                                exposures, temperatures, temperature_term)
+
+    # Fit the model to one tile, a (masters, rows, columns) array of calibrated data, with the (terms,
+    # masters) weights given as the only parameter:  the (rows, terms, columns) coefficients, each a
+    # weighted sum of the masters.  Called by the tile combiners;  the combine method isn't used.
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def fit_tile(cls, _: int, parameters: tuple, tile: ndarray,
+                 console: Console, session_controller: SessionController) -> ndarray:
+        (weights,) = parameters
+        (number_of_terms, _) = weights.shape
+        (_, rows, columns) = tile.shape
+        coefficients = numpy.zeros((rows, number_of_terms, columns))
+        for (index, master_rows) in enumerate(tile):
+            ImageMath.check_cancellation(session_controller)
+            for term in range(number_of_terms):
+                coefficients[:, term] += weights[term, index] * master_rows
+        return coefficients
+
+    # The master the model gives for the given exposure and temperature, in one evaluation of the model
+    # at every pixel, kept within the range of 16-bit data.  If the temperature term wasn't fitted, the
+    # temperature makes no difference.
+
+    def synthesize(self, exposure: float, temperature: float) -> ndarray:
+        terms = self.terms(exposure, temperature, self._reference_temperature, self._temperature_term)
+        master = numpy.tensordot(terms, self._coefficients, axes=1)
+        return numpy.clip(master, 0.0, 0xFFFF, out=master)
+
+    # Check the model against each of the given masters (those it was fitted to, in the same order) as if it
+    # had been held out of the fit, reading them again, calibrated, a frame at a time.  For each master,
+    # the root-mean-square and the mean absolute difference, in ADU, between the master and the prediction
+    # of the model fitted to the other masters;  or None if the other masters can't predict it.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    def held_out_residuals(self, masters: [FileDescriptor], data_model: DataModel, calibrator: Calibrator,
+                           console: Console,
+                           session_controller: SessionController) -> [Optional[tuple]]:
+        design = self.design_matrix(self._exposures, self._temperatures, self._temperature_term)
+        leverages = numpy.einsum("ij,ji->i", design, numpy.linalg.pinv(design))
+        file_names = [master.get_absolute_path() for master in masters]
+        read_ahead = StreamingMath.open_stream(file_names, ImageMath.working_dtype(data_model), data_model,
+                                               calibrator, console, session_controller)
+        residuals = []
+        for (index, frame) in StreamingMath.calibrated_frames(read_ahead, calibrator, len(file_names), console):
+            if 1.0 - leverages[index] < self.LEVERAGE_LIMIT:
+                residuals.append(None)
+                continue
+            errors = numpy.subtract(frame, numpy.tensordot(design[index], self._coefficients, axes=1))
+            errors /= 1.0 - leverages[index]
+            residuals.append((float(numpy.sqrt(numpy.mean(numpy.square(errors)))),
+                              float(numpy.mean(numpy.abs(errors)))))
+        read_ahead.report(console)
+        return residuals
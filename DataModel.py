@@ -18,7 +18,13 @@ class DataModel:
     def __init__(self, preferences: Preferences):
         self._master_combine_method: int = preferences.get_master_combine_method()
         self._min_max_number_clipped_per_end: int = preferences.get_min_max_number_clipped_per_end()
+        self._min_max_clip_mode: int = preferences.get_min_max_clip_mode()
         self._sigma_clip_threshold: float = preferences.get_sigma_clip_threshold()
+        self._sigma_clip_max_iterations: int = preferences.get_sigma_clip_max_iterations()
+        self._sigma_clip_center: int = preferences.get_sigma_clip_center()
+        self._sigma_clip_scale: int = preferences.get_sigma_clip_scale()
+        self._sigma_clip_low_threshold: float = preferences.get_sigma_clip_low_threshold()
+        self._sigma_clip_high_threshold: float = preferences.get_sigma_clip_high_threshold()
         self._input_file_disposition: int = preferences.get_input_file_disposition()
         self._disposition_subfolder_name: str = preferences.get_disposition_subfolder_name()
         self._precalibration_type: int = preferences.get_precalibration_type()
@@ -35,6 +41,17 @@ class DataModel:
         self._ignore_file_type: bool = False
         self._ignore_groups_fewer_than: bool = preferences.get_ignore_groups_fewer_than()
         self._minimum_group_size: int = preferences.get_minimum_group_size()
+        self._scan_worker_count: int = preferences.get_scan_worker_count()
+        self._use_descriptor_cache: bool = preferences.get_use_descriptor_cache()
+        self._working_precision: int = preferences.get_working_precision()
+        self._read_ahead_megabytes: int = preferences.get_read_ahead_megabytes()
+        self._combine_memory_megabytes: int = preferences.get_combine_memory_megabytes()
+        self._calibration_cache_megabytes: int = preferences.get_calibration_cache_megabytes()
+        self._combine_process_count: int = preferences.get_combine_process_count()
+        self._combine_thread_count: int = preferences.get_combine_thread_count()
+        self._streaming_mode: int = preferences.get_streaming_mode()
+        self._median_mode: int = preferences.get_median_mode()
+        self._descriptor_cache_max_entries: int = preferences.get_descriptor_cache_max_entries()
 
     def get_master_combine_method(self) -> int:
         result = self._master_combine_method
@@ -61,6 +78,18 @@ class DataModel:
         assert value > 0
         self._min_max_number_clipped_per_end = value
 
+    # If the Min-Max method is used, are values equal to a dropped minimum or maximum dropped too
+    # (MINMAX_CLIP_TIES), or exactly the given number of points from each end (MINMAX_CLIP_EXACT)?
+
+    def get_min_max_clip_mode(self) -> int:
+        result = self._min_max_clip_mode
+        assert (result == Constants.MINMAX_CLIP_TIES) or (result == Constants.MINMAX_CLIP_EXACT)
+        return result
+
+    def set_min_max_clip_mode(self, value: int):
+        assert (value == Constants.MINMAX_CLIP_TIES) or (value == Constants.MINMAX_CLIP_EXACT)
+        self._min_max_clip_mode = value
+
     # If Sigma-Clip method is used, what is the threshold sigma score?
     # Data farther than this many sigmas (ratio of value and std deviation of set) from the sample mean
     # are rejected, the the remaining points are mean-combined.  Floating point number > 0.
@@ -74,6 +103,99 @@ class DataModel:
         assert value > 0.0
         self._sigma_clip_threshold = value
 
+    # If Sigma-Clip method is used, how many times at most is the clipping repeated, each time
+    # measuring z-scores against the data kept by the previous one?  1 means a single pass.
+
+    def get_sigma_clip_max_iterations(self) -> int:
+        result = self._sigma_clip_max_iterations
+        assert result > 0
+        return result
+
+    def set_sigma_clip_max_iterations(self, value: int):
+        assert value > 0
+        self._sigma_clip_max_iterations = value
+
+    # If Sigma-Clip method is used, the centre (SIGMA_CENTER_xxx) and spread (SIGMA_SCALE_xxx)
+    # of the data that z-scores are measured with
+
+    def get_sigma_clip_center(self) -> int:
+        result = self._sigma_clip_center
+        assert (result == Constants.SIGMA_CENTER_MEAN) or (result == Constants.SIGMA_CENTER_MEDIAN)
+        return result
+
+    def set_sigma_clip_center(self, value: int):
+        assert (value == Constants.SIGMA_CENTER_MEAN) or (value == Constants.SIGMA_CENTER_MEDIAN)
+        self._sigma_clip_center = value
+
+    def get_sigma_clip_scale(self) -> int:
+        result = self._sigma_clip_scale
+        assert (result == Constants.SIGMA_SCALE_STD) or (result == Constants.SIGMA_SCALE_MAD)
+        return result
+
+    def set_sigma_clip_scale(self, value: int):
+        assert (value == Constants.SIGMA_SCALE_STD) or (value == Constants.SIGMA_SCALE_MAD)
+        self._sigma_clip_scale = value
+
+    # If Sigma-Clip method is used, separate z-score thresholds for data below and above the centre.
+    # 0 means the sigma clip threshold is used for that side.
+
+    def get_sigma_clip_low_threshold(self) -> float:
+        result = self._sigma_clip_low_threshold
+        assert result >= 0.0
+        return result
+
+    def set_sigma_clip_low_threshold(self, value: float):
+        assert value >= 0.0
+        self._sigma_clip_low_threshold = value
+
+    def get_sigma_clip_high_threshold(self) -> float:
+        result = self._sigma_clip_high_threshold
+        assert result >= 0.0
+        return result
+
+    def set_sigma_clip_high_threshold(self, value: float):
+        assert value >= 0.0
+        self._sigma_clip_high_threshold = value
+
+    # The sigma clipping settings in short, for output file names:  the threshold, then the low and high
+    # thresholds (L and H) if they aren't both the threshold, and the iterations (i) and the z-score
+    # statistics if they aren't a single clip against the mean and standard deviation.
+    # For example "2.0", or "2.0-1.5L3.0H-5i-Median-MAD"
+
+    def get_sigma_clip_name(self) -> str:
+        threshold = self.get_sigma_clip_threshold()
+        low_threshold = self.get_sigma_clip_low_threshold() or threshold
+        high_threshold = self.get_sigma_clip_high_threshold() or threshold
+        name = f"{threshold}"
+        if (low_threshold, high_threshold) != (threshold, threshold):
+            name += f"-{low_threshold}L{high_threshold}H"
+        if not self.sigma_clip_single_mean_pass():
+            name += f"-{self.get_sigma_clip_max_iterations()}i" \
+                    f"-{Constants.sigma_center_string(self.get_sigma_clip_center())}" \
+                    f"-{Constants.sigma_scale_string(self.get_sigma_clip_scale())}"
+        return name
+
+    # The sigma clipping settings in words, for the output file's comment.  For example "threshold 2.0",
+    # or "threshold 1.5 low, 3.0 high, up to 5 iterations, z-scores from median and MAD"
+
+    def get_sigma_clip_description(self) -> str:
+        threshold = self.get_sigma_clip_threshold()
+        low_threshold = self.get_sigma_clip_low_threshold() or threshold
+        high_threshold = self.get_sigma_clip_high_threshold() or threshold
+        description = f"threshold {threshold}" if low_threshold == high_threshold == threshold \
+            else f"threshold {low_threshold} low, {high_threshold} high"
+        if not self.sigma_clip_single_mean_pass():
+            description += f", up to {self.get_sigma_clip_max_iterations()} iterations, z-scores from " \
+                           f"{Constants.sigma_center_string(self.get_sigma_clip_center()).lower()} and " \
+                           f"{Constants.sigma_scale_string(self.get_sigma_clip_scale())}"
+        return description
+
+    # Is sigma clipping the original single clip, measuring z-scores against the mean and standard deviation?
+
+    def sigma_clip_single_mean_pass(self) -> bool:
+        return (self.get_sigma_clip_max_iterations(), self.get_sigma_clip_center(), self.get_sigma_clip_scale()) \
+            == (1, Constants.SIGMA_CENTER_MEAN, Constants.SIGMA_SCALE_STD)
+
     # What to do with input files after a successful combine
 
     def get_input_file_disposition(self):
@@ -208,3 +330,131 @@ class DataModel:
 
     def set_minimum_group_size(self, minimum: int):
         self._minimum_group_size = minimum
+
+    # How many files have their headers read at once when building the file list?
+
+    def get_scan_worker_count(self) -> int:
+        result = self._scan_worker_count
+        assert result > 0
+        return result
+
+    def set_scan_worker_count(self, value: int):
+        assert value > 0
+        self._scan_worker_count = value
+
+    # Keep a persistent cache of file header information?  How many files can it hold?
+
+    def get_use_descriptor_cache(self) -> bool:
+        return self._use_descriptor_cache
+
+    def set_use_descriptor_cache(self, use_cache: bool):
+        self._use_descriptor_cache = use_cache
+
+    def get_descriptor_cache_max_entries(self) -> int:
+        result = self._descriptor_cache_max_entries
+        assert result > 0
+        return result
+
+    def set_descriptor_cache_max_entries(self, value: int):
+        assert value > 0
+        self._descriptor_cache_max_entries = value
+
+    # Floating point precision of the image data while it is being calibrated and combined
+
+    def get_working_precision(self) -> int:
+        result = self._working_precision
+        assert (result == Constants.PRECISION_DOUBLE) or (result == Constants.PRECISION_SINGLE)
+        return result
+
+    def set_working_precision(self, value: int):
+        assert (value == Constants.PRECISION_DOUBLE) or (value == Constants.PRECISION_SINGLE)
+        self._working_precision = value
+
+    # Memory, in megabytes, for frames read in the background ahead of the calibration and combining
+
+    def get_read_ahead_megabytes(self) -> int:
+        result = self._read_ahead_megabytes
+        assert result > 0
+        return result
+
+    def set_read_ahead_megabytes(self, value: int):
+        assert value > 0
+        self._read_ahead_megabytes = value
+
+    # Memory, in megabytes, the combining may use.  Stacks needing more are combined a strip of rows at a time.
+
+    def get_combine_memory_megabytes(self) -> int:
+        result = self._combine_memory_megabytes
+        assert result > 0
+        return result
+
+    def set_combine_memory_megabytes(self, value: int):
+        assert value > 0
+        self._combine_memory_megabytes = value
+
+    # Memory, in megabytes, for calibration images kept, once read, for later groups in the session.
+    # Zero keeps none.
+
+    def get_calibration_cache_megabytes(self) -> int:
+        result = self._calibration_cache_megabytes
+        assert result >= 0
+        return result
+
+    def set_calibration_cache_megabytes(self, value: int):
+        assert value >= 0
+        self._calibration_cache_megabytes = value
+
+    # Number of processes that combine the image data at once, each taking a share of the rows
+
+    def get_combine_process_count(self) -> int:
+        result = self._combine_process_count
+        assert result > 0
+        return result
+
+    def set_combine_process_count(self, value: int):
+        assert value > 0
+        self._combine_process_count = value
+
+    # Number of threads that combine the image data at once, each taking a share of the rows.
+    # Used only when combining with a single process.
+
+    def get_combine_thread_count(self) -> int:
+        result = self._combine_thread_count
+        assert result > 0
+        return result
+
+    def set_combine_thread_count(self, value: int):
+        assert value > 0
+        self._combine_thread_count = value
+
+    # Whether the frames are combined by streaming them one at a time, for the combine methods that can be:
+    # always, never, or automatically when the stack is too big for the combine memory
+
+    def get_streaming_mode(self) -> int:
+        result = self._streaming_mode
+        assert result in (Constants.STREAMING_AUTO, Constants.STREAMING_ALWAYS, Constants.STREAMING_NEVER)
+        return result
+
+    def set_streaming_mode(self, value: int):
+        assert value in (Constants.STREAMING_AUTO, Constants.STREAMING_ALWAYS, Constants.STREAMING_NEVER)
+        self._streaming_mode = value
+
+    # Whether the median combine is exact, or approximated from histograms of the frames, streamed
+
+    def get_median_mode(self) -> int:
+        result = self._median_mode
+        assert result in (Constants.MEDIAN_EXACT, Constants.MEDIAN_APPROXIMATE)
+        return result
+
+    def set_median_mode(self, value: int):
+        assert value in (Constants.MEDIAN_EXACT, Constants.MEDIAN_APPROXIMATE)
+        self._median_mode = value
+
+    # Should a combine method that can stream do so, given the memory, in bytes, combining the whole
+    # stack would need?
+
+    def use_streaming(self, stack_bytes: float) -> bool:
+        streaming_mode = self.get_streaming_mode()
+        if streaming_mode == Constants.STREAMING_AUTO:
+            return stack_bytes > self.get_combine_memory_megabytes() * 1024 * 1024
+        return streaming_mode == Constants.STREAMING_ALWAYS
@@ -0,0 +1,152 @@
+#
+#   Persistent cache of the header information that describes each FITS file (the values returned
+#   by RmFitsUtil.categorize_file), so files that have been seen before don't have their headers
+#   read again on every run.
+#
+#   The cache is an SQLite database in the user's cache directory.  An entry is used only if the
+#   file's size and modification time are still what they were when the entry was made;  otherwise
+#   the file is read again and the entry replaced.  The number of entries is capped, and when the
+#   cap is exceeded the least recently used entries are removed.
+#
+#   Lookups and stores are done in batches, one transaction per batch, since committing an SQLite
+#   transaction is far slower than reading a header.  One connection is shared by all threads,
+#   serialized with a lock.
+#
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from MultiOsUtil import MultiOsUtil
+
+
+class DescriptorCache:
+    FILE_NAME = "file-descriptors.sqlite"
+    DEFAULT_MAX_ENTRIES = 250000
+
+    # Increase this whenever the stored values, or the way they are derived from the header, change.
+    # A cache made by a different version is discarded.
+    SCHEMA_VERSION = 2
+
+    def __init__(self, database_path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        assert max_entries > 0
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path, timeout=10.0, check_same_thread=False)
+        self.create_schema()
+
+    # Open the cache in its usual location.  If that isn't possible (for example, the cache
+    # directory can't be written) return None, and the program simply runs without a cache.
+
+    @classmethod
+    def open_default(cls, max_entries: int = DEFAULT_MAX_ENTRIES) -> Optional["DescriptorCache"]:
+        try:
+            return DescriptorCache(os.path.join(MultiOsUtil.user_cache_directory(), cls.FILE_NAME), max_entries)
+        except (OSError, sqlite3.Error) as exception:
+            print(f"File header cache not available: {exception}")
+            return None
+
+    # Value columns are deliberately declared without a type, so SQLite keeps each value in the
+    # form it was given - an integer exposure stays an integer, a real stays a real.
+
+    def create_schema(self):
+        with self._lock:
+            version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                self._connection.execute("DROP TABLE IF EXISTS descriptors")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS descriptors ("
+                                     "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                                     "type_code, x_size, y_size, x_binning, y_binning, "
+                                     "filter_name, exposure, temperature, "
+                                     "last_used REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS descriptors_by_last_used "
+                                     "ON descriptors (last_used)")
+            self._connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._connection.commit()
+
+    # Key of a file in the cache:  absolute path, size, and modification time.
+    # Returns None if the file can't be examined (it will be reported when it is read).
+
+    @classmethod
+    def file_key(cls, file_name: str) -> Optional[tuple]:
+        try:
+            status = os.stat(file_name)
+        except OSError:
+            return None
+        return os.path.abspath(file_name), status.st_size, status.st_mtime_ns
+
+    # Look up the given files.  Return a dictionary, from file name (as given) to the cached
+    # categorize_file values, of those files that have current entries.
+
+    def lookup_many(self, file_names: [str]) -> {str: tuple}:
+        result: {str: tuple} = {}
+        now = time.time()
+        with self._lock:
+            for file_name in file_names:
+                key = self.file_key(file_name)
+                if key is None:
+                    continue
+                (path, size, mtime_ns) = key
+                row = self._connection.execute("SELECT type_code, x_size, y_size, x_binning, y_binning, "
+                                               "filter_name, exposure, temperature FROM descriptors "
+                                               "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                               (path, size, mtime_ns)).fetchone()
+                if row is not None:
+                    result[file_name] = tuple(row)
+            # Record the use, for least-recently-used eviction
+            self._connection.executemany("UPDATE descriptors SET last_used = ? WHERE path = ?",
+                                         [(now, os.path.abspath(name)) for name in result])
+            self._connection.commit()
+        return result
+
+    def lookup(self, file_name: str) -> Optional[tuple]:
+        return self.lookup_many([file_name]).get(file_name)
+
+    # Store the categorize_file values for the given files:  a list of (file name, values).
+    # Any existing (out of date) entries for the same paths are replaced.
+
+    def store_many(self, entries: [(str, tuple)]):
+        now = time.time()
+        rows = []
+        for (file_name, values) in entries:
+            key = self.file_key(file_name)
+            if key is not None:
+                rows.append(key + tuple(values) + (now,))
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO descriptors VALUES "
+                                         "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.evict_excess_entries()
+            self._connection.commit()
+
+    def store(self, file_name: str, values: tuple):
+        self.store_many([(file_name, values)])
+
+    # Remove the least recently used entries until the cache is within its size limit.
+    # Called with the lock held, inside the caller's transaction.
+
+    def evict_excess_entries(self):
+        count = self._connection.execute("SELECT COUNT(*) FROM descriptors").fetchone()[0]
+        excess = count - self._max_entries
+        if excess > 0:
+            self._connection.execute("DELETE FROM descriptors WHERE path IN "
+                                     "(SELECT path FROM descriptors ORDER BY last_used LIMIT ?)", (excess,))
+
+    # Forget the given files, or everything if none are given
+
+    def invalidate(self, file_names: Optional[list] = None):
+        with self._lock:
+            if file_names is None:
+                self._connection.execute("DELETE FROM descriptors")
+            else:
+                self._connection.executemany("DELETE FROM descriptors WHERE path = ?",
+                                             [(os.path.abspath(name),) for name in file_names])
+            self._connection.commit()
+
+    def get_entry_count(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM descriptors").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
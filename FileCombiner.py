@@ -1,15 +1,20 @@
 #
 #   Object for combining FITS files using different algorithms
 #
+import math
+import os
 from itertools import groupby
 from typing import Callable
 
 import numpy
 import mean_shift as ms
 import MasterMakerExceptions
+from CalibrationImageCache import CalibrationImageCache
+from CalibrationIndex import CalibrationIndex
 from Calibrator import Calibrator
 from Console import Console
 from Constants import Constants
+from DarkCurrentModel import DarkCurrentModel
 from DataModel import DataModel
 from FileDescriptor import FileDescriptor
 from ImageMath import ImageMath
@@ -24,6 +29,10 @@ class FileCombiner:
                  file_moved_callback: Callable[[str], None]):
         self.callback_method = file_moved_callback
         self._session_controller = session_controller
+        # A combiner is made for each session;  calibration directories are indexed afresh in each,
+        # and calibration images are kept, and their use counted, for one session only
+        CalibrationIndex.forget_all()
+        CalibrationImageCache.clear()
 
     # Process one set of files.  Output to the given path, if provided.  If not provided, prompt the user for it.
     
@@ -167,7 +176,7 @@ class FileCombiner:
 
         # Make up a file name for this group's output, into the given directory
         file_name = SharedUtils.get_file_name_portion(combine_method, sample_file,
-                                                      data_model.get_sigma_clip_threshold(),
+                                                      data_model.get_sigma_clip_name(),
                                                       data_model.get_min_max_number_clipped_per_end())
         output_file = f"{output_directory}/{file_name}"
 
@@ -195,6 +204,81 @@ class FileCombiner:
             raise MasterMakerExceptions.IncompatibleSizes
         console.pop_level()
 
+    # Fit a dark current model (see DarkCurrentModel) to the given master darks, check it against each master
+    # held out of the fit, and output a master for the given exposure and temperature, synthesized from the
+    # model, to the given path.  The masters are calibrated as set in the data model;  they are not moved.
+    #
+    #   Exceptions thrown:
+    #       NotAllDarkFrames        The given files are not all dark frames
+    #       IncompatibleSizes       The given files are not all the same dimensions
+    #       DarkModelNotFittable    The masters have only one exposure, or there are too few of them
+
+    def synthesize_master(self, masters: [FileDescriptor],
+                          data_model: DataModel,
+                          exposure: float,
+                          temperature: float,
+                          output_path: str,
+                          console: Console):
+        console.push_level()
+        console.message(f"Synthesizing master for {exposure:g} seconds at {temperature:g} degrees "
+                        f"from {len(masters)} masters", +1)
+        assert len(masters) > 0
+        if not FileCombiner.all_compatible_sizes(masters):
+            raise MasterMakerExceptions.IncompatibleSizes
+        if not data_model.get_ignore_file_type() \
+                and not FileCombiner.all_of_type(masters, FileDescriptor.FILE_TYPE_DARK):
+            raise MasterMakerExceptions.NotAllDarkFrames
+        calibrator = Calibrator(data_model)
+        model = DarkCurrentModel.fit(masters, data_model, calibrator, console, self._session_controller)
+        self.check_cancellation()
+
+        # Check the model against the masters, before relying on it
+        console.message("Residuals predicting each master from the others", +1)
+        residuals = model.held_out_residuals(masters, data_model, calibrator, console, self._session_controller)
+        for (master, residual) in zip(masters, residuals):
+            description = f"{os.path.basename(master.get_absolute_path())} " \
+                          f"({master.get_exposure():g} s, {master.get_temperature():g} C)"
+            if residual is None:
+                console.message(f"{description}: can't be predicted without it", 0)
+            else:
+                (rms_residual, mean_absolute_residual) = residual
+                console.message(f"{description}: RMS {rms_residual:.2f} ADU, "
+                                f"mean absolute {mean_absolute_residual:.2f} ADU", 0)
+        checked = [rms_residual for (rms_residual, _) in filter(None, residuals)]
+        if len(checked) > 0:
+            overall = math.sqrt(sum(rms_residual ** 2 for rms_residual in checked) / len(checked))
+            console.message(f"Held-out RMS residual of {len(checked)} masters: {overall:.2f} ADU", -1)
+        else:
+            console.message("No master can be predicted from the others", -1)
+
+        # Say if the model is being used outside the library it was fitted to
+        exposures = model.get_exposures()
+        temperatures = model.get_temperatures()
+        if not min(exposures) <= exposure <= max(exposures):
+            console.message(f"Exposure {exposure:g} is outside the masters' {min(exposures):g} to "
+                            f"{max(exposures):g} seconds;  the model is extrapolated", 0)
+        if not model.get_temperature_term():
+            if abs(temperature - numpy.mean(temperatures)) >= DarkCurrentModel.TEMPERATURE_SPREAD_NEEDED:
+                console.message(f"Temperature {temperature:g} differs from the masters', but no temperature "
+                                f"term was fitted, so is ignored", 0)
+        elif not min(temperatures) <= temperature <= max(temperatures):
+            console.message(f"Temperature {temperature:g} is outside the masters' {min(temperatures):g} to "
+                            f"{max(temperatures):g} degrees;  the model is extrapolated", 0)
+
+        synthesized = model.synthesize(exposure, temperature)
+        self.check_cancellation()
+        RmFitsUtil.create_combined_fits_file(SharedUtils.substitute_date_time_filter_in_string(output_path),
+                                             synthesized,
+                                             FileDescriptor.FILE_TYPE_DARK,
+                                             "Dark Frame",
+                                             exposure, temperature,
+                                             SharedUtils.most_common_filter_name(masters),
+                                             masters[0].get_binning(),
+                                             f"Master Dark synthesized from dark current model of "
+                                             f"{len(masters)} masters {calibrator.fits_comment_tag()}")
+        console.message("Synthesis complete", 0)
+        console.pop_level()
+
     # Move the given files if the given disposition type requests it.
     # Return a list of any files that were moved so the UI can be adjusted if necessary
     
@@ -418,7 +502,8 @@ class FileCombiner:
         binning: int = input_files[0].get_binning()
         (mean_exposure, mean_temperature) = ImageMath.mean_exposure_and_temperature(input_files)
         if combine_method == Constants.COMBINE_MEAN:
-            mean_data = ImageMath.combine_mean(file_names, calibrator, console, self._session_controller)
+            mean_data = ImageMath.combine_mean(file_names, data_model, calibrator, console,
+                                               self._session_controller)
             self.check_cancellation()
             RmFitsUtil.create_combined_fits_file(substituted_file_name, mean_data,
                                                  FileDescriptor.FILE_TYPE_DARK,
@@ -426,7 +511,8 @@ class FileCombiner:
                                                  mean_exposure, mean_temperature, filter_name, binning,
                                                  f"Master Dark MEAN combined {calibration_tag}")
         elif combine_method == Constants.COMBINE_MEDIAN:
-            median_data = ImageMath.combine_median(file_names, calibrator, console, self._session_controller)
+            median_data = ImageMath.combine_median(file_names, data_model, calibrator, console,
+                                                   self._session_controller)
             self.check_cancellation()
             RmFitsUtil.create_combined_fits_file(substituted_file_name, median_data,
                                                  FileDescriptor.FILE_TYPE_DARK,
@@ -435,7 +521,7 @@ class FileCombiner:
                                                  f"Master Dark MEDIAN combined {calibration_tag}")
         elif combine_method == Constants.COMBINE_MINMAX:
             number_dropped_points = data_model.get_min_max_number_clipped_per_end()
-            min_max_clipped_mean = ImageMath.combine_min_max_clip(file_names, number_dropped_points,
+            min_max_clipped_mean = ImageMath.combine_min_max_clip(file_names, number_dropped_points, data_model,
                                                                   calibrator, console,
                                                                   self._session_controller)
             self.check_cancellation()
@@ -450,7 +536,7 @@ class FileCombiner:
         else:
             assert combine_method == Constants.COMBINE_SIGMA_CLIP
             sigma_threshold = data_model.get_sigma_clip_threshold()
-            sigma_clipped_mean = ImageMath.combine_sigma_clip(file_names, sigma_threshold,
+            sigma_clipped_mean = ImageMath.combine_sigma_clip(file_names, sigma_threshold, data_model,
                                                               calibrator, console, self._session_controller)
             self.check_cancellation()
             assert sigma_clipped_mean is not None
@@ -459,7 +545,7 @@ class FileCombiner:
                                                  "Dark Frame",
                                                  mean_exposure, mean_temperature, filter_name, binning,
                                                  f"Master Dark Sigma Clipped "
-                                                 f"(threshold {sigma_threshold}) Mean combined"
+                                                 f"({data_model.get_sigma_clip_description()}) Mean combined"
                                                  f" {calibration_tag}")
         console.pop_level()
 
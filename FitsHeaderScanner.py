@@ -0,0 +1,100 @@
+#
+#   Fast reader for a handful of keywords in the primary header of a FITS file.
+#
+#   Building a full astropy Header parses and validates every card in the file, which is most of
+#   the cost of scanning a large library of files when we only want ten or so keywords.
+#   This reader reads the header's 2880-byte blocks directly, picks out just the cards it was
+#   asked for, and stops at the END card.  Values are converted the way astropy converts them
+#   (integers to int, reals to float, logicals to bool, strings without trailing blanks), so
+#   code written against an astropy Header can use the result unchanged.
+#
+import re
+
+
+class FitsHeaderScanner:
+    BLOCK_SIZE = 2880
+    CARD_SIZE = 80
+    KEYWORD_SIZE = 8
+    VALUE_INDICATOR = b"= "
+
+    # Keywords needed to describe a file (see RmFitsUtil.categorize_file) and to map its pixels
+    DESCRIPTOR_KEYWORDS = ("PICTTYPE", "IMAGETYP", "XBINNING", "YBINNING", "FILTER",
+                           "NAXIS", "NAXIS1", "NAXIS2", "EXPOSURE", "EXPTIME", "CCD-TEMP")
+    IMAGE_MAP_KEYWORDS = ("NAXIS", "NAXIS1", "NAXIS2", "BITPIX", "BZERO", "BSCALE")
+
+    _integer_pattern = re.compile(r"[+-]?\d+")
+
+    # Read the primary header of the given file, returning a dictionary of the values of those
+    # of the given keywords that are present, and the byte offset in the file where the data
+    # following the header begins.
+    #
+    #   Exceptions thrown:
+    #       FileNotFoundError       No such file
+    #       OSError                 The file is not a FITS file, or its header has no END card
+
+    @classmethod
+    def scan(cls, file_name: str, keywords: [str]) -> ({str: object}, int):
+        wanted = set(k.upper().encode("ascii") for k in keywords)
+        values: {str: object} = {}
+        blocks_read = 0
+        with open(file_name, "rb") as file:
+            while True:
+                block = file.read(cls.BLOCK_SIZE)
+                if len(block) < cls.BLOCK_SIZE:
+                    raise OSError(f"FITS header in \"{file_name}\" has no END card")
+                if blocks_read == 0 and not block.startswith(b"SIMPLE  ="):
+                    raise OSError(f"\"{file_name}\" is not a FITS file")
+                blocks_read += 1
+                for card_start in range(0, cls.BLOCK_SIZE, cls.CARD_SIZE):
+                    keyword = block[card_start:card_start + cls.KEYWORD_SIZE].rstrip()
+                    if keyword == b"END":
+                        return values, blocks_read * cls.BLOCK_SIZE
+                    if keyword in wanted \
+                            and block[card_start + cls.KEYWORD_SIZE:card_start + 10] == cls.VALUE_INDICATOR:
+                        value_field = block[card_start + 10:card_start + cls.CARD_SIZE].decode("ascii", "replace")
+                        value = cls.parse_value(value_field)
+                        # As with astropy, the first occurrence of a repeated keyword wins
+                        if value is not None and keyword.decode("ascii") not in values:
+                            values[keyword.decode("ascii")] = value
+
+    # Convert the value field of a card (the part after "= ") to a python value.
+    # Returns None for an empty (undefined) value or one we don't understand, such as a complex number
+
+    @classmethod
+    def parse_value(cls, value_field: str):
+        stripped = value_field.lstrip()
+        if stripped.startswith("'"):
+            # Character string.  Embedded quotes are doubled;  trailing blanks are not significant
+            characters = []
+            index = 1
+            while index < len(stripped):
+                if stripped[index] == "'":
+                    if index + 1 < len(stripped) and stripped[index + 1] == "'":
+                        characters.append("'")
+                        index += 2
+                        continue
+                    break
+                characters.append(stripped[index])
+                index += 1
+            return "".join(characters).rstrip()
+        # Anything else ends at the comment, if there is one
+        token = stripped.split("/", 1)[0].strip()
+        if token == "T":
+            return True
+        elif token == "F":
+            return False
+        elif cls._integer_pattern.fullmatch(token):
+            return int(token)
+        else:
+            try:
+                # FITS allows "D" as the exponent marker of a double-precision value
+                return float(token.replace("D", "E").replace("d", "e"))
+            except ValueError:
+                return None
+
+    # Read just the keywords needed to build a FileDescriptor
+
+    @classmethod
+    def scan_for_descriptor(cls, file_name: str) -> {str: object}:
+        (values, _) = cls.scan(file_name, cls.DESCRIPTOR_KEYWORDS)
+        return values
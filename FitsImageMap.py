@@ -0,0 +1,109 @@
+#
+#   Read-only, memory-mapped view of the pixel data in the primary HDU of a FITS file.
+#
+#   The pixels are left on disk, in the file's own encoding, and only the rows that are asked for
+#   are converted to a working data type.  Because the operating system pages the file in on demand
+#   and shares those pages between everyone who maps the file, re-reading the same file (such as a
+#   bias frame used for several groups) is served from the page cache rather than from disk.
+#
+#   FITS stores unsigned 16-bit camera data as signed 16-bit integers with BZERO = 32768.
+#   That case is recognized, and the "native" type of such a file is uint16 rather than the
+#   float that a general BZERO/BSCALE scaling would need.
+#
+from typing import Optional
+
+import numpy
+from numpy import ndarray
+
+
+class FitsImageMap:
+    # Raw on-disk data types for each FITS BITPIX value.  FITS data is always big-endian.
+    RAW_DATA_TYPES = {8: "u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+    def __init__(self, file_name: str, data_offset: int,
+                 x_size: int, y_size: int,
+                 bitpix: int, bzero: float = 0, bscale: float = 1):
+        assert bitpix in self.RAW_DATA_TYPES
+        self._file_name = file_name
+        self._bzero = bzero
+        self._bscale = bscale
+        self._unsigned_16 = self.is_unsigned_16(bitpix, bzero, bscale)
+        # numpy.memmap in mode "r" gives a read-only array; nothing we do can write to the file
+        self._raw: Optional[ndarray] = numpy.memmap(file_name, dtype=self.RAW_DATA_TYPES[bitpix], mode="r",
+                                                    offset=data_offset, shape=(y_size, x_size))
+        self._native_dtype = self.native_type_for(bitpix, bzero, bscale, self._unsigned_16)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Is data with the given BITPIX, BZERO and BSCALE unsigned 16-bit data?
+
+    @classmethod
+    def is_unsigned_16(cls, bitpix: int, bzero: float, bscale: float) -> bool:
+        return bitpix == 16 and bzero == 32768 and bscale == 1
+
+    # Determine the smallest data type that holds the scaled (physical) pixel values exactly
+
+    @classmethod
+    def native_type_for(cls, bitpix: int, bzero: float, bscale: float, unsigned_16: bool) -> numpy.dtype:
+        if unsigned_16:
+            return numpy.dtype(numpy.uint16)
+        elif bzero == 0 and bscale == 1:
+            return numpy.dtype(cls.RAW_DATA_TYPES[bitpix]).newbyteorder("=")
+        else:
+            return numpy.dtype(float)
+
+    def get_file_name(self) -> str:
+        return self._file_name
+
+    def get_native_dtype(self) -> numpy.dtype:
+        return self._native_dtype
+
+    # Shape of the image, as numpy sees it:  (rows, columns), i.e. (NAXIS2, NAXIS1)
+
+    def get_shape(self) -> (int, int):
+        assert self._raw is not None
+        return self._raw.shape
+
+    # The mapped pixels, unscaled and in the file's byte order.  Read-only, and no copy is made.
+
+    def get_raw_data(self) -> ndarray:
+        assert self._raw is not None
+        return self._raw
+
+    # Convert the given rows (start inclusive, end exclusive) to the given data type, or the
+    # file's native type if none is given.  If an output array is given, the converted data
+    # goes straight into it rather than into a new array.
+
+    def read_rows(self, start_row: int, end_row: int,
+                  dtype=None, out: Optional[ndarray] = None) -> ndarray:
+        assert self._raw is not None
+        raw = self._raw[start_row:end_row]
+        if out is None:
+            out = numpy.empty(raw.shape, dtype=self._native_dtype if dtype is None else dtype)
+        assert out.shape == raw.shape
+        if self._unsigned_16 and out.dtype == numpy.uint16:
+            # Adding 32768 to a signed 16-bit value is the same as flipping its sign bit
+            numpy.bitwise_xor(raw.view(">u2"), 0x8000, out=out)
+        else:
+            numpy.copyto(out, raw, casting="unsafe")
+            if self._bscale != 1:
+                numpy.multiply(out, self._bscale, out=out, casting="unsafe")
+            if self._bzero != 0:
+                numpy.add(out, self._bzero, out=out, casting="unsafe")
+        return out
+
+    # Convert the whole image
+
+    def read_frame(self, dtype=None, out: Optional[ndarray] = None) -> ndarray:
+        (rows, _) = self.get_shape()
+        return self.read_rows(0, rows, dtype, out)
+
+    # Release the mapping.  Any arrays already returned by read_rows are independent copies
+    # and remain valid;  the array from get_raw_data should no longer be used.
+
+    def close(self):
+        self._raw = None
@@ -0,0 +1,151 @@
+#
+#   Reads the frames of a set of files in a background thread, ahead of the code that uses them,
+#   so the disk is busy reading the next frames while the current one is being calibrated and
+#   combined, rather than each waiting for the other.  Either whole frames, or the same range of
+#   rows from every frame, can be read.
+#
+#   The reader runs ahead by as many frames as fit in a given memory budget, then waits for the
+#   consumer to catch up.  The time the consumer spends waiting for frames to be read, and the
+#   time the reader spends waiting for the consumer, are recorded;  the first is time lost to
+#   input, the second time lost to computation.
+#
+import queue
+import threading
+import time
+from typing import Optional, Iterator
+
+import numpy
+from numpy import ndarray
+
+import MasterMakerExceptions
+from Console import Console
+from RmFitsUtil import RmFitsUtil
+from SessionController import SessionController
+
+
+class FrameReadAhead:
+    # How long either thread blocks on the queue before checking for cancellation
+    POLL_INTERVAL = 0.1
+
+    #
+    #   Set up to read the given files, all the same size, converted to the given data type.
+    #   Only the headers are read here.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files are not all the same dimensions
+    #
+    def __init__(self, file_names: [str], dtype, memory_budget: int,
+                 session_controller: Optional[SessionController] = None):
+        assert len(file_names) > 0
+        self._file_names = file_names
+        self._dtype = numpy.dtype(dtype)
+        self._session_controller = session_controller
+        self._memory_budget = memory_budget
+        (self._layouts, self._frame_shape) = RmFitsUtil.scan_stack_layouts(file_names)
+        self._input_wait_seconds = 0.0
+        self._compute_wait_seconds = 0.0
+
+    def get_frame_shape(self) -> (int, int):
+        return self._frame_shape
+
+    # The data type the frames are read as, which can be changed before they are read
+    def get_dtype(self) -> numpy.dtype:
+        return self._dtype
+
+    def set_dtype(self, dtype):
+        self._dtype = numpy.dtype(dtype)
+
+    # The data type the files' pixels all have natively (see FitsImageMap), or None if they differ
+    def get_native_dtype(self) -> Optional[numpy.dtype]:
+        native_dtypes = set(RmFitsUtil.native_dtype_from_header(header) for (header, _) in self._layouts)
+        return native_dtypes.pop() if len(native_dtypes) == 1 else None
+
+    # How many frames, each of the given number of rows, fit in the memory budget
+    def get_read_ahead_frames(self, rows: int) -> int:
+        (_, columns) = self._frame_shape
+        return max(1, self._memory_budget // (rows * columns * self._dtype.itemsize))
+
+    # Time the consumer of the frames spent waiting for them to be read
+    def get_input_wait_seconds(self) -> float:
+        return self._input_wait_seconds
+
+    # Time the reader spent waiting because it was as far ahead of the consumer as allowed
+    def get_compute_wait_seconds(self) -> float:
+        return self._compute_wait_seconds
+
+    # Read the given rows (first inclusive, end exclusive;  by default, all of them) of the frames,
+    # yielding (index, frame rows) for each file in order.  If an output array of (files, rows, columns)
+    # is given, each frame's rows are read directly into its slice of it, and the array yielded is
+    # that slice;  otherwise each is a new array.
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session controller was cancelled
+    #       (and any raised reading a file, re-raised in the consumer's thread)
+
+    def frames(self, first_row: int = 0, end_row: Optional[int] = None,
+               out: Optional[ndarray] = None) -> Iterator[tuple]:
+        (rows, columns) = self._frame_shape
+        end_row = rows if end_row is None else end_row
+        assert 0 <= first_row < end_row <= rows
+        if out is not None:
+            assert out.shape == (len(self._file_names), end_row - first_row, columns)
+        frame_queue = queue.Queue(maxsize=self.get_read_ahead_frames(end_row - first_row))
+        stop = threading.Event()
+        reader = threading.Thread(target=self.read_frames, args=(frame_queue, stop, first_row, end_row, out),
+                                  daemon=True)
+        reader.start()
+        try:
+            for _ in range(len(self._file_names)):
+                wait_start = time.perf_counter()
+                item = None
+                while item is None:
+                    self.check_cancellation()
+                    try:
+                        item = frame_queue.get(timeout=self.POLL_INTERVAL)
+                    except queue.Empty:
+                        pass
+                self._input_wait_seconds += time.perf_counter() - wait_start
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Also reached if the consumer stops early, or raises an exception
+            stop.set()
+            reader.join()
+
+    # Body of the reader thread.  An exception reading a file is passed through the queue,
+    # to be raised in the consumer's thread, and ends the reading.
+
+    def read_frames(self, frame_queue: queue.Queue, stop: threading.Event,
+                    first_row: int, end_row: int, out: Optional[ndarray]):
+        try:
+            for (index, name) in enumerate(self._file_names):
+                if stop.is_set():
+                    return
+                (header, data_offset) = self._layouts[index]
+                with RmFitsUtil.image_map_from_header(name, header, data_offset) as image:
+                    frame = image.read_rows(first_row, end_row, self._dtype, None if out is None else out[index])
+                self.put_when_room(frame_queue, stop, (index, frame))
+        except Exception as exception:
+            self.put_when_room(frame_queue, stop, exception)
+
+    def put_when_room(self, frame_queue: queue.Queue, stop: threading.Event, item):
+        wait_start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=self.POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        self._compute_wait_seconds += time.perf_counter() - wait_start
+
+    def check_cancellation(self):
+        if self._session_controller is not None and self._session_controller.thread_cancelled():
+            raise MasterMakerExceptions.SessionCancelled
+
+    # Report where the time went, once the frames have been read
+
+    def report(self, console: Console):
+        console.message(f"Read {len(self._file_names)} files: "
+                        f"{self._input_wait_seconds:.2f} s waiting for input, "
+                        f"{self._compute_wait_seconds:.2f} s of reading held up by processing", 0)
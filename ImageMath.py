@@ -2,28 +2,260 @@
 #   Class to do the math on FITS images to combine them in various ways
 #
 import sys
-from typing import Optional
+from typing import Optional, Callable
 
 import numpy
-from numpy import ma
 from numpy.core.multiarray import ndarray
 
 import MasterMakerExceptions
 from Calibrator import Calibrator
 from Console import Console
+from Constants import Constants
+from DataModel import DataModel
 from FileDescriptor import FileDescriptor
+from FrameReadAhead import FrameReadAhead
+from ParallelCombiner import ParallelCombiner
 from RmFitsUtil import RmFitsUtil
 from SessionController import SessionController
+from StreamingMath import StreamingMath
+from ThreadedCombiner import ThreadedCombiner
 
 
 class ImageMath:
 
+    # Approximate memory each combine method needs, as a multiple of the stack of data it is given,
+    # counting the temporary arrays numpy makes along the way.  Used to size strips; see combine_in_strips.
+    WORKING_COPIES = {
+        Constants.COMBINE_MEAN: 1.0,
+        Constants.COMBINE_MEDIAN: 1.0,
+        Constants.COMBINE_MINMAX: 2.0,
+        Constants.COMBINE_SIGMA_CLIP: 1.5,
+    }
+
+    # Number of values per frame sigma_clip_stack works on at once:  small enough that its frame-sized
+    # working arrays stay in the processor's cache, large enough that the overhead of each numpy call is small
+    SIGMA_CLIP_BLOCK_SIZE = 16384
+
+    # Number of values, over all the frames, median_stack and sort_stack sort at once:  their 16-bit copies
+    # of them stay in the processor's larger caches
+    MEDIAN_BLOCK_VALUES = 1024 * 1024
+
+    # Stacks of up to this many files have their medians found, or are sorted for min-max clipping, by
+    # sorting networks rather than by numpy's sort, which is as fast or faster for deeper stacks (see the
+    # sorting-network benchmark)
+    SORTING_NETWORK_MAX_VALUES = {
+        Constants.COMBINE_MEDIAN: 64,
+        Constants.COMBINE_MINMAX: 32,
+    }
+
+    # Sorting networks already made, by number of values and sorted positions wanted (see sorting_network)
+    _sorting_networks = {}
+
+    # The median absolute deviation of normally distributed data, times this, estimates its standard deviation
+    MAD_TO_STD = 1.482602218505602
+
+    # Floating point type used for the image data while combining, as set in the data model.
+    # In single precision the data (integers up to 65535) is still held exactly, and sums over
+    # the whole stack are accumulated in double precision, so results agree with a double-precision
+    # combine to well within the rounding to integer done when the master file is written.
+
+    @classmethod
+    def working_dtype(cls, data_model: DataModel) -> numpy.dtype:
+        if data_model.get_working_precision() == Constants.PRECISION_SINGLE:
+            return numpy.dtype(numpy.float32)
+        else:
+            return numpy.dtype(numpy.float64)
+
+    # Data type of the strips of files combined by the given method, whose pixels are all natively the given
+    # type.  Unsigned 16-bit camera data that is not calibrated, or is calibrated by a 16-bit pedestal (which,
+    # subtracted stopping at zero, leaves whole numbers in range), is kept as 16-bit integers for the methods
+    # that work on them directly - mean, median and min-max clipping - so a strip takes a quarter of the
+    # memory of double precision, and the results are identical.  Otherwise it is the working precision.
+
+    @classmethod
+    def strip_dtype(cls, data_model: DataModel, combine_method: int,
+                    native_dtype: Optional[numpy.dtype]) -> numpy.dtype:
+        calibration_type = data_model.get_precalibration_type()
+        integer_calibration = calibration_type == Constants.CALIBRATION_NONE \
+            or (calibration_type == Constants.CALIBRATION_PEDESTAL
+                and data_model.get_precalibration_pedestal() <= 0xFFFF)
+        if native_dtype == numpy.uint16 and integer_calibration \
+                and combine_method in (Constants.COMBINE_MEAN, Constants.COMBINE_MEDIAN, Constants.COMBINE_MINMAX):
+            return numpy.dtype(numpy.uint16)
+        return cls.working_dtype(data_model)
+
+    # Combine the given files by reading and calibrating them in horizontal strips, the same rows from
+    # every file, and combining each strip with the given combine method and parameters (see combine_tile).
+    # Each pixel is combined only from its own column of values, so the result is the same as combining the
+    # whole stack at once, but only one strip of every file need be in memory.  The strips are as tall as
+    # fit in the combine memory budget, given how many copies of its input the combine method needs
+    # (including its temporary arrays);  if the whole stack fits, it is done in a single strip.
+    # Each file's rows are read straight into the strip, in the background ahead of the calibration,
+    # so the strip is the only copy of the data.
+    # Each strip is combined by a tile combiner (see make_tile_combiner), which may split it into tiles
+    # that are combined at the same time by several threads or processes.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def combine_in_strips(cls, file_names: [str],
+                          data_model: DataModel,
+                          calibrator: Calibrator,
+                          console: Console,
+                          session_controller: SessionController,
+                          combine_method: int,
+                          parameters: tuple) -> ndarray:
+        return cls.reduce_in_strips(file_names, data_model, calibrator, console, session_controller,
+                                    cls.combine_tile, combine_method, parameters, 1)
+
+    # Reduce the given files in strips, as combine_in_strips does, with the given tile function in place of
+    # combine_tile.  It is called the same way, as tile_function(combine_method, parameters, tile, console,
+    # session_controller), and returns the (rows, columns) results of the tile;  or, if more than one plane
+    # of results is asked for, (rows, planes, columns), and the whole result is (rows, planes, columns).
+    # The combine method decides the memory allowed for working copies of the strips, and whether the data
+    # can be kept as 16-bit integers (see strip_dtype), so the tile function must handle its data the same
+    # way.  The tile function must be something that can be sent to another process, such as a class method.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def reduce_in_strips(cls, file_names: [str],
+                         data_model: DataModel,
+                         calibrator: Calibrator,
+                         console: Console,
+                         session_controller: SessionController,
+                         tile_function: Callable,
+                         combine_method: int,
+                         parameters: tuple,
+                         result_planes: int) -> ndarray:
+        working_dtype = cls.working_dtype(data_model)
+        sample_file = RmFitsUtil.make_file_descriptor(file_names[0])
+        calibrator.prepare_calibration(sample_file, working_dtype, console, session_controller)
+        read_ahead = FrameReadAhead(file_names, working_dtype,
+                                    data_model.get_read_ahead_megabytes() * 1024 * 1024,
+                                    session_controller)
+        strip_dtype = cls.strip_dtype(data_model, combine_method, read_ahead.get_native_dtype())
+        if strip_dtype != working_dtype:
+            console.message("Combining the 16-bit data as integers", 0)
+            read_ahead.set_dtype(strip_dtype)
+        frame_shape = read_ahead.get_frame_shape()
+        (rows, columns) = frame_shape
+        memory_budget = data_model.get_combine_memory_megabytes() * 1024 * 1024
+        strip_rows = cls.rows_per_strip(len(file_names), columns, strip_dtype,
+                                        cls.WORKING_COPIES[combine_method], memory_budget)
+        if strip_rows < rows:
+            console.message(f"Combining in strips of {strip_rows} rows, "
+                            f"to use no more than {data_model.get_combine_memory_megabytes()} MB", 0)
+        with cls.make_tile_combiner(data_model, console, session_controller) as tile_combiner:
+            result = tile_combiner.new_result_array(frame_shape if result_planes == 1
+                                                    else (rows, result_planes, columns))
+            for first_row in range(0, rows, strip_rows):
+                end_row = min(rows, first_row + strip_rows)
+                if strip_rows < rows:
+                    console.message(f"Rows {first_row} to {end_row - 1}", 0, temp=True)
+                strip = tile_combiner.new_strip_array((len(file_names), end_row - first_row, columns),
+                                                      strip_dtype)
+                cls.read_calibrated_strip(read_ahead, calibrator, strip, first_row)
+                cls.check_cancellation(session_controller)
+                tile_combiner.combine_tiles(tile_function, combine_method, parameters,
+                                            strip, result, first_row)
+                # Release this strip before allocating the next, so there are never two at once
+                del strip
+            # A process combiner's shared memory is released when it closes, so keep an ordinary copy
+            result = result.copy()
+        read_ahead.report(console)
+        return result
+
+    # The object that combines each strip.  If more than one combine process is set, a pool of processes
+    # each combines a tile of the strip;  the strip and the result are then in shared memory, so the
+    # worker processes use them directly rather than having copies sent to them.  Otherwise a pool of
+    # threads (possibly just one, the calling thread) does the same, more cheaply but limited by the
+    # parts of the combining that hold the interpreter lock.
+
+    @classmethod
+    def make_tile_combiner(cls, data_model: DataModel, console: Console,
+                           session_controller: SessionController):
+        process_count = data_model.get_combine_process_count()
+        if process_count > 1:
+            console.message(f"Combining with {process_count} processes", 0)
+            return ParallelCombiner(process_count, session_controller)
+        thread_count = data_model.get_combine_thread_count()
+        if thread_count > 1:
+            console.message(f"Combining with {thread_count} threads", 0)
+        return ThreadedCombiner(thread_count, console, session_controller)
+
+    # Read the strip of every file starting at the given row into the given (files, rows, columns) array,
+    # calibrating each file's rows as they arrive
+
+    @classmethod
+    def read_calibrated_strip(cls, read_ahead: FrameReadAhead, calibrator: Calibrator,
+                              strip: ndarray, first_row: int):
+        (_, strip_rows, _) = strip.shape
+        for (_, frame_rows) in read_ahead.frames(first_row, first_row + strip_rows, out=strip):
+            calibrator.calibrate_rows(frame_rows, first_row, read_ahead.get_frame_shape())
+
+    # Combine one tile - a (files, rows, columns) array of calibrated data, which may be changed -
+    # with the given combine method (one of the COMBINE_xxx constants) and its parameters:  none for mean
+    # and median;  the number of values clipped from each end, and the MINMAX_CLIP_xxx mode, for min-max
+    # clipping;  the low and high z-score thresholds, the SIGMA_CENTER_xxx and SIGMA_SCALE_xxx statistics,
+    # and the maximum number of iterations, for sigma clipping.  A single symmetric pass against the mean
+    # and standard deviation is the original sigma clip, done by sigma_clip_stack.
+    # Returns the (rows, columns) combined result.
+
+    @classmethod
+    def combine_tile(cls, combine_method: int, parameters: tuple, tile: ndarray,
+                     console: Console, session_controller: SessionController) -> ndarray:
+        if combine_method == Constants.COMBINE_MEAN:
+            if tile.dtype == numpy.uint16:
+                # Integer sums are exact, as are the double-precision sums of the floating-point data
+                sums = numpy.sum(tile, axis=0, dtype=numpy.min_scalar_type(len(tile) * 0xFFFF))
+                return numpy.divide(sums, len(tile), dtype=numpy.float64)
+            return numpy.mean(tile, axis=0, dtype=numpy.float64)
+        elif combine_method == Constants.COMBINE_MEDIAN:
+            return cls.median_stack(tile, console, session_controller)
+        elif combine_method == Constants.COMBINE_MINMAX:
+            (number_dropped_values, clip_mode) = parameters
+            return cls.min_max_clip_version_6(tile, number_dropped_values, clip_mode, console, session_controller)
+        else:
+            assert combine_method == Constants.COMBINE_SIGMA_CLIP
+            (low_threshold, high_threshold, center, scale, max_iterations) = parameters
+            if max_iterations == 1 and low_threshold == high_threshold \
+                    and center == Constants.SIGMA_CENTER_MEAN and scale == Constants.SIGMA_SCALE_STD:
+                return cls.sigma_clip_stack(tile, low_threshold, console, session_controller)
+            else:
+                return cls.sigma_clip_iterative(tile, low_threshold, high_threshold, center, scale,
+                                                max_iterations, console, session_controller)
+
+    # Memory, in bytes, combining the whole stack of the given files at once with the given method would need,
+    # by which the data model decides whether to stream them instead
+
+    @classmethod
+    def stack_bytes(cls, file_names: [str], data_model: DataModel, combine_method: int) -> float:
+        (x_size, y_size) = RmFitsUtil.make_file_descriptor(file_names[0]).get_dimensions()
+        with RmFitsUtil.map_fits_image(file_names[0]) as image:
+            strip_dtype = cls.strip_dtype(data_model, combine_method, image.get_native_dtype())
+        return len(file_names) * x_size * y_size * strip_dtype.itemsize * cls.WORKING_COPIES[combine_method]
+
+    # Number of rows in each strip, for the given number of files, each of the given width and data type,
+    # to stay within the given memory budget.  At least one row, whatever the budget.
+
+    @classmethod
+    def rows_per_strip(cls, number_of_files: int, columns: int, dtype: numpy.dtype,
+                       working_copies: float, memory_budget: int) -> int:
+        bytes_per_row = number_of_files * columns * dtype.itemsize * working_copies
+        return max(1, int(memory_budget // bytes_per_row))
+
     # Combine the files in the given list using a simple mean (average)
     # Check, as reading, that they all have the same dimensions
     # Return  the mean data array
 
     @classmethod
     def combine_mean(cls, file_names: [str],
+                     data_model: DataModel,
                      calibrator: Calibrator,
                      console: Console,
                      session_controller: SessionController) -> ndarray:
@@ -31,15 +263,13 @@ class ImageMath:
         assert len(file_names) > 0  # Otherwise the combine button would have been disabled
         console.push_level()
         console.message("Combining by simple mean", +1)
-        sample_file = RmFitsUtil.make_file_descriptor(file_names[0])
-        file_data: [ndarray]
-        file_data = RmFitsUtil.read_all_files_data(file_names)
-
-        cls.check_cancellation(session_controller)
-        calibrated_data = calibrator.calibrate_images(file_data, sample_file, console, session_controller)
-
-        cls.check_cancellation(session_controller)
-        mean_result = numpy.mean(calibrated_data, axis=0)
+        if data_model.use_streaming(cls.stack_bytes(file_names, data_model, Constants.COMBINE_MEAN)):
+            console.message("Streaming the frames one at a time", 0)
+            mean_result = StreamingMath.combine_mean(file_names, cls.working_dtype(data_model), data_model,
+                                                     calibrator, console, session_controller)
+        else:
+            mean_result = cls.combine_in_strips(file_names, data_model, calibrator, console, session_controller,
+                                                Constants.COMBINE_MEAN, ())
         console.pop_level()
         return mean_result
 
@@ -48,6 +278,8 @@ class ImageMath:
     # We'll sort the list to more efficiently delete items - we don't need to search
     # the whole list for them, and we know where min and max values are
 
+    # Columns are now repaired all at once by repair_columns;  this remains as the reference it is checked against.
+
     # Example list:   [3, 8, 2, 1, 0, 4, 3, 2, 5, 3, 2, 9, 5, 1, 0, 3, 8, 4, 9, 2]
     @classmethod
     def calc_mm_clipped_mean(cls, column: numpy.array,
@@ -424,82 +656,79 @@ class ImageMath:
     #     console.pop_level()
     #     return result
 
-    # Min-max clipped mean, version 5.  Minor modification of version-4.  It still uses full matrix operations
-    #   to calculate the mean.
+    # Min-max clipped mean, version 6.  Whole-matrix operations like version 5, but without masked arrays:
+    #   the columns of the (files, rows, columns) stack are sorted in place (the stack is ours to change,
+    #   see sort_stack), and the mean taken of the values left in the middle.  (Partitioning the columns at both ends,
+    #   rather than sorting them, was tried too, and is slower for all the stack sizes tried, 10 to 2000.)
     #
-    #   However, method (4) can produce different results than the cell-by-cell methods above in the case where
-    #   a column has no data left after eliminating the minimums and maximums; because in that algorithm the entire
-    #   matrix is re-calculated with fewer dropped points, while in the above methods only the offending columns
-    #   are recalculated.
+    #   In MINMAX_CLIP_TIES mode the results are identical to version 5 (now Benchmarks.min_max_clip_version_5).
+    #   Clipping the minimum and every value equal to it, the given number of times, clips the lowest few
+    #   *distinct* values in the column;  similarly for the maximum.  So once a column is sorted, we number
+    #   its distinct values (its "rank"), and keep the values whose rank is far enough from both ends.
+    #   A column with m distinct values has something left only if no more than (m-1)//2 are clipped from
+    #   each end, which is what version 5's repair of emptied columns (dropping one fewer, until something
+    #   is left) comes to, so each column simply uses the smaller of the two.
     #
-    #   This method, (5), is designed to produce identical results to (0) through (3) (and different from 4).
-    #   If columns are entirely masked, only those columns are re-calculated with a lower drop quotient, not
-    #   the entire matrix.
+    #   In MINMAX_CLIP_EXACT mode, exactly the given number of values is clipped from each end of each column,
+    #   whether or not they equal other values, so every column keeps the same number of values and none
+    #   are emptied.  That's just the mean of the middle of each sorted column.
+    #   If there are too few files for that, as many are clipped as leave at least one value.
 
     @classmethod
-    def min_max_clip_version_5(cls, file_data: ndarray, number_dropped_values: int,
-                               console: Console, session_controller: SessionController):
+    def min_max_clip_version_6(cls, file_data: ndarray, number_dropped_values: int, clip_mode: int,
+                               console: Console, session_controller: SessionController) -> ndarray:
         console.push_level()
-        console.message(f"Using min-max clip with {number_dropped_values} iterations", +1)
-        masked_array = ma.MaskedArray(file_data)
-        drop_counter = 1
-        while drop_counter <= number_dropped_values:
-            cls.check_cancellation(session_controller)
-            console.push_level()
-            console.message(f"Iteration {drop_counter} of {number_dropped_values}.", +1)
-            drop_counter += 1
-            # Find the minimums in all columns.  This will give a 2d matrix the same size as the images
-            # with the column-minimum in each position
-            minimum_values = masked_array.min(axis=0)
+        number_of_values = file_data.shape[0]
+        if clip_mode == Constants.MINMAX_CLIP_EXACT:
+            drop = min(number_dropped_values, (number_of_values - 1) // 2)
+            console.message(f"Min-max clip, dropping exactly {drop} values from each end", +1)
+            if drop > 0:
+                cls.sort_stack(file_data, session_controller)
+                cls.check_cancellation(session_controller)
+            result = numpy.mean(file_data[drop:number_of_values - drop], axis=0, dtype=numpy.float64)
+        else:
+            assert clip_mode == Constants.MINMAX_CLIP_TIES
+            console.message(f"Min-max clip, dropping {number_dropped_values} values and their ties "
+                            f"from each end", +1)
+            cls.sort_stack(file_data, session_controller)
             cls.check_cancellation(session_controller)
+            result = cls.mean_without_tied_extremes(file_data, number_dropped_values)
+        cls.check_cancellation(session_controller)
+        console.pop_level()
+        return result.round()
 
-            # Now compare that matrix of minimums down the layers, so we get Trues where
-            # each minimum exists in its column (minimums might exist more than once, and
-            # we want to find all of them)
-            masked_array = ma.masked_where(masked_array == minimum_values, masked_array)
-            cls.check_cancellation(session_controller)
-            console.message("Masked minimums.", +1, temp=True)
+    # Mean of each column of the given array of columns, sorted along the first axis, after dropping the
+    # given number of lowest and highest values with all their ties, as described for version 6 above.
+    # A column that would be left with nothing has fewer values dropped, as calc_mm_clipped_mean does,
+    # so this gives the same result as calc_mm_clipped_mean on every column at once.  The columns can be
+    # a whole stack, or just a (values, columns) collection of them.
 
-            # Now find and mask the maximums, same approach
-            maximum_values = masked_array.max(axis=0)
-            masked_array = ma.masked_where(masked_array == maximum_values, masked_array)
-            cls.check_cancellation(session_controller)
-            console.message("Masked maximums.", +1, temp=True)
-            console.pop_level()
+    @classmethod
+    def mean_without_tied_extremes(cls, sorted_columns: ndarray, number_dropped_values: int) -> ndarray:
+        # Rank of each value among the distinct values of its (sorted) column:  the number of times the
+        # value changes on the way down the column.  The smallest type that holds it saves a lot of memory.
+        rank_type = numpy.min_scalar_type(sorted_columns.shape[0])
+        rank = numpy.zeros(sorted_columns.shape, dtype=rank_type)
+        numpy.cumsum(sorted_columns[1:] != sorted_columns[:-1], axis=0, dtype=rank_type, out=rank[1:])
+        highest_rank = rank[-1].copy()
+        drop = numpy.minimum(highest_rank // 2, number_dropped_values).astype(rank_type)
+        keep = rank >= drop
+        keep &= rank <= highest_rank - drop
+        del rank
+        result = numpy.sum(sorted_columns, axis=0, where=keep, dtype=numpy.float64)
+        result /= numpy.count_nonzero(keep, axis=0)
+        return result
 
-        console.message(f"Calculating mean of remaining data.", 0)
-        masked_means = numpy.mean(masked_array, axis=0)
-        cls.check_cancellation(session_controller)
-        # If the means matrix contains any masked values, that means that in that column the clipping
-        # eliminated *all* the data.  We will find the offending columns and re-calculate those with
-        # fewer dropped extremes.  This should exactly reproduce the results of the cell-by-cell methods
-        if ma.is_masked(masked_means):
-            console.message("Some columns lost all their values; reducing drops for those columns.", 0)
-            #  Get the mask, and get a 2D matrix showing which columns were entirely masked
-            the_mask = masked_array.mask
-            eliminated_columns_map = ndarray.all(the_mask, axis=0)
-            masked_coordinates = numpy.where(eliminated_columns_map)
-            cls.check_cancellation(session_controller)
-            x_coordinates = masked_coordinates[0]
-            y_coordinates = masked_coordinates[1]
-            assert len(x_coordinates) == len(y_coordinates)
-            repairs = len(x_coordinates)
-            cp = "s" if repairs > 1 else ""
-            np = "" if repairs > 1 else "s"
-            console.message(f"{repairs} column{cp} need{np} repair.", +1)
-            for index in range(repairs):
-                cls.check_cancellation(session_controller)
-                # print(".", end="\n" if (index > 0) and (index % 50 == 0) else "")
-                column_x = x_coordinates[index]
-                column_y = y_coordinates[index]
-                column = file_data[:, column_x, column_y]
-                min_max_clipped_mean: int = round(cls.calc_mm_clipped_mean(column, number_dropped_values - 1,
-                                                                           console, session_controller))
-                masked_means[column_x, column_y] = min_max_clipped_mean
-            # We've replaced the problematic columns, now the mean should calculate cleanly
-            assert not ma.is_masked(masked_means)
-        console.pop_level()
-        return masked_means.round()
+    # Min-max clipped means, as calc_mm_clipped_mean computes them, of the columns of the given stack
+    # selected by the given (rows, columns) map, rounded.  Used to repair the columns that a whole-stack
+    # clipping has left empty:  rather than visiting the columns one at a time, they are gathered into
+    # one (values, columns) array and all computed at once.
+
+    @classmethod
+    def repair_columns(cls, file_data: ndarray, columns_map: ndarray, number_dropped_values: int) -> ndarray:
+        columns = file_data[:, columns_map]
+        columns.sort(axis=0)
+        return cls.mean_without_tied_extremes(columns, number_dropped_values).round()
 
     # Combine given files using "sigma clip"
     #
@@ -533,97 +762,379 @@ class ImageMath:
 
     @classmethod
     def combine_sigma_clip(cls, file_names: [str], sigma_threshold: float,
+                           data_model: DataModel,
                            calibrator: Calibrator, console: Console,
                            session_controller: SessionController) -> Optional[ndarray]:
         console.push_level()
-        console.message(f"Combine by sigma-clipped mean, z-score threshold {sigma_threshold}", +1)
-        sample_file = RmFitsUtil.make_file_descriptor(file_names[0])
-
-        file_data = numpy.asarray(RmFitsUtil.read_all_files_data(file_names))
-        cls.check_cancellation(session_controller)
-
-        file_data = calibrator.calibrate_images(file_data, sample_file, console, session_controller)
-        cls.check_cancellation(session_controller)
-
-        console.message("Calculating unclipped means", +1)
-        column_means = numpy.mean(file_data, axis=0)
-        cls.check_cancellation(session_controller)
+        # Separate low and high thresholds, where set, replace the given one
+        low_threshold = data_model.get_sigma_clip_low_threshold() or sigma_threshold
+        high_threshold = data_model.get_sigma_clip_high_threshold() or sigma_threshold
+        center = data_model.get_sigma_clip_center()
+        scale = data_model.get_sigma_clip_scale()
+        max_iterations = data_model.get_sigma_clip_max_iterations()
+        threshold_string = f"{sigma_threshold}" if low_threshold == high_threshold == sigma_threshold \
+            else f"{low_threshold} low, {high_threshold} high"
+        console.message(f"Combine by sigma-clipped mean, z-score threshold {threshold_string}", +1)
+        if (max_iterations, center, scale) != (1, Constants.SIGMA_CENTER_MEAN, Constants.SIGMA_SCALE_STD):
+            console.message(f"Up to {max_iterations} iterations, z-scores from "
+                            f"{Constants.sigma_center_string(center).lower()} and "
+                            f"{Constants.sigma_scale_string(scale)}", 0)
+        # Only the original single symmetric clip against the mean and standard deviation can be streamed
+        single_pass = low_threshold == high_threshold \
+            and (max_iterations, center, scale) == (1, Constants.SIGMA_CENTER_MEAN, Constants.SIGMA_SCALE_STD)
+        if single_pass and data_model.use_streaming(cls.stack_bytes(file_names, data_model,
+                                                                    Constants.COMBINE_SIGMA_CLIP)):
+            console.message("Streaming the frames, reading each file twice", 0)
+            result = StreamingMath.combine_sigma_clip(file_names, low_threshold, cls.working_dtype(data_model),
+                                                      data_model, calibrator, console, session_controller)
+        else:
+            result = cls.combine_in_strips(file_names, data_model, calibrator, console, session_controller,
+                                           Constants.COMBINE_SIGMA_CLIP,
+                                           (low_threshold, high_threshold, center, scale, max_iterations))
+        console.pop_level()
+        return result
 
-        console.message("Calculating standard deviations", 0)
-        column_stdevs = numpy.std(file_data, axis=0)
-        cls.check_cancellation(session_controller)
-        console.message("Calculating z-scores", 0)
-        # Now what we'd like to do is just:
-        #    z_scores = abs(file_data - column_means) / column_stdevs
-        # Unfortunately, standard deviations can be zero, so that simplistic
-        # statement would generate division-by-zero errors.
-        # Std for a column would be zero if all the values in the column were identical.
-        # In that case we wouldn't want to eliminate any anyway, so we'll set the
-        # zero stdevs to a large number, which causes the z-scores to be small, which
-        # causes no values to be eliminated.
-        column_stdevs[column_stdevs == 0.0] = sys.float_info.max
-        z_scores = abs(file_data - column_means) / column_stdevs
-        cls.check_cancellation(session_controller)
+    # Sigma-clipped mean of the given (files, rows, columns) stack of calibrated data, as described above.
+    #
+    # Rather than mark the rejected data in a mask as big as the stack, then take the mean of the masked
+    # stack, each frame in turn is tested against the threshold and the data it keeps added into a running
+    # sum and count for each column;  the mean is just their ratio.  So, besides the stack itself, only
+    # frame-sized arrays are needed.  And the stack is done a block of rows at a time, small enough that
+    # those arrays stay in the processor's cache through all the passes over the frames.  The z-scores are
+    # computed exactly as the masked version (now Benchmarks.sigma_clip_masked) did, and the sums added in
+    # the same order, so the results are identical.
 
-        console.message("Eliminated data outside threshold", 0)
-        exceeds_threshold = z_scores > sigma_threshold
+    @classmethod
+    def sigma_clip_stack(cls, file_data: ndarray, sigma_threshold: float,
+                         console: Console, session_controller: SessionController) -> ndarray:
+        console.push_level()
+        console.message("Calculating z-scores and means of data within threshold", +1)
+        (number_of_files, rows, columns) = file_data.shape
+        kept_sums = numpy.empty((rows, columns))
+        kept_counts = numpy.empty((rows, columns), dtype=numpy.min_scalar_type(number_of_files))
+        block_rows = max(1, cls.SIGMA_CLIP_BLOCK_SIZE // columns)
+        for first_row in range(0, rows, block_rows):
+            cls.check_cancellation(session_controller)
+            end_row = min(rows, first_row + block_rows)
+            cls.sigma_clip_block(file_data[:, first_row:end_row], sigma_threshold,
+                                 kept_sums[first_row:end_row], kept_counts[first_row:end_row])
         cls.check_cancellation(session_controller)
 
         # Calculate and display how much data we are ignoring
-        dimensions = exceeds_threshold.shape
-        total_pixels = dimensions[0] * dimensions[1] * dimensions[2]
-        number_masked = numpy.count_nonzero(exceeds_threshold)
+        total_pixels = file_data.size
+        number_masked = total_pixels - int(numpy.sum(kept_counts, dtype=numpy.int64))
         percentage_masked = 100.0 * number_masked / total_pixels
         console.message(f"Discarded {number_masked:,} pixels of {total_pixels:,} "
                         f"({percentage_masked:.3f}% of data)", +1)
-
-        masked_array = ma.masked_array(file_data, exceeds_threshold)
-        cls.check_cancellation(session_controller)
         console.message("Calculating adjusted means", -1)
-        masked_means = ma.mean(masked_array, axis=0)
-        cls.check_cancellation(session_controller)
+        eliminated_columns_map = kept_counts == 0
+        result = numpy.divide(kept_sums, kept_counts, out=kept_sums, where=~eliminated_columns_map)
 
-        # If the means matrix contains any masked values, that means that in that column the clipping
-        # eliminated *all* the data.  We will find the offending columns and re-calculate those using
-        # simple min-max clipping.
-        if ma.is_masked(masked_means):
+        # Columns where the clipping eliminated *all* the data are re-calculated using simple min-max clipping
+        if numpy.any(eliminated_columns_map):
             console.message("Some columns lost all their values; min-max clipping those columns.", 0)
-            #  Get the mask, and get a 2D matrix showing which columns were entirely masked
-            eliminated_columns_map = ndarray.all(exceeds_threshold, axis=0)
-            masked_coordinates = numpy.where(eliminated_columns_map)
-            x_coordinates = masked_coordinates[0]
-            y_coordinates = masked_coordinates[1]
-            assert len(x_coordinates) == len(y_coordinates)
-            for index in range(len(x_coordinates)):
-                cls.check_cancellation(session_controller)
-                column_x = x_coordinates[index]
-                column_y = y_coordinates[index]
-                column = file_data[:, column_x, column_y]
-                min_max_clipped_mean: int = round(cls.calc_mm_clipped_mean(column, 2, console, session_controller))
-                masked_means[column_x, column_y] = min_max_clipped_mean
-            # We've replaced the problematic columns, now the mean should calculate cleanly
-            assert not ma.is_masked(masked_means)
+            result[eliminated_columns_map] = cls.repair_columns(file_data, eliminated_columns_map, 2)
         cls.check_cancellation(session_controller)
         console.pop_level()
-        result = masked_means.round().filled()
-        return result
+        return result.round()
+
+    # Sigma clip one block of rows of the stack:  set the given sum and count of each column's values that
+    # are within the threshold.  The statistics and z-scores are computed one frame at a time, in double
+    # precision whatever the working precision, so values that fall right at the threshold are kept or
+    # rejected exactly as they would be in double precision.  Summing the squared deviations frame by frame
+    # adds them in the same order numpy.std does, so gives the same result.
+
+    @classmethod
+    def sigma_clip_block(cls, file_data: ndarray, sigma_threshold: float,
+                         kept_sums: ndarray, kept_counts: ndarray):
+        column_means = numpy.mean(file_data, axis=0, dtype=numpy.float64)
+        sum_of_squares = numpy.zeros(column_means.shape)
+        deviations = numpy.empty(column_means.shape)
+        for frame in file_data:
+            numpy.subtract(frame, column_means, out=deviations)
+            deviations *= deviations
+            sum_of_squares += deviations
+        column_stdevs = numpy.sqrt(sum_of_squares / len(file_data))
+        # A column whose values are all the same has no deviation, and none of its values should be
+        # rejected, so give it a huge standard deviation and hence tiny z-scores
+        column_stdevs[column_stdevs == 0.0] = sys.float_info.max
+
+        kept_sums[...] = 0.0
+        kept_counts[...] = 0
+        kept = numpy.empty(column_means.shape, dtype=bool)
+        for frame in file_data:
+            numpy.subtract(frame, column_means, out=deviations)
+            numpy.absolute(deviations, out=deviations)
+            numpy.divide(deviations, column_stdevs, out=deviations)
+            numpy.less_equal(deviations, sigma_threshold, out=kept)
+            numpy.add(kept_sums, frame, out=kept_sums, where=kept)
+            kept_counts += kept
+
+    # Iterative sigma-clipped mean of the given (files, rows, columns) stack of calibrated data.
+    #
+    # Each iteration measures the z-scores of the data kept so far against a centre (mean or median)
+    # and spread (standard deviation, or median absolute deviation scaled to estimate a standard deviation)
+    # of that data, and rejects what lies further than the low threshold below the centre or the high
+    # threshold above it.  A column whose kept data no longer changes has converged, and drops out of the
+    # later iterations;  the iterations stop when every column has converged, or at the given maximum.
+    # A column with no spread (or one whose clipping would leave nothing) has converged too, as it was.
+    #
+    # Since clipping keeps the data within a range, the kept data of a sorted column is always an
+    # unbroken run of it.  So each block of rows is sorted, and what is kept is just the first and end
+    # positions of the run in each column;  the medians are at the middle of the run.
+
+    @classmethod
+    def sigma_clip_iterative(cls, file_data: ndarray, low_threshold: float, high_threshold: float,
+                             center: int, scale: int, max_iterations: int,
+                             console: Console, session_controller: SessionController) -> ndarray:
+        console.push_level()
+        console.message(f"Iterative sigma clip, up to {max_iterations} iterations", +1)
+        (number_of_files, rows, columns) = file_data.shape
+        result = numpy.empty((rows, columns))
+        unconverged = 0
+        block_rows = max(1, cls.SIGMA_CLIP_BLOCK_SIZE // columns)
+        for first_row in range(0, rows, block_rows):
+            cls.check_cancellation(session_controller)
+            end_row = min(rows, first_row + block_rows)
+            # A (files, pixels) copy of the block, sorted
+            values = numpy.sort(file_data[:, first_row:end_row].reshape(number_of_files, -1), axis=0)
+            first_kept = numpy.zeros(values.shape[1], dtype=numpy.intp)
+            end_kept = numpy.full(values.shape[1], number_of_files, dtype=numpy.intp)
+            active = numpy.arange(values.shape[1])
+            for _ in range(max_iterations):
+                if len(active) == 0:
+                    break
+                active_values = values[:, active]
+                (center_values, scale_values) = cls.sigma_clip_statistics(active_values, first_kept[active],
+                                                                          end_kept[active], center, scale)
+                # New bounds of the kept run:  within those of the previous iteration (data once rejected
+                # stays rejected) and within the thresholds
+                new_first = numpy.maximum(first_kept[active],
+                                          numpy.count_nonzero(active_values < center_values
+                                                              - low_threshold * scale_values, axis=0))
+                new_end = numpy.minimum(end_kept[active],
+                                        numpy.count_nonzero(active_values <= center_values
+                                                            + high_threshold * scale_values, axis=0))
+                changed = ((new_first != first_kept[active]) | (new_end != end_kept[active])) \
+                    & (new_end > new_first) & (scale_values > 0.0)
+                active = active[changed]
+                first_kept[active] = new_first[changed]
+                end_kept[active] = new_end[changed]
+            unconverged += len(active)
+            result[first_row:end_row] = cls.mean_of_runs(values, first_kept, end_kept).reshape(end_row - first_row,
+                                                                                                columns)
+        if unconverged > 0:
+            console.message(f"{unconverged:,} pixels had not converged after {max_iterations} iterations", 0)
+        cls.check_cancellation(session_controller)
+        console.pop_level()
+        return result.round()
+
+    # Centre and spread, in double precision, of the runs, from the given first to the given end position,
+    # of the columns of the given (values, columns) array of sorted columns
+
+    @classmethod
+    def sigma_clip_statistics(cls, sorted_columns: ndarray, first_kept: ndarray, end_kept: ndarray,
+                              center: int, scale: int) -> (ndarray, ndarray):
+        kept = cls.run_mask(sorted_columns.shape[0], first_kept, end_kept)
+        counts = end_kept - first_kept
+        median = cls.median_of_runs(sorted_columns, first_kept, end_kept)
+        if scale == Constants.SIGMA_SCALE_STD or center == Constants.SIGMA_CENTER_MEAN:
+            mean = numpy.sum(sorted_columns, axis=0, where=kept, dtype=numpy.float64) / counts
+        if scale == Constants.SIGMA_SCALE_STD:
+            deviations = sorted_columns - mean
+            deviations *= deviations
+            scale_values = numpy.sqrt(numpy.sum(deviations, axis=0, where=kept) / counts)
+        else:
+            assert scale == Constants.SIGMA_SCALE_MAD
+            # Median of the absolute deviations from the median.  Sorting the deviations, with those of
+            # the rejected data made infinite so they sort to the end, puts it at the middle of the first
+            # "count" values.
+            deviations = numpy.absolute(sorted_columns - median)
+            deviations[~kept] = numpy.inf
+            deviations.sort(axis=0)
+            scale_values = cls.median_of_runs(deviations, numpy.zeros_like(counts), counts) * cls.MAD_TO_STD
+        center_values = median if center == Constants.SIGMA_CENTER_MEDIAN else mean
+        return center_values, scale_values
+
+    # A (values, columns) map of which positions of each column are within its run, from the given first
+    # to the given end position
+
+    @classmethod
+    def run_mask(cls, number_of_values: int, first_kept: ndarray, end_kept: ndarray) -> ndarray:
+        positions = numpy.arange(number_of_values)[:, numpy.newaxis]
+        return (positions >= first_kept) & (positions < end_kept)
+
+    # Median, in double precision, of the runs of the given sorted columns, from the given first
+    # to the given end position:  the middle value of each run, or the mean of the middle two
+
+    @classmethod
+    def median_of_runs(cls, sorted_columns: ndarray, first_kept: ndarray, end_kept: ndarray) -> ndarray:
+        lower_middle = numpy.take_along_axis(sorted_columns, ((first_kept + end_kept - 1) // 2)[numpy.newaxis], 0)
+        upper_middle = numpy.take_along_axis(sorted_columns, ((first_kept + end_kept) // 2)[numpy.newaxis], 0)
+        return (lower_middle[0].astype(numpy.float64) + upper_middle[0]) / 2.0
+
+    # Mean, in double precision, of the runs of the given sorted columns
+
+    @classmethod
+    def mean_of_runs(cls, sorted_columns: ndarray, first_kept: ndarray, end_kept: ndarray) -> ndarray:
+        kept = cls.run_mask(sorted_columns.shape[0], first_kept, end_kept)
+        return numpy.sum(sorted_columns, axis=0, where=kept, dtype=numpy.float64) / (end_kept - first_kept)
 
     @classmethod
     def combine_median(cls, file_names: [str],
+                       data_model: DataModel,
                        calibrator: Calibrator, console: Console,
                        session_controller: SessionController) -> ndarray:
         assert len(file_names) > 0  # Otherwise the combine button would have been disabled
         console.push_level()
         console.message("Combine by simple Median", +1)
-        file_data = RmFitsUtil.read_all_files_data(file_names)
-        cls.check_cancellation(session_controller)
-        sample_file = RmFitsUtil.make_file_descriptor(file_names[0])
-        file_data = calibrator.calibrate_images(file_data, sample_file, console, session_controller)
-        cls.check_cancellation(session_controller)
-        median_result = numpy.median(file_data, axis=0)
+        if data_model.get_median_mode() == Constants.MEDIAN_APPROXIMATE:
+            console.message("Approximate median, streaming the frames, reading each file up to three times", 0)
+            median_result = StreamingMath.combine_median_approximate(file_names, cls.working_dtype(data_model),
+                                                                     data_model, calibrator, console,
+                                                                     session_controller)
+        else:
+            median_result = cls.combine_in_strips(file_names, data_model, calibrator, console, session_controller,
+                                                  Constants.COMBINE_MEDIAN, ())
         console.pop_level()
         return median_result
 
+    # Median of the given (files, rows, columns) stack of calibrated data.
+    #
+    # The data is almost always whole numbers from 0 to 65535 - it came from 16-bit files and any
+    # calibration was by whole-number pedestals or bias frames - so the stack is done a block of rows at
+    # a time, each block converted to 16-bit integers, turned so each column's values are together in
+    # memory, and sorted.  Sorting 2-byte integers in cache is several times faster than numpy.median's
+    # partitioning of the floating-point stack, and as the integers are the data exactly, the middle
+    # values (or the mean of the two middle values, for an even number of files) are exactly what
+    # numpy.median would give.  A block with any value that isn't such an integer (from a calibration
+    # image that wasn't) is done by numpy.median instead.
+    #   A stack of no more files than SORTING_NETWORK_MAX_VALUES allows isn't turned:  its middle values are found
+    # by a sorting network pruned to them, applied to whole frames of the block at once.
+
+    @classmethod
+    def median_stack(cls, file_data: ndarray, console: Console,
+                     session_controller: SessionController) -> ndarray:
+        (number_of_files, rows, columns) = file_data.shape
+        lower_middle = (number_of_files - 1) // 2
+        upper_middle = number_of_files // 2
+        result = numpy.empty((rows, columns))
+        block_rows = max(1, cls.MEDIAN_BLOCK_VALUES // (number_of_files * columns))
+        floating_blocks = 0
+        for first_row in range(0, rows, block_rows):
+            cls.check_cancellation(session_controller)
+            end_row = min(rows, first_row + block_rows)
+            block = file_data[:, first_row:end_row]
+            if block.dtype == numpy.uint16:
+                # The data is already 16-bit integers, and ours to change
+                integers = block
+            else:
+                # Values that aren't 16-bit integers don't survive the conversion, so show up in the comparison
+                with numpy.errstate(invalid="ignore"):
+                    integers = block.astype(numpy.uint16)
+            if integers is block or numpy.array_equal(integers, block):
+                if number_of_files <= cls.SORTING_NETWORK_MAX_VALUES[Constants.COMBINE_MEDIAN]:
+                    sorted_planes = cls.apply_sorting_network(integers, cls.sorting_network(
+                        number_of_files, (lower_middle, upper_middle)))
+                    (lower_values, upper_values) = (sorted_planes[lower_middle], sorted_planes[upper_middle])
+                else:
+                    sorted_columns = integers.reshape((number_of_files, -1)).T.copy()
+                    sorted_columns.sort(axis=1)
+                    (lower_values, upper_values) = (sorted_columns[:, lower_middle], sorted_columns[:, upper_middle])
+                medians = lower_values.astype(numpy.float64)
+                if upper_middle != lower_middle:
+                    medians += upper_values
+                    medians /= 2
+                result[first_row:end_row] = medians.reshape((end_row - first_row, columns))
+            else:
+                # The tile is ours and not used again, so let median partially sort it in place
+                # rather than sorting a copy of it
+                result[first_row:end_row] = numpy.median(block, axis=0, overwrite_input=True)
+                floating_blocks += 1
+        cls.check_cancellation(session_controller)
+        if floating_blocks > 0:
+            console.message(f"Calibrated data not all whole numbers: {floating_blocks} of "
+                            f"{-(-rows // block_rows)} blocks of rows used the floating-point median", 0)
+        return result
+
+    # A sorting network for the given number of values:  a list of (low, high, keep_low, keep_high)
+    # comparators, each putting the smaller of the values at positions low and high at low, and the larger
+    # at high, that sort the values when applied in order.  The network is Knuth's merge exchange (Batcher's
+    # odd-even merge), which works for any number of values.  If the sorted positions wanted are given, it
+    # is pruned to the comparators those depend on, and a comparator whose smaller (or larger) result
+    # nothing later depends on has keep_low (or keep_high) False and computes only the other.
+
+    @classmethod
+    def sorting_network(cls, number_of_values: int, positions: Optional[tuple] = None) -> [tuple]:
+        key = (number_of_values, positions)
+        if key not in cls._sorting_networks:
+            comparators = []
+            if number_of_values > 1:
+                bits = (number_of_values - 1).bit_length()
+                p = 1 << (bits - 1)
+                while p > 0:
+                    (q, r, d) = (1 << (bits - 1), 0, p)
+                    while d > 0:
+                        comparators += [(i, i + d) for i in range(number_of_values - d) if i & p == r]
+                        (d, q, r) = (q - p, q >> 1, p)
+                    p >>= 1
+            needed = set(range(number_of_values) if positions is None else positions)
+            network = []
+            for (low, high) in reversed(comparators):
+                if low in needed or high in needed:
+                    network.append((low, high, low in needed, high in needed))
+                    needed.update((low, high))
+            cls._sorting_networks[key] = network[::-1]
+        return cls._sorting_networks[key]
+
+    # Apply the given sorting network to the planes of the given (values, ...) array:  each comparator is
+    # a numpy.minimum and numpy.maximum of two whole planes, so for a few values this is much faster than
+    # numpy's sort, whose overhead per sorted column is the greater part of its time.  Rather than copying
+    # planes to exchange them, the planes are exchanged in a list, which is returned in sorted order;  the
+    # array's planes are left in no particular order, and one of the returned planes is a new array.
+
+    @classmethod
+    def apply_sorting_network(cls, values: ndarray, network: [tuple]) -> [ndarray]:
+        planes = list(values)
+        spare = numpy.empty(values.shape[1:], dtype=values.dtype)
+        for (low, high, keep_low, keep_high) in network:
+            if keep_low and keep_high:
+                numpy.minimum(planes[low], planes[high], out=spare)
+                numpy.maximum(planes[low], planes[high], out=planes[high])
+                (planes[low], spare) = (spare, planes[low])
+            elif keep_low:
+                numpy.minimum(planes[low], planes[high], out=planes[low])
+            else:
+                numpy.maximum(planes[low], planes[high], out=planes[high])
+        return planes
+
+    # Sort the given (files, rows, columns) stack along its first axis, in place, for min-max clipping.
+    # A stack of no more files than SORTING_NETWORK_MAX_VALUES allows is sorted a block of rows at a time, as
+    # median_stack does.  Each block whose values are all whole numbers from 0 to 65535 (almost always all of
+    # them) is sorted as 16-bit integers by a sorting network;  any other block is sorted by numpy's sort.
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def sort_stack(cls, file_data: ndarray, session_controller: SessionController):
+        (number_of_files, rows, columns) = file_data.shape
+        if number_of_files > cls.SORTING_NETWORK_MAX_VALUES[Constants.COMBINE_MINMAX]:
+            file_data.sort(axis=0)
+            return
+        network = cls.sorting_network(number_of_files)
+        block_rows = max(1, cls.MEDIAN_BLOCK_VALUES // (number_of_files * columns))
+        for first_row in range(0, rows, block_rows):
+            cls.check_cancellation(session_controller)
+            block = file_data[:, first_row:first_row + block_rows]
+            with numpy.errstate(invalid="ignore"):
+                integers = block.astype(numpy.uint16)
+            if block.dtype == numpy.uint16 or numpy.array_equal(integers, block):
+                for (index, plane) in enumerate(cls.apply_sorting_network(integers, network)):
+                    block[index] = plane
+            else:
+                block.sort(axis=0)
+
     # Combine given files using "min-max clip"
     # In the following explanation, "column" means all of the points at a given image (x,y) coordinate,
     # across all the provided files.  Imagine that 20 images are given - then one "column" would be the 20 values
@@ -642,7 +1153,7 @@ class ImageMath:
     # Note that, because the clipping eliminates points on a column-by-column basis, the number of points actually
     # surviving for combination will vary.  There are simple slow ways, and complex fast ways, to handle this.
     #
-    #   The following versions were all tried, in order, and timed, ending up at "optimization 5" which is the
+    #   The following versions were all tried, in order, and timed, ending up at "optimization 6" which is the
     #   one in use.  The other ones are left here for education or interest.
     #
     #   Optimization 0:     This initial version just loops over each image cell and calculates the mean of each column
@@ -663,22 +1174,20 @@ class ImageMath:
     #                       it recalculates the entire matrix with a smaller drop-quotient, rather than just that column
     #   Optimization 5:     Like (4), but recalculates individual columns that fail through complete elimination,
     #                       so generates identical results to options (0) through (3)
+    #   Optimization 6:     No masked arrays at all.  Sort each column in place, then take the mean of the middle
+    #                       of it, in one pass, with the columns that would lose all their data handled in the
+    #                       same pass.  Identical results to (5), without its full-stack temporaries, and about
+    #                       7 times faster.  Can optionally clip exactly the given number of values, not all ties.
 
     @classmethod
     def combine_min_max_clip(cls, file_names: [str], number_dropped_values: int,
+                             data_model: DataModel,
                              calibrator: Calibrator, console: Console,
                              session_controller: SessionController) -> Optional[ndarray]:
         """Combine FITS files in given list using min/max-clipped mean.
         Return an ndarray containing the combined data."""
         success: bool
         assert len(file_names) > 0  # Otherwise the combine button would have been disabled
-        # Get the data to be processed
-        file_data_list: [ndarray] = RmFitsUtil.read_all_files_data(file_names)
-        cls.check_cancellation(session_controller)
-        file_data = numpy.asarray(file_data_list)
-        sample_file = RmFitsUtil.make_file_descriptor(file_names[0])
-        file_data = calibrator.calibrate_images(file_data, sample_file, console, session_controller)
-        cls.check_cancellation(session_controller)
         # Do the math using each algorithm, and display how long it takes
 
         # time_before_0 = datetime.now()
@@ -727,10 +1236,17 @@ class ImageMath:
         # cls.compare_results(result0, result5, "5")
         #
         # return result0
-        result5 = cls.min_max_clip_version_5(file_data, number_dropped_values, console,
-                                             session_controller)
+        if data_model.use_streaming(cls.stack_bytes(file_names, data_model, Constants.COMBINE_MINMAX)):
+            console.message("Streaming the frames one at a time", 0)
+            result = StreamingMath.combine_min_max_clip(file_names, number_dropped_values,
+                                                        data_model.get_min_max_clip_mode(),
+                                                        cls.working_dtype(data_model), data_model,
+                                                        calibrator, console, session_controller)
+        else:
+            result = cls.combine_in_strips(file_names, data_model, calibrator, console, session_controller,
+                                           Constants.COMBINE_MINMAX,
+                                           (number_dropped_values, data_model.get_min_max_clip_mode()))
         cls.check_cancellation(session_controller)
-        result = result5.filled()
         return result
 
     # @classmethod
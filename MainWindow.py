@@ -11,6 +11,7 @@ from PyQt5.QtCore import QObject, QEvent, QModelIndex
 from PyQt5.QtGui import QResizeEvent, QMoveEvent
 from PyQt5.QtWidgets import QMainWindow, QDialog, QHeaderView, QFileDialog, QMessageBox
 
+import MasterMakerExceptions
 from ConsoleWindow import ConsoleWindow
 from Constants import Constants
 from DataModel import DataModel
@@ -395,11 +396,15 @@ class MainWindow(QMainWindow):
             pass
         else:
             try:
-                file_descriptions = RmFitsUtil.make_file_descriptions(file_names)
+                file_descriptions = RmFitsUtil.make_file_descriptions(file_names,
+                                                                      self._data_model.get_scan_worker_count())
                 self._table_model.set_file_descriptors(file_descriptions)
                 self._table_model.sort(0, PyQt5.QtCore.Qt.AscendingOrder)  # Column 0, ascending order
-            except FileNotFoundError as exception:
-                self.error_dialog("File Not Found", f"File \"{exception.filename}\" was not found or not readable")
+            except MasterMakerExceptions.UnreadableFiles as exception:
+                failures = exception.get_failures()
+                self.error_dialog("File Not Readable",
+                                  f"{len(failures)} of the selected files could not be read",
+                                  "\n".join(f"{name}: {message}" for (name, message) in failures))
         self.enable_buttons()
 
     def error_dialog(self, brief_message: str, long_message: str, detailed_text: str = ""):
@@ -541,6 +546,19 @@ class MainWindow(QMainWindow):
         dialog: PreferencesWindow = PreferencesWindow()
         dialog.set_up_ui(self._preferences)
         QDialog.DialogCode = dialog.ui.exec_()
+        self.load_settings_without_controls()
+
+    def load_settings_without_controls(self):
+        """Settings with no control in the main window take effect as soon as they are changed
+        in the preferences dialog, so copy them from the preferences to the data model"""
+        self._data_model.set_working_precision(self._preferences.get_working_precision())
+        self._data_model.set_combine_process_count(self._preferences.get_combine_process_count())
+        self._data_model.set_combine_thread_count(self._preferences.get_combine_thread_count())
+        self._data_model.set_sigma_clip_max_iterations(self._preferences.get_sigma_clip_max_iterations())
+        self._data_model.set_sigma_clip_center(self._preferences.get_sigma_clip_center())
+        self._data_model.set_sigma_clip_scale(self._preferences.get_sigma_clip_scale())
+        self._data_model.set_sigma_clip_low_threshold(self._preferences.get_sigma_clip_low_threshold())
+        self._data_model.set_sigma_clip_high_threshold(self._preferences.get_sigma_clip_high_threshold())
 
     def all_text_fields_valid(self):
         """Return whether all text fields are valid.  (In fact, returns that
@@ -636,7 +654,7 @@ class MainWindow(QMainWindow):
             return self.get_group_output_directory()
         else:
             path = SharedUtils.create_output_path(sample_file, self._data_model.get_master_combine_method(),
-                                                  self._data_model.get_sigma_clip_threshold(),
+                                                  self._data_model.get_sigma_clip_name(),
                                                   self._data_model.get_min_max_number_clipped_per_end())
             return self.get_output_file(path)
 
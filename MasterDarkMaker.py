@@ -1,4 +1,5 @@
 #!/Library/Frameworks/Python.framework/Versions/3.8/bin/python3.8
+import multiprocessing
 import sys
 from argparse import ArgumentParser
 
@@ -12,73 +13,127 @@ from MainWindow import MainWindow
 # window opens.  If run given a list of file names as args, then those are immediately processed
 # without the UI interaction.  Preferences control how they are combined and where the result goes.
 from Preferences import Preferences
+from RmFitsUtil import RmFitsUtil
 
-# Set up command line arguments
-arg_parser = ArgumentParser(description="Combine Dark-Frame FITS files into a master dark")
-arg_parser.add_argument("-g", "--gui", action="store_true",
-                        help="Force GUI interface to open, ignoring other arguments")
+# The program's work is done only when run as a program, not when this module is imported by
+# the worker processes that combine data in parallel (see ParallelCombiner).
+if __name__ == "__main__":
+    # Lets worker processes start properly in a packaged (pyinstaller) copy of the program
+    multiprocessing.freeze_support()
 
-# precalibration options - only one may be used
-precal_arg_group = arg_parser.add_mutually_exclusive_group()
-precal_arg_group.add_argument("-np", "--noprecal", action="store_true",
-                              help="No precalibration of input files")
-precal_arg_group.add_argument("-p", "--pedestal", type=int, metavar="<pedestal value>",
-                              help="Precalibrate by subtracting pedestal value")
-precal_arg_group.add_argument("-b", "--bias", metavar="<Bias FITS file>",
-                              help="Precalibrate by subtracting bias file")
-precal_arg_group.add_argument("-a", "--auto", type=str, metavar="<auto bias directory>",
-                              help="Select best bias file from given directory of bias files")
+    # Set up command line arguments
+    arg_parser = ArgumentParser(description="Combine Dark-Frame FITS files into a master dark")
+    arg_parser.add_argument("-g", "--gui", action="store_true",
+                            help="Force GUI interface to open, ignoring other arguments")
 
-arg_parser.add_argument("-ar", "--autorecursive", action="store_true",
-                        help="Recursively check sub-folders for auto calibration")
-arg_parser.add_argument("-ab", "--autobias", action="store_true",
-                        help="Restrict auto calibration files considered to only Bias files")
+    # precalibration options - only one may be used
+    precal_arg_group = arg_parser.add_mutually_exclusive_group()
+    precal_arg_group.add_argument("-np", "--noprecal", action="store_true",
+                                  help="No precalibration of input files")
+    precal_arg_group.add_argument("-p", "--pedestal", type=int, metavar="<pedestal value>",
+                                  help="Precalibrate by subtracting pedestal value")
+    precal_arg_group.add_argument("-b", "--bias", metavar="<Bias FITS file>",
+                                  help="Precalibrate by subtracting bias file")
+    precal_arg_group.add_argument("-a", "--auto", type=str, metavar="<auto bias directory>",
+                                  help="Select best bias file from given directory of bias files")
 
-# # combination algorithm options - only one may be used
-method_arg_group = arg_parser.add_mutually_exclusive_group()
-method_arg_group.add_argument("-m", "--mean", action="store_true",
-                              help="Combine by simple mean")
-method_arg_group.add_argument("-n", "--median", action="store_true",
-                              help="Combine by simple median")
-method_arg_group.add_argument("-mm", "--minmax", type=int, metavar="<# values to clip>",
-                              help="Min-max clipping of <n> values, then mean")
-method_arg_group.add_argument("-s", "--sigma", type=float, metavar="<z threshold>",
-                              help="Remove values with z-score greater than threshold, then mean")
+    arg_parser.add_argument("-ar", "--autorecursive", action="store_true",
+                            help="Recursively check sub-folders for auto calibration")
+    arg_parser.add_argument("-ab", "--autobias", action="store_true",
+                            help="Restrict auto calibration files considered to only Bias files")
 
-# Grouping
-arg_parser.add_argument("-gs", "--groupsize", action="store_true",
-                        help="Group files by size (dimensions and binning)")
-arg_parser.add_argument("-ge", "--groupexposure", type=float, metavar="<Bandwidth>",
-                        help="Group by exposure within given %% tolerance")
-arg_parser.add_argument("-gt", "--grouptemperature", type=float, metavar="<Bandwidth>",
-                        help="Group by temperature with given bandwidth")
-arg_parser.add_argument("-mg", "--minimumgroup", type=int, metavar="<Minimum group size>",
-                        help="Ignore groups smaller than given size")
-arg_parser.add_argument("-od", "--outputdirectory", type=str, metavar="Output directory",
-                        help="Directory to receive outputs of grouped combines")
+    # # combination algorithm options - only one may be used
+    method_arg_group = arg_parser.add_mutually_exclusive_group()
+    method_arg_group.add_argument("-m", "--mean", action="store_true",
+                                  help="Combine by simple mean")
+    method_arg_group.add_argument("-n", "--median", action="store_true",
+                                  help="Combine by simple median")
+    method_arg_group.add_argument("-mm", "--minmax", type=int, metavar="<# values to clip>",
+                                  help="Min-max clipping of <n> values, then mean")
+    method_arg_group.add_argument("-s", "--sigma", type=float, metavar="<z threshold>",
+                                  help="Remove values with z-score greater than threshold, then mean")
 
-# File disposition and other options
-arg_parser.add_argument("-v", "--moveinputs", metavar="<directory>",
-                        help="After successful processing, move input files to directory")
-arg_parser.add_argument("-t", "--ignoretype", action="store_true",
-                        help="Ignore the internal FITS file type (flat, bias, etc)")
-arg_parser.add_argument("-o", "--output", metavar="<output path>",
-                        help="Name of output file (default: constructed name at location of inputs)")
+    # Options of the combination algorithms, used only with the corresponding one above
+    arg_parser.add_argument("-mc", "--minmaxclip", choices=["ties", "exact"],
+                            help="Min-max clipping also drops values equal to those dropped (ties), "
+                                 "or exactly <n> values (exact)")
+    arg_parser.add_argument("-nm", "--medianmode", choices=["exact", "approximate"],
+                            help="Median is exact, or approximated from frames streamed one at a time")
+    arg_parser.add_argument("-si", "--sigmaiterations", type=int, metavar="<n>",
+                            help="Repeat sigma clipping on the data kept, up to <n> times")
+    arg_parser.add_argument("-sc", "--sigmacenter", choices=["mean", "median"],
+                            help="Sigma clipping measures z-scores from the mean or median")
+    arg_parser.add_argument("-ss", "--sigmascale", choices=["std", "mad"],
+                            help="Sigma clipping measures z-scores in standard or median absolute deviations")
+    arg_parser.add_argument("-sl", "--sigmalow", type=float, metavar="<z threshold>",
+                            help="Sigma clipping threshold for values below the center")
+    arg_parser.add_argument("-sh", "--sigmahigh", type=float, metavar="<z threshold>",
+                            help="Sigma clipping threshold for values above the center")
 
-arg_parser.add_argument("filenames", nargs="*")
-args = arg_parser.parse_args()
+    # Grouping
+    arg_parser.add_argument("-gs", "--groupsize", action="store_true",
+                            help="Group files by size (dimensions and binning)")
+    arg_parser.add_argument("-ge", "--groupexposure", type=float, metavar="<Bandwidth>",
+                            help="Group by exposure within given %% tolerance")
+    arg_parser.add_argument("-gt", "--grouptemperature", type=float, metavar="<Bandwidth>",
+                            help="Group by temperature with given bandwidth")
+    arg_parser.add_argument("-mg", "--minimumgroup", type=int, metavar="<Minimum group size>",
+                            help="Ignore groups smaller than given size")
+    arg_parser.add_argument("-od", "--outputdirectory", type=str, metavar="Output directory",
+                            help="Directory to receive outputs of grouped combines")
 
-preferences: Preferences = Preferences()
-data_model: DataModel = DataModel(preferences)
+    # Synthesis of a master from a library of masters, rather than combining frames
+    arg_parser.add_argument("-sy", "--synthesize", type=float, nargs=2, metavar=("<exposure>", "<temperature>"),
+                            help="Fit a dark current model to the given master darks, and synthesize from it "
+                                 "a master for the given exposure and temperature")
 
-# If no arguments were given, or if the --gui argument was given, open the GUI window
-if len(sys.argv) == 1 or args.gui:
-    app = QtWidgets.QApplication(sys.argv)
-    window = MainWindow(preferences, data_model)
-    window.set_up_ui()
-    window.ui.show()
-    app.exec_()
-else:
-    # We're operating in pure command-line mode
-    command_line_handler = CommandLineHandler(args, data_model)
-    command_line_handler.execute()
+    # File disposition and other options
+    arg_parser.add_argument("-v", "--moveinputs", metavar="<directory>",
+                            help="After successful processing, move input files to directory")
+    arg_parser.add_argument("-t", "--ignoretype", action="store_true",
+                            help="Ignore the internal FITS file type (flat, bias, etc)")
+    arg_parser.add_argument("-o", "--output", metavar="<output path>",
+                            help="Name of output file (default: constructed name at location of inputs)")
+
+    # Performance tuning
+    arg_parser.add_argument("-sw", "--scanworkers", type=int, metavar="<n>",
+                            help="Number of files whose headers are read at once")
+    arg_parser.add_argument("-j", "--jobs", type=int, metavar="<n>",
+                            help="Number of processes combining the image data at once")
+    arg_parser.add_argument("-ct", "--combinethreads", type=int, metavar="<n>",
+                            help="Number of threads combining the image data at once, if one process")
+    arg_parser.add_argument("-cm", "--combinememory", type=int, metavar="<megabytes>",
+                            help="Memory the combining may use; larger stacks are combined in strips")
+    arg_parser.add_argument("-ra", "--readahead", type=int, metavar="<megabytes>",
+                            help="Memory for frames read ahead of the combining")
+    arg_parser.add_argument("-cc", "--calibrationcache", type=int, metavar="<megabytes>",
+                            help="Memory for calibration images kept for re-use by later groups")
+    arg_parser.add_argument("-st", "--streaming", choices=["auto", "always", "never"],
+                            help="Combine frames one at a time (methods that can), rather than as a stack")
+    arg_parser.add_argument("-pr", "--precision", choices=["single", "double"],
+                            help="Floating point precision used while combining")
+    cache_arg_group = arg_parser.add_mutually_exclusive_group()
+    cache_arg_group.add_argument("-nc", "--nocache", action="store_true",
+                                 help="Read all file headers, ignoring and not updating the header cache")
+    cache_arg_group.add_argument("-rc", "--rebuildcache", action="store_true",
+                                 help="Empty the file header cache, then rebuild it as files are read")
+
+    arg_parser.add_argument("filenames", nargs="*")
+    args = arg_parser.parse_args()
+
+    preferences: Preferences = Preferences()
+    data_model: DataModel = DataModel(preferences)
+
+    # If no arguments were given, or if the --gui argument was given, open the GUI window
+    if len(sys.argv) == 1 or args.gui:
+        RmFitsUtil.set_up_descriptor_cache(data_model.get_use_descriptor_cache(),
+                                           data_model.get_descriptor_cache_max_entries())
+        app = QtWidgets.QApplication(sys.argv)
+        window = MainWindow(preferences, data_model)
+        window.set_up_ui()
+        window.ui.show()
+        app.exec_()
+    else:
+        # We're operating in pure command-line mode
+        command_line_handler = CommandLineHandler(args, data_model)
+        command_line_handler.execute()
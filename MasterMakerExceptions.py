@@ -65,3 +65,33 @@ class AutoCalibrationNoBiasFiles(Exception):
 
 class SessionCancelled(Exception):
     pass
+
+
+#
+#   One or more files could not be read when their headers were scanned.
+#   All the files are tried before this is raised, so it reports every failure at once,
+#   as a list of (file name, error message)
+#
+
+
+class UnreadableFiles(Exception):
+    def __init__(self, failures: [(str, str)]):
+        self._failures = failures
+
+    def get_failures(self) -> [(str, str)]:
+        return self._failures
+
+
+#
+#   A dark current model can't be fitted to the given master darks:  too few of them, or not enough
+#   different exposures, to determine the model and still leave masters to check it against.
+#   The reason is a sentence describing what is missing.
+#
+
+
+class DarkModelNotFittable(Exception):
+    def __init__(self, reason: str):
+        self._reason = reason
+
+    def get_reason(self) -> str:
+        return self._reason
@@ -2,6 +2,7 @@
 # Helps locate resource files, end-running around the problems I've been having
 # with the various native bundle packaging utilities that I can't get working
 import os
+import sys
 
 
 class MultiOsUtil:
@@ -17,3 +18,18 @@ class MultiOsUtil:
         path_to_file = f"{directory_name}/{file_name}"
         return path_to_file
 
+    # Directory where this program can keep cached data that it can rebuild if it is lost.
+    # This is the conventional per-user cache location for each system.  It is created if necessary.
+
+    @classmethod
+    def user_cache_directory(cls) -> str:
+        """Determine the directory for this program's cache files, creating it if necessary"""
+        if sys.platform == "darwin":
+            base_directory = os.path.expanduser("~/Library/Caches")
+        elif sys.platform == "win32":
+            base_directory = os.environ.get("LOCALAPPDATA", os.path.expanduser("~\\AppData\\Local"))
+        else:
+            base_directory = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        cache_directory = os.path.join(base_directory, "MasterDarkMaker")
+        os.makedirs(cache_directory, exist_ok=True)
+        return cache_directory
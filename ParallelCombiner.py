@@ -0,0 +1,184 @@
+#
+#   Combines a strip of the image stack on several processes at once, each process combining a tile
+#   (a range of the strip's rows) with the usual combine method.  Each pixel depends only on its own
+#   column of values, so the tiles are independent and the result is exactly what one process produces.
+#
+#   The strip and the result are allocated in shared memory, so the worker processes read their tiles
+#   and write their results in place:  only the names of the shared blocks and the row ranges are sent
+#   to them, never the pixel data.  The worker processes are started with "spawn", which is safe from
+#   the GUI's worker thread and works the same on every platform.
+#
+#   Worker processes can't see the session controller, so when the session is cancelled a shared
+#   event is set instead, which the combine code running in the workers sees through a
+#   WorkerSessionController the next time it checks for cancellation.
+#
+#   With one process, nothing is shared or started, and arrays are ordinary numpy arrays.
+#
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+from typing import Optional, Callable
+
+import numpy
+from numpy import ndarray
+
+import MasterMakerExceptions
+from ConsoleSilent import ConsoleSilent
+from SessionController import SessionController
+
+
+class ParallelCombiner:
+    # How often the main process checks for cancellation while waiting for the workers
+    POLL_INTERVAL = 0.25
+
+    # ProcessPoolExecutor can't use more than this many processes on Windows
+    MAXIMUM_PROCESSES = 61
+
+    # In a worker process:  the event set when the session is cancelled, and the shared blocks
+    # attached so far, by name.  Blocks stay attached for the life of the worker, so they are attached
+    # only once however many tiles use them.
+    _cancel_event = None
+    _attached_blocks: {str: shared_memory.SharedMemory} = {}
+
+    def __init__(self, process_count: int, session_controller: SessionController):
+        assert process_count > 0
+        self._process_count = min(process_count, self.MAXIMUM_PROCESSES)
+        self._session_controller = session_controller
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Tiles submitted to the workers by the last combine_tiles, so any not started can be cancelled
+        self._futures = []
+        self._cancel_event = None
+        self._result_block: Optional[shared_memory.SharedMemory] = None
+        self._strip_block: Optional[shared_memory.SharedMemory] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Allocate the (rows, columns) array of double-precision results, or (rows, planes, columns) if more
+    # than one plane of results is asked for (see ImageMath.reduce_in_strips)
+
+    def new_result_array(self, shape: tuple) -> ndarray:
+        if self._process_count == 1:
+            return numpy.empty(shape)
+        assert self._result_block is None
+        self._result_block = self.new_block(shape, numpy.float64)
+        return numpy.ndarray(shape, dtype=numpy.float64, buffer=self._result_block.buf)
+
+    # Allocate a (files, rows, columns) strip.  Strips are used one at a time, so each new one
+    # uses the memory of the one before, if it is big enough;  the previous strip must not be used again.
+
+    def new_strip_array(self, shape: (int, int, int), dtype) -> ndarray:
+        if self._process_count == 1:
+            return numpy.empty(shape, dtype=dtype)
+        dtype = numpy.dtype(dtype)
+        if self._strip_block is None or self._strip_block.size < math.prod(shape) * dtype.itemsize:
+            if self._strip_block is not None:
+                self.release_block(self._strip_block)
+            self._strip_block = self.new_block(shape, dtype)
+        return numpy.ndarray(shape, dtype=dtype, buffer=self._strip_block.buf)
+
+    @classmethod
+    def new_block(cls, shape: tuple, dtype) -> shared_memory.SharedMemory:
+        return shared_memory.SharedMemory(create=True, size=max(1, math.prod(shape) * numpy.dtype(dtype).itemsize))
+
+    @classmethod
+    def release_block(cls, block: shared_memory.SharedMemory):
+        block.close()
+        block.unlink()
+
+    # Combine the given strip, which starts at the given row of the result, into the result, by
+    # splitting it into tiles combined at the same time by the worker processes.  The strip and result
+    # must have been allocated by this object.  The given tile-combining function is called in the
+    # workers as combine_tile(combine_method, parameters, tile, console, session_controller), so must be
+    # something that can be sent to another process, such as a class method.
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session was cancelled
+    #       (and any raised by combine_tile in a worker)
+
+    def combine_tiles(self, combine_tile: Callable, combine_method: int, parameters: tuple,
+                      strip: ndarray, result: ndarray, first_row: int):
+        assert self._process_count > 1 and self._strip_block is not None and self._result_block is not None
+        if self._executor is None:
+            context = multiprocessing.get_context("spawn")
+            self._cancel_event = context.Event()
+            self._executor = ProcessPoolExecutor(max_workers=self._process_count, mp_context=context,
+                                                 initializer=ParallelCombiner.initialize_worker,
+                                                 initargs=(self._cancel_event,))
+        (_, strip_rows, _) = strip.shape
+        tile_count = min(self._process_count, strip_rows)
+        tile_bounds = [(index * strip_rows) // tile_count for index in range(tile_count + 1)]
+        self._futures = [self._executor.submit(ParallelCombiner.combine_tile_in_worker, combine_tile,
+                                               combine_method, parameters,
+                                               self._strip_block.name, strip.shape, strip.dtype.str,
+                                               tile_bounds[index], tile_bounds[index + 1],
+                                               self._result_block.name, result.shape, first_row)
+                         for index in range(tile_count)]
+        pending = set(self._futures)
+        while len(pending) > 0:
+            if self._session_controller.thread_cancelled():
+                self._cancel_event.set()
+                for future in pending:
+                    future.cancel()
+                # Wait for the tiles already started to notice the cancellation, so none is still
+                # using the shared memory when it is released
+                wait(pending)
+                raise MasterMakerExceptions.SessionCancelled
+            (_, pending) = wait(pending, timeout=self.POLL_INTERVAL, return_when=FIRST_COMPLETED)
+        for future in self._futures:
+            # Re-raises, here, any exception raised in the worker
+            future.result()
+
+    # Stop the worker processes and release the shared memory.  Any arrays from this object must
+    # no longer be in use.
+
+    def close(self):
+        if self._executor is not None:
+            # Abandon any tiles not yet started (shutdown's cancel_futures needs Python 3.9)
+            for future in self._futures:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._futures = []
+        for block in (self._strip_block, self._result_block):
+            if block is not None:
+                self.release_block(block)
+        self._strip_block = None
+        self._result_block = None
+
+    # The following run in the worker processes
+
+    @classmethod
+    def initialize_worker(cls, cancel_event):
+        ParallelCombiner._cancel_event = cancel_event
+
+    @classmethod
+    def attach_block(cls, name: str) -> shared_memory.SharedMemory:
+        if name not in ParallelCombiner._attached_blocks:
+            ParallelCombiner._attached_blocks[name] = shared_memory.SharedMemory(name=name)
+        return ParallelCombiner._attached_blocks[name]
+
+    @classmethod
+    def combine_tile_in_worker(cls, combine_tile: Callable, combine_method: int, parameters: tuple,
+                               strip_name: str, strip_shape: (int, int, int), strip_dtype: str,
+                               first_tile_row: int, end_tile_row: int,
+                               result_name: str, result_shape: tuple, first_result_row: int):
+        strip = numpy.ndarray(strip_shape, dtype=strip_dtype, buffer=cls.attach_block(strip_name).buf)
+        result = numpy.ndarray(result_shape, dtype=numpy.float64, buffer=cls.attach_block(result_name).buf)
+        result[first_result_row + first_tile_row:first_result_row + end_tile_row] = \
+            combine_tile(combine_method, parameters, strip[:, first_tile_row:end_tile_row],
+                         ConsoleSilent(), WorkerSessionController())
+
+
+#
+#   Stands in for the session controller in a worker process:  the session is cancelled when
+#   the main process sets the shared cancellation event.
+#
+class WorkerSessionController(SessionController):
+
+    def thread_running(self):
+        return not ParallelCombiner._cancel_event.is_set()
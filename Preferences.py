@@ -1,6 +1,7 @@
 from PyQt5.QtCore import QSettings, QSize, QPoint
 
 from Constants import Constants
+from DescriptorCache import DescriptorCache
 
 
 class Preferences(QSettings):
@@ -14,11 +15,23 @@ class Preferences(QSettings):
     # before the remaining points are Mean-combined?  Returns an integer > 0.
     MIN_MAX_NUMBER_CLIPPED_PER_END = "min_max_number_clipped_per_end"
 
+    # Does min-max clipping also drop values equal to those dropped?  One of the MINMAX_CLIP_xxx constants
+    MIN_MAX_CLIP_MODE = "min_max_clip_mode"
+
     # If Sigma-Clip method is used, what is the threshold sigma score?
     # Data farther than this many standard deviations from the sample mean are rejected,
     # the the remaining points are mean-combined.  Floating point number > 0.
     SIGMA_CLIP_THRESHOLD = "sigma_clip_threshold"
 
+    # Sigma clipping can be repeated, measuring against the data kept each time, up to this many times
+    SIGMA_CLIP_MAX_ITERATIONS = "sigma_clip_max_iterations"
+    # Statistics z-scores are measured against:  SIGMA_CENTER_xxx and SIGMA_SCALE_xxx constants
+    SIGMA_CLIP_CENTER = "sigma_clip_center"
+    SIGMA_CLIP_SCALE = "sigma_clip_scale"
+    # Separate thresholds for data below and above the centre;  0 means use the sigma clip threshold
+    SIGMA_CLIP_LOW_THRESHOLD = "sigma_clip_low_threshold"
+    SIGMA_CLIP_HIGH_THRESHOLD = "sigma_clip_high_threshold"
+
     # What do we do with the input files after a successful combine?
     # Gives an integer from the constants class DISPOSITION_xxx
     INPUT_FILE_DISPOSITION = "input_file_disposition"
@@ -63,6 +76,35 @@ class Preferences(QSettings):
     IGNORE_GROUPS_FEWER_THAN = "ignore_groups_fewer_than"
     MINIMUM_GROUP_SIZE = "minimum_group_size"
 
+    # How many files have their headers read at once when building the file list?
+    SCAN_WORKER_COUNT = "scan_worker_count"
+
+    # Floating point precision used while combining, one of the PRECISION_xxx constants
+    WORKING_PRECISION = "working_precision"
+
+    # How much memory may be used for frames read ahead of the combining?  In megabytes.
+    READ_AHEAD_MEGABYTES = "read_ahead_megabytes"
+
+    # How much memory may the combining use?  Larger stacks are combined in strips.  In megabytes.
+    COMBINE_MEMORY_MEGABYTES = "combine_memory_megabytes"
+
+    # How much memory may calibration images, kept for re-use by later groups, take?  In megabytes.
+    CALIBRATION_CACHE_MEGABYTES = "calibration_cache_megabytes"
+
+    # How many processes combine the image data at once?
+    COMBINE_PROCESS_COUNT = "combine_process_count"
+    COMBINE_THREAD_COUNT = "combine_thread_count"
+
+    # Are frames combined one at a time, rather than as a stack?  One of the STREAMING_xxx constants
+    STREAMING_MODE = "streaming_mode"
+
+    # Is the median exact, or approximated from streamed frames?  One of the MEDIAN_xxx constants
+    MEDIAN_MODE = "median_mode"
+
+    # Keep a persistent cache of file header information?  How many files can it hold?
+    USE_DESCRIPTOR_CACHE = "use_descriptor_cache"
+    DESCRIPTOR_CACHE_MAX_ENTRIES = "descriptor_cache_max_entries"
+
     def __init__(self):
         QSettings.__init__(self, "EarwigHavenObservatory.com", "MasterDarkMaker_b")
         # print(f"Preferences file path: {self.fileName()}")
@@ -97,6 +139,18 @@ class Preferences(QSettings):
         assert value > 0
         self.setValue(self.MIN_MAX_NUMBER_CLIPPED_PER_END, value)
 
+    # If the Min-Max method is used, are values equal to a dropped minimum or maximum dropped too
+    # (MINMAX_CLIP_TIES), or exactly the given number of points from each end (MINMAX_CLIP_EXACT)?
+
+    def get_min_max_clip_mode(self) -> int:
+        result = int(self.value(self.MIN_MAX_CLIP_MODE, defaultValue=Constants.MINMAX_CLIP_TIES))
+        assert (result == Constants.MINMAX_CLIP_TIES) or (result == Constants.MINMAX_CLIP_EXACT)
+        return result
+
+    def set_min_max_clip_mode(self, value: int):
+        assert (value == Constants.MINMAX_CLIP_TIES) or (value == Constants.MINMAX_CLIP_EXACT)
+        self.setValue(self.MIN_MAX_CLIP_MODE, value)
+
     # If Sigma-Clip method is used, what is the threshold sigma score?
     # Data farther than this many sigmas (ratio of value and std deviation of set) from the sample mean
     # are rejected, the the remaining points are mean-combined.  Floating point number > 0.
@@ -110,6 +164,60 @@ class Preferences(QSettings):
         assert value > 0.0
         self.setValue(self.SIGMA_CLIP_THRESHOLD, value)
 
+    # If Sigma-Clip method is used, how many times at most is the clipping repeated, each time
+    # measuring z-scores against the data kept by the previous one?  1 means a single pass.
+
+    def get_sigma_clip_max_iterations(self) -> int:
+        result = int(self.value(self.SIGMA_CLIP_MAX_ITERATIONS, defaultValue=1))
+        assert result > 0
+        return result
+
+    def set_sigma_clip_max_iterations(self, value: int):
+        assert value > 0
+        self.setValue(self.SIGMA_CLIP_MAX_ITERATIONS, value)
+
+    # If Sigma-Clip method is used, the centre (SIGMA_CENTER_xxx) and spread (SIGMA_SCALE_xxx)
+    # of the data that z-scores are measured with
+
+    def get_sigma_clip_center(self) -> int:
+        result = int(self.value(self.SIGMA_CLIP_CENTER, defaultValue=Constants.SIGMA_CENTER_MEAN))
+        assert (result == Constants.SIGMA_CENTER_MEAN) or (result == Constants.SIGMA_CENTER_MEDIAN)
+        return result
+
+    def set_sigma_clip_center(self, value: int):
+        assert (value == Constants.SIGMA_CENTER_MEAN) or (value == Constants.SIGMA_CENTER_MEDIAN)
+        self.setValue(self.SIGMA_CLIP_CENTER, value)
+
+    def get_sigma_clip_scale(self) -> int:
+        result = int(self.value(self.SIGMA_CLIP_SCALE, defaultValue=Constants.SIGMA_SCALE_STD))
+        assert (result == Constants.SIGMA_SCALE_STD) or (result == Constants.SIGMA_SCALE_MAD)
+        return result
+
+    def set_sigma_clip_scale(self, value: int):
+        assert (value == Constants.SIGMA_SCALE_STD) or (value == Constants.SIGMA_SCALE_MAD)
+        self.setValue(self.SIGMA_CLIP_SCALE, value)
+
+    # If Sigma-Clip method is used, separate z-score thresholds for data below and above the centre.
+    # 0 means the sigma clip threshold is used for that side.
+
+    def get_sigma_clip_low_threshold(self) -> float:
+        result = float(self.value(self.SIGMA_CLIP_LOW_THRESHOLD, defaultValue=0.0))
+        assert result >= 0.0
+        return result
+
+    def set_sigma_clip_low_threshold(self, value: float):
+        assert value >= 0.0
+        self.setValue(self.SIGMA_CLIP_LOW_THRESHOLD, value)
+
+    def get_sigma_clip_high_threshold(self) -> float:
+        result = float(self.value(self.SIGMA_CLIP_HIGH_THRESHOLD, defaultValue=0.0))
+        assert result >= 0.0
+        return result
+
+    def set_sigma_clip_high_threshold(self, value: float):
+        assert value >= 0.0
+        self.setValue(self.SIGMA_CLIP_HIGH_THRESHOLD, value)
+
     # What to do with input files after a successful combine
 
     def get_input_file_disposition(self):
@@ -273,3 +381,124 @@ class Preferences(QSettings):
 
     def set_minimum_group_size(self, value: int):
         self.setValue(self.MINIMUM_GROUP_SIZE, value)
+
+    # How many files have their headers read at once when building the file list?
+
+    def get_scan_worker_count(self) -> int:
+        result = int(self.value(self.SCAN_WORKER_COUNT, defaultValue=8))
+        assert result > 0
+        return result
+
+    def set_scan_worker_count(self, value: int):
+        assert value > 0
+        self.setValue(self.SCAN_WORKER_COUNT, value)
+
+    # Keep a persistent cache of file header information, so unchanged files aren't re-read every run?
+
+    def get_use_descriptor_cache(self) -> bool:
+        return bool(self.value(self.USE_DESCRIPTOR_CACHE, defaultValue=True, type=bool))
+
+    def set_use_descriptor_cache(self, use_cache: bool):
+        self.setValue(self.USE_DESCRIPTOR_CACHE, use_cache)
+
+    # Maximum number of files in the header cache.  Least recently used files are dropped beyond this.
+
+    def get_descriptor_cache_max_entries(self) -> int:
+        result = int(self.value(self.DESCRIPTOR_CACHE_MAX_ENTRIES, defaultValue=DescriptorCache.DEFAULT_MAX_ENTRIES))
+        assert result > 0
+        return result
+
+    def set_descriptor_cache_max_entries(self, value: int):
+        assert value > 0
+        self.setValue(self.DESCRIPTOR_CACHE_MAX_ENTRIES, value)
+
+    # Floating point precision of the image data while it is being calibrated and combined
+
+    def get_working_precision(self) -> int:
+        result = int(self.value(self.WORKING_PRECISION, defaultValue=Constants.PRECISION_DOUBLE))
+        assert (result == Constants.PRECISION_DOUBLE) or (result == Constants.PRECISION_SINGLE)
+        return result
+
+    def set_working_precision(self, value: int):
+        assert (value == Constants.PRECISION_DOUBLE) or (value == Constants.PRECISION_SINGLE)
+        self.setValue(self.WORKING_PRECISION, value)
+
+    # Memory, in megabytes, for frames read in the background ahead of the calibration and combining
+
+    def get_read_ahead_megabytes(self) -> int:
+        result = int(self.value(self.READ_AHEAD_MEGABYTES, defaultValue=256))
+        assert result > 0
+        return result
+
+    def set_read_ahead_megabytes(self, value: int):
+        assert value > 0
+        self.setValue(self.READ_AHEAD_MEGABYTES, value)
+
+    # Memory, in megabytes, the combining may use.  Stacks needing more are combined a strip of rows at a time.
+
+    def get_combine_memory_megabytes(self) -> int:
+        result = int(self.value(self.COMBINE_MEMORY_MEGABYTES, defaultValue=2048))
+        assert result > 0
+        return result
+
+    def set_combine_memory_megabytes(self, value: int):
+        assert value > 0
+        self.setValue(self.COMBINE_MEMORY_MEGABYTES, value)
+
+    # Memory, in megabytes, for calibration images kept, once read, for later groups in the session.
+    # Zero keeps none.
+
+    def get_calibration_cache_megabytes(self) -> int:
+        result = int(self.value(self.CALIBRATION_CACHE_MEGABYTES, defaultValue=256))
+        assert result >= 0
+        return result
+
+    def set_calibration_cache_megabytes(self, value: int):
+        assert value >= 0
+        self.setValue(self.CALIBRATION_CACHE_MEGABYTES, value)
+
+    # Number of processes that combine the image data at once, each taking a share of the rows
+
+    def get_combine_process_count(self) -> int:
+        result = int(self.value(self.COMBINE_PROCESS_COUNT, defaultValue=1))
+        assert result > 0
+        return result
+
+    def set_combine_process_count(self, value: int):
+        assert value > 0
+        self.setValue(self.COMBINE_PROCESS_COUNT, value)
+
+    # Number of threads that combine the image data at once, each taking a share of the rows.
+    # Used only when combining with a single process.
+
+    def get_combine_thread_count(self) -> int:
+        result = int(self.value(self.COMBINE_THREAD_COUNT, defaultValue=1))
+        assert result > 0
+        return result
+
+    def set_combine_thread_count(self, value: int):
+        assert value > 0
+        self.setValue(self.COMBINE_THREAD_COUNT, value)
+
+    # Whether the frames are combined by streaming them one at a time, for the combine methods that can be:
+    # always, never, or automatically when the stack is too big for the combine memory
+
+    def get_streaming_mode(self) -> int:
+        result = int(self.value(self.STREAMING_MODE, defaultValue=Constants.STREAMING_AUTO))
+        assert result in (Constants.STREAMING_AUTO, Constants.STREAMING_ALWAYS, Constants.STREAMING_NEVER)
+        return result
+
+    def set_streaming_mode(self, value: int):
+        assert value in (Constants.STREAMING_AUTO, Constants.STREAMING_ALWAYS, Constants.STREAMING_NEVER)
+        self.setValue(self.STREAMING_MODE, value)
+
+    # Whether the median combine is exact, or approximated from histograms of the frames, streamed
+
+    def get_median_mode(self) -> int:
+        result = int(self.value(self.MEDIAN_MODE, defaultValue=Constants.MEDIAN_EXACT))
+        assert result in (Constants.MEDIAN_EXACT, Constants.MEDIAN_APPROXIMATE)
+        return result
+
+    def set_median_mode(self, value: int):
+        assert value in (Constants.MEDIAN_EXACT, Constants.MEDIAN_APPROXIMATE)
+        self.setValue(self.MEDIAN_MODE, value)
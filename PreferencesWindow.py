@@ -41,6 +41,19 @@ class PreferencesWindow(QDialog):
         self.ui.minMaxNumDropped.setText(str(preferences.get_min_max_number_clipped_per_end()))
         self.ui.sigmaThreshold.setText(str(preferences.get_sigma_clip_threshold()))
 
+        # Sigma clip options
+        self.ui.sigmaMaxIterations.setText(str(preferences.get_sigma_clip_max_iterations()))
+        if preferences.get_sigma_clip_center() == Constants.SIGMA_CENTER_MEDIAN:
+            self.ui.sigmaCenterMedianRB.setChecked(True)
+        else:
+            self.ui.sigmaCenterMeanRB.setChecked(True)
+        if preferences.get_sigma_clip_scale() == Constants.SIGMA_SCALE_MAD:
+            self.ui.sigmaScaleMadRB.setChecked(True)
+        else:
+            self.ui.sigmaScaleStdRB.setChecked(True)
+        self.ui.sigmaLowThreshold.setText(str(preferences.get_sigma_clip_low_threshold()))
+        self.ui.sigmaHighThreshold.setText(str(preferences.get_sigma_clip_high_threshold()))
+
         # Disposition of input files
         disposition = preferences.get_input_file_disposition()
         if disposition == Constants.INPUT_DISPOSITION_SUBFOLDER:
@@ -78,12 +91,25 @@ class PreferencesWindow(QDialog):
         self.ui.temperatureGroupBandwidth.setText(f"{preferences.get_temperature_group_bandwidth()}")
         self.ui.minimumGroupSize.setText(str(preferences.get_minimum_group_size()))
 
+        # Combining performance
+        if preferences.get_working_precision() == Constants.PRECISION_SINGLE:
+            self.ui.precisionSingleRB.setChecked(True)
+        else:
+            self.ui.precisionDoubleRB.setChecked(True)
+        self.ui.combineProcessCount.setText(str(preferences.get_combine_process_count()))
+        self.ui.combineThreadCount.setText(str(preferences.get_combine_thread_count()))
+
         # Set up responders for buttons and fields
         self.ui.combineMeanRB.clicked.connect(self.combine_mean_button_clicked)
         self.ui.combineMedianRB.clicked.connect(self.combine_median_button_clicked)
         self.ui.combineMinMaxRB.clicked.connect(self.combine_minmax_button_clicked)
         self.ui.combineSigmaRB.clicked.connect(self.combine_sigma_button_clicked)
 
+        self.ui.sigmaCenterMeanRB.clicked.connect(self.sigma_center_mean_clicked)
+        self.ui.sigmaCenterMedianRB.clicked.connect(self.sigma_center_median_clicked)
+        self.ui.sigmaScaleStdRB.clicked.connect(self.sigma_scale_std_clicked)
+        self.ui.sigmaScaleMadRB.clicked.connect(self.sigma_scale_mad_clicked)
+
         self.ui.dispositionNothingRB.clicked.connect(self.disposition_nothing_clicked)
         self.ui.dispositionSubFolderRB.clicked.connect(self.disposition_sub_folder_clicked)
 
@@ -103,16 +129,24 @@ class PreferencesWindow(QDialog):
         self.ui.autoRecursive.clicked.connect(self.auto_recursive_clicked)
         self.ui.autoBiasOnly.clicked.connect(self.auto_bias_only_clicked)
 
+        self.ui.precisionDoubleRB.clicked.connect(self.precision_double_clicked)
+        self.ui.precisionSingleRB.clicked.connect(self.precision_single_clicked)
+
         self.ui.closeButton.clicked.connect(self.close_button_clicked)
 
         # Input fields
         self.ui.minMaxNumDropped.editingFinished.connect(self.min_max_drop_changed)
         self.ui.sigmaThreshold.editingFinished.connect(self.sigma_threshold_changed)
+        self.ui.sigmaMaxIterations.editingFinished.connect(self.sigma_max_iterations_changed)
+        self.ui.sigmaLowThreshold.editingFinished.connect(self.sigma_low_threshold_changed)
+        self.ui.sigmaHighThreshold.editingFinished.connect(self.sigma_high_threshold_changed)
         self.ui.subFolderName.editingFinished.connect(self.sub_folder_name_changed)
         self.ui.fixedPedestalAmount.editingFinished.connect(self.pedestal_amount_changed)
         self.ui.exposureGroupBandwidth.editingFinished.connect(self.exposure_group_bandwidth_changed)
         self.ui.temperatureGroupBandwidth.editingFinished.connect(self.temperature_group_bandwidth_changed)
         self.ui.minimumGroupSize.editingFinished.connect(self.minimum_group_size_changed)
+        self.ui.combineProcessCount.editingFinished.connect(self.combine_process_count_changed)
+        self.ui.combineThreadCount.editingFinished.connect(self.combine_thread_count_changed)
 
         # Tiny fonts in path display fields
         tiny_font = self.ui.precalibrationPathDisplay.font()
@@ -166,6 +200,22 @@ class PreferencesWindow(QDialog):
         self._preferences.set_master_combine_method(Constants.COMBINE_SIGMA_CLIP)
         self.enableFields()
 
+    def sigma_center_mean_clicked(self):
+        """Sigma clip z-scores measured from the mean. Store that preference."""
+        self._preferences.set_sigma_clip_center(Constants.SIGMA_CENTER_MEAN)
+
+    def sigma_center_median_clicked(self):
+        """Sigma clip z-scores measured from the median. Store that preference."""
+        self._preferences.set_sigma_clip_center(Constants.SIGMA_CENTER_MEDIAN)
+
+    def sigma_scale_std_clicked(self):
+        """Sigma clip z-scores measured in standard deviations. Store that preference."""
+        self._preferences.set_sigma_clip_scale(Constants.SIGMA_SCALE_STD)
+
+    def sigma_scale_mad_clicked(self):
+        """Sigma clip z-scores measured in median absolute deviations. Store that preference."""
+        self._preferences.set_sigma_clip_scale(Constants.SIGMA_SCALE_MAD)
+
     def disposition_nothing_clicked(self):
         """Do nothing to input files radio button selected"""
         self._preferences.set_input_file_disposition(Constants.INPUT_DISPOSITION_NOTHING)
@@ -196,6 +246,14 @@ class PreferencesWindow(QDialog):
         self._preferences.set_precalibration_type(Constants.CALIBRATION_AUTO_DIRECTORY)
         self.enableFields()
 
+    def precision_double_clicked(self):
+        """User has selected double working precision. Store that preference."""
+        self._preferences.set_working_precision(Constants.PRECISION_DOUBLE)
+
+    def precision_single_clicked(self):
+        """User has selected single working precision. Store that preference."""
+        self._preferences.set_working_precision(Constants.PRECISION_SINGLE)
+
     def select_precalibration_file_clicked(self):
         (file_name, _) = QFileDialog.getOpenFileName(parent=self,
                                                      caption="Select dark or bias file",
@@ -250,6 +308,24 @@ class PreferencesWindow(QDialog):
             self._preferences.set_minimum_group_size(new_number)
         SharedUtils.background_validity_color(self.ui.minimumGroupSize, valid)
 
+    def combine_process_count_changed(self):
+        """User has entered value in combining process count field.  Validate and save"""
+        proposed_new_number: str = self.ui.combineProcessCount.text()
+        new_number = Validators.valid_int_in_range(proposed_new_number, 1, 256)
+        valid = new_number is not None
+        if valid:
+            self._preferences.set_combine_process_count(new_number)
+        SharedUtils.background_validity_color(self.ui.combineProcessCount, valid)
+
+    def combine_thread_count_changed(self):
+        """User has entered value in combining thread count field.  Validate and save"""
+        proposed_new_number: str = self.ui.combineThreadCount.text()
+        new_number = Validators.valid_int_in_range(proposed_new_number, 1, 256)
+        valid = new_number is not None
+        if valid:
+            self._preferences.set_combine_thread_count(new_number)
+        SharedUtils.background_validity_color(self.ui.combineThreadCount, valid)
+
     def min_max_drop_changed(self):
         """the field giving the number of minimum and maximum values to drop has been changed.
         Validate it (integer > 0) and store if valid"""
@@ -270,6 +346,36 @@ class PreferencesWindow(QDialog):
             self._preferences.set_sigma_clip_threshold(new_number)
         SharedUtils.background_validity_color(self.ui.sigmaThreshold, valid)
 
+    def sigma_max_iterations_changed(self):
+        """the field giving the most times sigma clipping is repeated has changed.
+        Validate it (integer > 0) and store if valid"""
+        proposed_new_number: str = self.ui.sigmaMaxIterations.text()
+        new_number = Validators.valid_int_in_range(proposed_new_number, 1, 100)
+        valid = new_number is not None
+        if valid:
+            self._preferences.set_sigma_clip_max_iterations(new_number)
+        SharedUtils.background_validity_color(self.ui.sigmaMaxIterations, valid)
+
+    def sigma_low_threshold_changed(self):
+        """the field giving the sigma limit for data below the centre has changed.
+        Validate it (floating point >= 0, 0 meaning the sigma threshold) and store if valid"""
+        proposed_new_number: str = self.ui.sigmaLowThreshold.text()
+        new_number = Validators.valid_float_in_range(proposed_new_number, 0.0, 100.0)
+        valid = new_number is not None
+        if valid:
+            self._preferences.set_sigma_clip_low_threshold(new_number)
+        SharedUtils.background_validity_color(self.ui.sigmaLowThreshold, valid)
+
+    def sigma_high_threshold_changed(self):
+        """the field giving the sigma limit for data above the centre has changed.
+        Validate it (floating point >= 0, 0 meaning the sigma threshold) and store if valid"""
+        proposed_new_number: str = self.ui.sigmaHighThreshold.text()
+        new_number = Validators.valid_float_in_range(proposed_new_number, 0.0, 100.0)
+        valid = new_number is not None
+        if valid:
+            self._preferences.set_sigma_clip_high_threshold(new_number)
+        SharedUtils.background_validity_color(self.ui.sigmaHighThreshold, valid)
+
     def sub_folder_name_changed(self):
         """the field giving the name of the sub-folder to be created or used has changed.
         Validate that it is an acceptable folder name and store if valid"""
@@ -309,5 +415,10 @@ class PreferencesWindow(QDialog):
             self.sigma_threshold_changed()
         if self.ui.dispositionSubFolderRB.isChecked():
             self.sub_folder_name_changed()
+        self.combine_process_count_changed()
+        self.combine_thread_count_changed()
+        self.sigma_max_iterations_changed()
+        self.sigma_low_threshold_changed()
+        self.sigma_high_threshold_changed()
 
         self.ui.close()
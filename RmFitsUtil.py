@@ -1,10 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional
+
+import numpy
 from astropy.io import fits
 from numpy.core.multiarray import ndarray
 
+import MasterMakerExceptions
+from DescriptorCache import DescriptorCache
 from FileDescriptor import FileDescriptor
+from FitsHeaderScanner import FitsHeaderScanner
+from FitsImageMap import FitsImageMap
+from SessionController import SessionController
 
 
 class RmFitsUtil:
+    # Persistent cache of file descriptions, if one is in use.  See set_up_descriptor_cache
+    _descriptor_cache: Optional[DescriptorCache] = None
 
     # Take a best guess at what kind of file this is.  Use FITS header if present, but if that
     # is not present, then guess from file name, looking for keywords such as Dark, Bias, Flat,
@@ -17,12 +28,24 @@ class RmFitsUtil:
     #   4 = Flat
 
     # (type_code, bin_x, bin_y, filter) = RmFitsUtil.categorize_file(name)
+    # The header is read only if the file isn't in the descriptor cache.
     @classmethod
     def make_file_descriptor(cls, absolute_path):
+        cache = cls._descriptor_cache
+        categories = None if cache is None else cache.lookup(absolute_path)
+        if categories is None:
+            categories = cls.categorize_file(absolute_path)
+            if cache is not None:
+                cache.store(absolute_path, categories)
+        return cls.descriptor_from_categories(absolute_path, categories)
+
+    # Make a descriptor from the values returned by categorize_file
+
+    @classmethod
+    def descriptor_from_categories(cls, absolute_path: str, categories: tuple) -> FileDescriptor:
         descriptor = FileDescriptor(absolute_path)
 
-        (type_code, x_size, y_size, x_bin, y_bin, filter_name, exposure, temperature) \
-            = cls.categorize_file(absolute_path)
+        (type_code, x_size, y_size, x_bin, y_bin, filter_name, exposure, temperature) = categories
         descriptor.set_type(type_code)
         descriptor.set_binning(x_bin, y_bin)
         descriptor.set_dimensions(x_size, y_size)
@@ -48,66 +71,95 @@ class RmFitsUtil:
             filter name
             exposure time in seconds
             temperature of CCD"""
+        header = FitsHeaderScanner.scan_for_descriptor(file_name)
+        return cls.categorize_header(file_name, header, light_keywords)
+
+    # Categorize a file from its header values.  The header can be an astropy Header or the
+    # dictionary of values from FitsHeaderScanner - all we need is "in" and indexing by keyword.
+
+    @classmethod
+    def categorize_header(cls, file_name: str, header, light_keywords: [str]) \
+            -> (int, int, int, int, int, str, float, float):
         x_size = 0
         y_size = 0
         exposure = 0.0
         temperature = 0.0
-        with fits.open(file_name) as file:
-            primary = file[0]
-            header = primary.header
-            # Image type
-            if 'PICTTYPE' in header:
-                # This keyword codes the file type directly
+        # Image type
+        if 'PICTTYPE' in header:
+            # This keyword codes the file type directly
+            try:
                 result = int(header['PICTTYPE'])
-            elif 'IMAGETYP' in header:
-                type_code = header['IMAGETYP'].upper()
-                if 'BIAS' in type_code:
-                    result = FileDescriptor.FILE_TYPE_BIAS
-                elif 'DARK' in type_code:
-                    result = FileDescriptor.FILE_TYPE_DARK
-                elif 'FLAT' in type_code:
-                    result = FileDescriptor.FILE_TYPE_FLAT
-                elif 'LIGHT' in type_code:
-                    result = FileDescriptor.FILE_TYPE_LIGHT
-                else:
-                    result = FileDescriptor.FILE_TYPE_UNKNOWN
+            except (TypeError, ValueError):
+                raise ValueError(f"PICTTYPE is {header['PICTTYPE']!r}, not an integer")
+        elif 'IMAGETYP' in header:
+            if not isinstance(header['IMAGETYP'], str):
+                raise ValueError(f"IMAGETYP is {header['IMAGETYP']!r}, not a string")
+            type_code = header['IMAGETYP'].upper()
+            if 'BIAS' in type_code:
+                result = FileDescriptor.FILE_TYPE_BIAS
+            elif 'DARK' in type_code:
+                result = FileDescriptor.FILE_TYPE_DARK
+            elif 'FLAT' in type_code:
+                result = FileDescriptor.FILE_TYPE_FLAT
+            elif 'LIGHT' in type_code:
+                result = FileDescriptor.FILE_TYPE_LIGHT
+            else:
+                result = FileDescriptor.FILE_TYPE_UNKNOWN
+        else:
+            fn_upper = file_name.upper()
+            if 'BIAS' in fn_upper:
+                result = FileDescriptor.FILE_TYPE_BIAS
+            elif 'DARK' in fn_upper:
+                result = FileDescriptor.FILE_TYPE_DARK
+            elif 'FLAT' in fn_upper:
+                result = FileDescriptor.FILE_TYPE_FLAT
             else:
-                fn_upper = file_name.upper()
-                if 'BIAS' in fn_upper:
-                    result = FileDescriptor.FILE_TYPE_BIAS
-                elif 'DARK' in fn_upper:
-                    result = FileDescriptor.FILE_TYPE_DARK
-                elif 'FLAT' in fn_upper:
-                    result = FileDescriptor.FILE_TYPE_FLAT
-                else:
-                    result = FileDescriptor.FILE_TYPE_UNKNOWN
-                    for keyword in light_keywords:
-                        if keyword.upper() in fn_upper:
-                            result = FileDescriptor.FILE_TYPE_LIGHT
-            # Binning values
-            x_binning, y_binning, filter_name = 0, 0, ""
-            if "XBINNING" in header:
-                x_binning = header["XBINNING"]
-            if "YBINNING" in header:
-                y_binning = header["YBINNING"]
-            # Filter name
-            if "FILTER" in header:
-                filter_name = header["FILTER"]
-            # Dimensions
-            if "NAXIS" in header:
-                number_axes = header["NAXIS"]
-                assert number_axes == 2
-                x_size = header["NAXIS1"]
-                y_size = header["NAXIS2"]
-            # Exposure
-            if "EXPOSURE" in header:
-                exposure = header["EXPOSURE"]
-            elif "EXPTIME" in header:
-                exposure = header["EXPTIME"]
-            # Temperature
-            if "CCD-TEMP" in header:
-                temperature = header["CCD-TEMP"]
-            return result, x_size, y_size, x_binning, y_binning, filter_name, exposure, temperature
+                result = FileDescriptor.FILE_TYPE_UNKNOWN
+                for keyword in light_keywords:
+                    if keyword.upper() in fn_upper:
+                        result = FileDescriptor.FILE_TYPE_LIGHT
+        # Binning values
+        x_binning, y_binning, filter_name = 0, 0, ""
+        if "XBINNING" in header:
+            x_binning = cls.header_number(header, "XBINNING", integer=True)
+        if "YBINNING" in header:
+            y_binning = cls.header_number(header, "YBINNING", integer=True)
+        if x_binning != y_binning:
+            raise ValueError(f"Binning is {x_binning} by {y_binning};  only equal binnings can be combined")
+        # Filter name
+        if "FILTER" in header:
+            filter_name = header["FILTER"]
+        # Dimensions
+        if "NAXIS" in header:
+            number_axes = header["NAXIS"]
+            if number_axes != 2:
+                raise ValueError(f"Image has {number_axes} axes, not 2")
+            if "NAXIS1" not in header or "NAXIS2" not in header:
+                raise ValueError("Header is missing the image dimensions (NAXIS1 or NAXIS2)")
+            x_size = cls.header_number(header, "NAXIS1", integer=True)
+            y_size = cls.header_number(header, "NAXIS2", integer=True)
+        # Exposure
+        if "EXPOSURE" in header:
+            exposure = cls.header_number(header, "EXPOSURE")
+        elif "EXPTIME" in header:
+            exposure = cls.header_number(header, "EXPTIME")
+        # Temperature
+        if "CCD-TEMP" in header:
+            temperature = cls.header_number(header, "CCD-TEMP")
+        return result, x_size, y_size, x_binning, y_binning, filter_name, exposure, temperature
+
+    # The value of the given keyword in a header, which must be a number (an integer, if asked).
+    # A file with any other value can't be described, so it is reported as unreadable.
+    #
+    #   Exceptions thrown:
+    #       ValueError          The value is not a number, or not an integer
+
+    @staticmethod
+    def header_number(header, keyword: str, integer: bool = False):
+        value = header[keyword]
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+            raise ValueError(f"{keyword} is {value!r}, not {'an integer' if integer else 'a number'}")
+        return value
 
     @classmethod
     def create_combined_fits_file(cls, name: str,
@@ -158,30 +210,146 @@ class RmFitsUtil:
         else:
             return "UNKNOWN"
 
-    # Read ndarray data arrays for all the given file names.
-    # Result is a list of n ndarrays, where n is the number of file_names.
-    # Each ndarray is a 2-dimensional array of the data for that fits file.
+    # Read the headers of the given files, which are to be combined, so their pixels can be mapped
+    # (see image_map_from_header) and an array allocated to hold them all.  Returns the
+    # (header, data offset) of each file, and the (rows, columns) shape shared by all of them.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files are not all the same dimensions
+
+    @classmethod
+    def scan_stack_layouts(cls, file_names: [str]) -> ([({str: object}, int)], (int, int)):
+        assert len(file_names) > 0
+        layouts = [FitsHeaderScanner.scan(name, FitsHeaderScanner.IMAGE_MAP_KEYWORDS) for name in file_names]
+        shapes = set((header["NAXIS2"], header["NAXIS1"]) for (header, _) in layouts)
+        if len(shapes) != 1:
+            raise MasterMakerExceptions.IncompatibleSizes
+        return layouts, shapes.pop()
+
+    # The native data type (see FitsImageMap) of the pixels of a file with the given IMAGE_MAP_KEYWORDS
+    # header values
 
     @classmethod
-    def read_all_files_data(cls, file_names: [str]) -> [ndarray]:
-        result_array: [ndarray] = []
+    def native_dtype_from_header(cls, header: {str: object}) -> numpy.dtype:
+        (bitpix, bzero, bscale) = (header["BITPIX"], header.get("BZERO", 0), header.get("BSCALE", 1))
+        return FitsImageMap.native_type_for(bitpix, bzero, bscale,
+                                            FitsImageMap.is_unsigned_16(bitpix, bzero, bscale))
+
+    # Read the image in the given file, converted to the given data type.
+    # The pixels are memory-mapped and converted straight into the result, so the only
+    # full-size array allocated is the one returned.
+
+    @classmethod
+    def fits_data_from_path(cls, file_name: str, dtype=float) -> ndarray:
+        with cls.map_fits_image(file_name) as image:
+            return image.read_frame(dtype)
+
+    # Memory-map the pixel data of the given file, without reading or converting it.
+    # Only the header is read here, by the fast scanner;  see FitsImageMap for access to the pixels.
+
+    @classmethod
+    def map_fits_image(cls, file_name: str) -> FitsImageMap:
+        (header, data_offset) = FitsHeaderScanner.scan(file_name, FitsHeaderScanner.IMAGE_MAP_KEYWORDS)
+        return cls.image_map_from_header(file_name, header, data_offset)
+
+    # Memory-map the pixel data of the given file, given its IMAGE_MAP_KEYWORDS header values
+    # and data offset, as returned by FitsHeaderScanner.scan
+
+    @classmethod
+    def image_map_from_header(cls, file_name: str, header: {str: object}, data_offset: int) -> FitsImageMap:
+        assert header["NAXIS"] == 2
+        return FitsImageMap(file_name, data_offset,
+                            header["NAXIS1"], header["NAXIS2"], header["BITPIX"],
+                            header.get("BZERO", 0), header.get("BSCALE", 1))
+
+    # Make descriptors for all the given files, in the same order as the given names.
+    # Headers are read by the given number of worker threads at once;  reading a header is almost
+    # all waiting for the disk or network, so the threads overlap that waiting well.
+    # A file that can't be read doesn't stop the others;  once all files have been tried,
+    # the failures are reported together.
+    #
+    #   Exceptions thrown:
+    #       UnreadableFiles         One or more of the files could not be read
+    #       SessionCancelled        The given session controller was cancelled during the scan
+
+    @classmethod
+    def make_file_descriptions(cls, file_names: [str], worker_count: int = 1,
+                               session_controller: Optional[SessionController] = None) -> [FileDescriptor]:
+        (descriptors, failures) = cls.scan_file_descriptions(file_names, worker_count, session_controller)
+        if len(failures) > 0:
+            raise MasterMakerExceptions.UnreadableFiles(failures)
+        return descriptors
+
+    # Same as make_file_descriptions, but rather than raising an exception for unreadable files,
+    # return the descriptors of the files that could be read, and a list of (file name, error message)
+    # for those that could not.  Both lists are in the same order as the given names.
+    # Files in the descriptor cache are looked up all at once first, and only the rest are read;
+    # the cache is then updated with those in one batch.
+
+    @classmethod
+    def scan_file_descriptions(cls, file_names: [str], worker_count: int = 1,
+                               session_controller: Optional[SessionController] = None) \
+            -> ([FileDescriptor], [(str, str)]):
+        cache = cls._descriptor_cache
+        cached: {str: tuple} = {} if cache is None else cache.lookup_many(file_names)
+        names_to_read = [name for name in file_names if name not in cached]
+        if worker_count <= 1 or len(names_to_read) <= 1:
+            outcomes = []
+            for name in names_to_read:
+                cls.check_cancellation(session_controller)
+                outcomes.append(cls.try_categorize_file(name))
+        else:
+            with ThreadPoolExecutor(max_workers=worker_count) as executor:
+                futures = [executor.submit(cls.try_categorize_file, name) for name in names_to_read]
+                # Wait in short intervals so a cancel request is noticed promptly
+                pending = set(futures)
+                while len(pending) > 0:
+                    if session_controller is not None and session_controller.thread_cancelled():
+                        for future in pending:
+                            future.cancel()
+                        raise MasterMakerExceptions.SessionCancelled
+                    (_, pending) = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+                outcomes = [future.result() for future in futures]
+        read: {str: (Optional[tuple], Optional[str])} = dict(zip(names_to_read, outcomes))
+        if cache is not None:
+            cache.store_many([(name, categories) for (name, (categories, _)) in read.items()
+                              if categories is not None])
+
+        descriptors: [FileDescriptor] = []
+        failures: [(str, str)] = []
         for name in file_names:
-            result_array.append(cls.fits_data_from_path(name))
-        return result_array
+            (categories, message) = (cached[name], None) if name in cached else read[name]
+            if categories is None:
+                failures.append((name, message))
+            else:
+                descriptors.append(cls.descriptor_from_categories(name, categories))
+        return descriptors, failures
+
+    # Categorize one file, returning (categorize_file values, None), or (None, error message)
+    # if the file can't be read
+
+    @classmethod
+    def try_categorize_file(cls, absolute_path: str) -> (Optional[tuple], Optional[str]):
+        try:
+            return cls.categorize_file(absolute_path), None
+        except OSError as exception:
+            return None, exception.strerror if exception.strerror is not None else str(exception)
+        except ValueError as exception:
+            return None, str(exception)
+
+    # Start using the persistent descriptor cache if it is enabled, emptying it first if asked to
+    # rebuild it, or stop using it if it is not enabled.
 
     @classmethod
-    def fits_data_from_path(cls, file_name: str) -> ndarray:
-        with fits.open(file_name) as hdul:
-            primary = hdul[0]
-            # Exposure and temperature
-            return primary.data.astype(float)
+    def set_up_descriptor_cache(cls, enabled: bool, max_entries: int, rebuild: bool = False):
+        cache = DescriptorCache.open_default(max_entries) if enabled else None
+        if cache is not None and rebuild:
+            cache.invalidate()
+        cls._descriptor_cache = cache
 
     @classmethod
-    def make_file_descriptions(cls, file_names: [str]) -> [FileDescriptor]:
-        result: [FileDescriptor] = []
-        for absolute_path in file_names:
-            descriptor = RmFitsUtil.make_file_descriptor(absolute_path)
-            result.append(descriptor)
-        return result
+    def check_cancellation(cls, session_controller: Optional[SessionController]):
+        if session_controller is not None and session_controller.thread_cancelled():
+            raise MasterMakerExceptions.SessionCancelled
 
 
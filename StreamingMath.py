@@ -0,0 +1,573 @@
+#
+#   Combine methods done by streaming the frames:  each frame is read, calibrated, and folded into
+#   running per-pixel values, then dropped, so the memory used depends on the size of a frame and not
+#   on the number of frames.  Frames are read in the background ahead of the calibration and combining,
+#   as in the stack-based methods in ImageMath, so the read-ahead memory is used as well.
+#
+import sys
+from typing import Iterator
+
+import numpy
+from numpy import ndarray
+
+from Calibrator import Calibrator
+from Console import Console
+from Constants import Constants
+from DataModel import DataModel
+from FrameReadAhead import FrameReadAhead
+from RmFitsUtil import RmFitsUtil
+from SessionController import SessionController
+
+
+class StreamingMath:
+    # Larger than any data value:  marks the unused places for the lowest distinct values (see add_to_lowest_distinct)
+    UNUSED_VALUE = numpy.finfo(numpy.float64).max
+
+    # Number of values of a frame added to the running lowest values at once:  small enough that the
+    # working arrays stay in the processor's cache through the passes over the places
+    BLOCK_SIZE = 32768
+
+    # Sigma clipping z-scores this close to the threshold, as a fraction of it, when computed from the
+    # estimated standard deviations, are tested again with the exact ones (see combine_sigma_clip)
+    SIGMA_UNDECIDED_MARGIN = 1.0e-9
+
+    # Number of histogram bins per pixel for the approximate median, and the most passes over the files
+    # counting values in them, each in the bins found to hold the middle values by the one before
+    # (see combine_median_approximate)
+    MEDIAN_BINS = 64
+    MEDIAN_HISTOGRAM_PASSES = 2
+
+    # Set up to stream the given files, read as the given data type:  prepare the calibration, and return
+    # the reader of the frames
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files are not all the same dimensions
+
+    @classmethod
+    def open_stream(cls, file_names: [str], dtype: numpy.dtype, data_model: DataModel, calibrator: Calibrator,
+                    console: Console, session_controller: SessionController) -> FrameReadAhead:
+        sample_file = RmFitsUtil.make_file_descriptor(file_names[0])
+        calibrator.prepare_calibration(sample_file, dtype, console, session_controller)
+        return FrameReadAhead(file_names, dtype, data_model.get_read_ahead_megabytes() * 1024 * 1024,
+                              session_controller)
+
+    # Yield (index, frame) for each file in turn, calibrated, showing the progress on the console.
+    # Each frame is a new array, which the caller may change.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The calibration image is not the same size as the frames
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def calibrated_frames(cls, read_ahead: FrameReadAhead, calibrator: Calibrator,
+                          number_of_files: int, console: Console) -> Iterator[tuple]:
+        frame_shape = read_ahead.get_frame_shape()
+        for (index, frame) in read_ahead.frames():
+            console.message(f"Frame {index + 1} of {number_of_files}", 0, temp=True)
+            calibrator.calibrate_rows(frame, 0, frame_shape)
+            yield index, frame
+
+    # Mean of the given files, read as the given data type, kept as a running double-precision sum of
+    # the frames.  The data is whole numbers, whose sums double precision holds exactly, so this is
+    # exactly the mean numpy.mean gives of the whole stack.  Besides the frames read ahead, only the sum
+    # and the frame being added to it are in memory.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def combine_mean(cls, file_names: [str], dtype: numpy.dtype, data_model: DataModel, calibrator: Calibrator,
+                     console: Console, session_controller: SessionController) -> ndarray:
+        read_ahead = cls.open_stream(file_names, dtype, data_model, calibrator, console, session_controller)
+        sums = numpy.zeros(read_ahead.get_frame_shape())
+        for (_, frame) in cls.calibrated_frames(read_ahead, calibrator, len(file_names), console):
+            sums += frame
+        read_ahead.report(console)
+        sums /= len(file_names)
+        return sums
+
+    # Approximate median of the given files, read as the given data type, from histograms of each pixel's
+    # values, built a frame at a time.
+    #
+    # A first pass finds each pixel's mean and standard deviation.  The median is never more than one
+    # standard deviation from the mean (and, with an even number of files, neither are the two middle
+    # values), so the next pass counts each pixel's values in MEDIAN_BINS bins spanning that range, padded
+    # by 1 at each end, of a whole number of ADU each, plus a bin for the values below it and one for those
+    # above.  The bins holding the middle values are found from the running totals of the counts, and,
+    # up to MEDIAN_HISTOGRAM_PASSES times, the span of those bins is counted again in narrower bins;  the
+    # values below it are counted in the bin below the range, so the middle values' ranks don't change.
+    # Each middle value is then taken as the centre of its bin.
+    #
+    # Error:  a pixel whose final bins are 1 ADU wide has, for whole-number data (which calibrated data is),
+    # its exact median;  otherwise, with bins w ADU wide, the median is within (w - 1) / 2 ADU of the exact
+    # one for whole-number data, and w / 2 in general.  With two passes, the median is exact wherever both
+    # middle values are in a first-pass bin no more than MEDIAN_BINS ADU wide - a range of up to
+    # MEDIAN_BINS squared ADU.  The error is never more than the first pass's bounds (see median_error_bounds).
+    # The share of exact pixels and the largest error bound of the final bins are reported on the console.
+    #
+    # Memory is the histograms, (MEDIAN_BINS + 2) counts of 1 or 2 bytes per pixel, and a few frames,
+    # however many files there are.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def combine_median_approximate(cls, file_names: [str], dtype: numpy.dtype, data_model: DataModel,
+                                   calibrator: Calibrator, console: Console,
+                                   session_controller: SessionController) -> ndarray:
+        number_of_files = len(file_names)
+        read_ahead = cls.open_stream(file_names, dtype, data_model, calibrator, console, session_controller)
+        frame_shape = read_ahead.get_frame_shape()
+        number_of_pixels = frame_shape[0] * frame_shape[1]
+
+        (means, sum_of_squares) = cls.means_and_sums_of_squares(read_ahead, calibrator, number_of_files, console)
+        stdevs = numpy.sqrt(numpy.divide(sum_of_squares, number_of_files, out=sum_of_squares), out=sum_of_squares)
+        (range_starts, range_ends) = cls.median_ranges(means, stdevs)
+        del means, stdevs, sum_of_squares
+        for histogram_pass in range(cls.MEDIAN_HISTOGRAM_PASSES):
+            bin_widths = range_ends - range_starts + 1.0
+            bin_widths /= cls.MEDIAN_BINS
+            numpy.ceil(bin_widths, out=bin_widths)
+            counts = cls.count_in_bins(read_ahead, calibrator, number_of_files, range_starts, bin_widths, console)
+            (lower_bins, upper_bins) = cls.middle_bins(counts, number_of_files)
+            del counts
+            numpy.clip(lower_bins, 1, cls.MEDIAN_BINS, out=lower_bins)
+            numpy.clip(upper_bins, 1, cls.MEDIAN_BINS, out=upper_bins)
+            if histogram_pass == cls.MEDIAN_HISTOGRAM_PASSES - 1 or bin_widths.max() == 1.0:
+                break
+            # The span of those bins (which are never outside the range) is the range of the next pass
+            numpy.multiply(upper_bins, bin_widths, out=range_ends)
+            range_ends += range_starts
+            range_ends -= 1.0
+            range_starts += (lower_bins - 1) * bin_widths
+        read_ahead.report(console)
+
+        # The centres of the last pass's bins holding the middle values, averaged
+        result = (lower_bins + upper_bins - 2) * bin_widths
+        result /= 2.0
+        result += range_starts
+        result += (bin_widths - 1.0) / 2.0
+        exact_pixels = numpy.count_nonzero(bin_widths == 1.0)
+        console.message(f"Approximate median exact (for whole-number data) at {exact_pixels:,} of "
+                        f"{number_of_pixels:,} pixels ({100.0 * exact_pixels / number_of_pixels:.2f}%); "
+                        f"elsewhere within {(bin_widths.max() - 1.0) / 2.0:g} ADU", 0)
+        return result
+
+    # The range of whole numbers the approximate median's first pass counts in, at each pixel of the given
+    # means and standard deviations:  the (starts, ends), both included, of the mean plus or minus one
+    # standard deviation, padded by 1 at each end
+
+    @classmethod
+    def median_ranges(cls, means: ndarray, stdevs: ndarray) -> (ndarray, ndarray):
+        return numpy.floor(means - stdevs) - 1.0, numpy.ceil(means + stdevs) + 1.0
+
+    # The most the approximate median can differ, for whole-number data, from the exact median, at each pixel
+    # of the given means and standard deviations:  (w - 1) / 2 ADU, w being the first pass's bin width,
+    # ceil(R / MEDIAN_BINS) for a range of R whole numbers (see median_ranges).  The later passes' bins are
+    # never wider than the first's, so this holds however many passes are made;  usually they are much
+    # narrower, and the median exact.
+
+    @classmethod
+    def median_error_bounds(cls, means: ndarray, stdevs: ndarray) -> ndarray:
+        (range_starts, range_ends) = cls.median_ranges(means, stdevs)
+        bin_widths = numpy.ceil((range_ends - range_starts + 1.0) / cls.MEDIAN_BINS)
+        return (bin_widths - 1.0) / 2.0
+
+    # Count each pixel's values, over all the files, in MEDIAN_BINS bins of the given widths starting at the
+    # given whole numbers (the first bin holding the values within 0.5 of that number or above it), and in a
+    # bin below those, number 0, and one above them.  Returns the (bins, rows, columns) counts.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The calibration image is not the same size as the frames
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def count_in_bins(cls, read_ahead: FrameReadAhead, calibrator: Calibrator, number_of_files: int,
+                      range_starts: ndarray, bin_widths: ndarray, console: Console) -> ndarray:
+        console.message(f"Counting values in {cls.MEDIAN_BINS} histogram bins", 0)
+        frame_shape = read_ahead.get_frame_shape()
+        number_of_pixels = frame_shape[0] * frame_shape[1]
+        counts = numpy.zeros((cls.MEDIAN_BINS + 2,) + frame_shape, dtype=numpy.min_scalar_type(number_of_files))
+        # Each frame's bin numbers are made indices into the flattened counts, one per pixel, so all distinct
+        flat_counts = counts.reshape(-1)
+        pixel_indices = numpy.arange(number_of_pixels, dtype=numpy.intp).reshape(frame_shape)
+        bins = numpy.empty(frame_shape)
+        indices = numpy.empty(frame_shape, dtype=numpy.intp)
+        for (_, frame) in cls.calibrated_frames(read_ahead, calibrator, number_of_files, console):
+            numpy.subtract(frame, range_starts, out=bins)
+            bins += 0.5
+            bins /= bin_widths
+            numpy.floor(bins, out=bins)
+            bins += 1.0
+            numpy.clip(bins, 0.0, cls.MEDIAN_BINS + 1.0, out=bins)
+            numpy.copyto(indices, bins, casting="unsafe")
+            indices *= number_of_pixels
+            indices += pixel_indices
+            flat_counts[indices] += 1
+        return counts
+
+    # The numbers of the bins, of the given (bins, rows, columns) counts of the given number of values, that
+    # hold each pixel's lower and upper middle values:  the first whose running total passes their ranks
+
+    @classmethod
+    def middle_bins(cls, counts: ndarray, number_of_values: int) -> (ndarray, ndarray):
+        frame_shape = counts.shape[1:]
+        lower_bins = numpy.full(frame_shape, -1, dtype=numpy.int16)
+        upper_bins = numpy.full(frame_shape, -1, dtype=numpy.int16)
+        running_totals = numpy.zeros(frame_shape, dtype=counts.dtype)
+        found = numpy.empty(frame_shape, dtype=bool)
+        for bin_number in range(counts.shape[0]):
+            running_totals += counts[bin_number]
+            for (middle_bins, rank) in [(lower_bins, (number_of_values - 1) // 2), (upper_bins, number_of_values // 2)]:
+                numpy.greater(running_totals, rank, out=found)
+                found &= middle_bins < 0
+                numpy.copyto(middle_bins, bin_number, where=found)
+        return lower_bins, upper_bins
+
+    # Min-max clipped mean of the given files, in the given MINMAX_CLIP_xxx mode, exactly as
+    # ImageMath.min_max_clip_version_6 computes it from the whole stack.
+    #
+    # For each pixel the running sum of its values is kept, along with the given number of its lowest
+    # distinct values, and of its highest, each with the number of times it has occurred - so memory is
+    # (2 * number clipped + 2) frames, however many files there are.  That is all either mode needs:
+    # clipping exactly drops the lowest and highest few values, which are among those kept, from the sum;
+    # clipping ties drops the lowest and highest few distinct values, with all their occurrences, which are
+    # exactly those kept.  When that would leave nothing, a column has no more than twice the number
+    # clipped distinct values, so all its values are among those kept, and the smaller clipping that the
+    # stack method falls back to can be done from them.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def combine_min_max_clip(cls, file_names: [str], number_dropped_values: int, clip_mode: int,
+                             dtype: numpy.dtype, data_model: DataModel, calibrator: Calibrator,
+                             console: Console, session_controller: SessionController) -> ndarray:
+        assert number_dropped_values > 0
+        read_ahead = cls.open_stream(file_names, dtype, data_model, calibrator, console, session_controller)
+        sums = numpy.zeros(read_ahead.get_frame_shape())
+        # The highest values are kept negated, so they are the lowest of the negated values, and kept
+        # by the same code
+        (lowest, lowest_counts) = cls.new_lowest_distinct(number_dropped_values, read_ahead.get_frame_shape(),
+                                                          len(file_names))
+        (negated_highest, negated_highest_counts) = cls.new_lowest_distinct(number_dropped_values,
+                                                                            read_ahead.get_frame_shape(),
+                                                                            len(file_names))
+        negated_frame = numpy.empty(read_ahead.get_frame_shape())
+        (rows, columns) = read_ahead.get_frame_shape()
+        block_rows = max(1, cls.BLOCK_SIZE // columns)
+        for (_, frame) in cls.calibrated_frames(read_ahead, calibrator, len(file_names), console):
+            sums += frame
+            numpy.negative(frame, out=negated_frame)
+            for first_row in range(0, rows, block_rows):
+                block = slice(first_row, min(rows, first_row + block_rows))
+                cls.add_to_lowest_distinct(lowest[:, block], lowest_counts[:, block], frame[block])
+                cls.add_to_lowest_distinct(negated_highest[:, block], negated_highest_counts[:, block],
+                                           negated_frame[block])
+        read_ahead.report(console)
+        if clip_mode == Constants.MINMAX_CLIP_EXACT:
+            drop = min(number_dropped_values, (len(file_names) - 1) // 2)
+            console.message(f"Min-max clip, dropping exactly {drop} values from each end", 0)
+            sums -= cls.sum_of_lowest(lowest, lowest_counts, drop)
+            sums += cls.sum_of_lowest(negated_highest, negated_highest_counts, drop)
+            sums /= len(file_names) - 2 * drop
+            result = sums
+        else:
+            assert clip_mode == Constants.MINMAX_CLIP_TIES
+            console.message(f"Min-max clip, dropping {number_dropped_values} values and their ties "
+                            f"from each end", 0)
+            result = cls.mean_without_tied_extremes(sums, len(file_names), lowest, lowest_counts,
+                                                    numpy.negative(negated_highest), negated_highest_counts)
+        return result.round()
+
+    # New, empty, running lowest distinct values, with the given number of places, of values of the given shape,
+    # for up to the given number of values each:  the values, with every place unused, and their counts
+
+    @classmethod
+    def new_lowest_distinct(cls, places: int, shape: tuple, number_of_values: int) -> (ndarray, ndarray):
+        return (numpy.full((places,) + shape, cls.UNUSED_VALUE),
+                numpy.zeros((places,) + shape, dtype=numpy.min_scalar_type(number_of_values)))
+
+    # Add a frame to the running (places, rows, columns) lowest distinct values of each pixel, kept in
+    # increasing order, and the numbers of times they have occurred.  A value already among them is counted
+    # again;  a lower value than the highest of them (or any value, if there are unused places) is inserted,
+    # moving the higher ones up a place and dropping the highest.  The insertion is a compare and exchange
+    # of the new value with each place in turn, all pixels at once.
+
+    @classmethod
+    def add_to_lowest_distinct(cls, lowest: ndarray, lowest_counts: ndarray, frame: ndarray):
+        already_present = numpy.zeros(frame.shape, dtype=bool)
+        equal = numpy.empty(frame.shape, dtype=bool)
+        for (place_values, place_counts) in zip(lowest, lowest_counts):
+            numpy.equal(place_values, frame, out=equal)
+            place_counts += equal
+            already_present |= equal
+        # A value already present is carried past all the places, so is inserted nowhere
+        carried = numpy.where(already_present, cls.UNUSED_VALUE, frame)
+        carried_counts = numpy.ones(frame.shape, dtype=lowest_counts.dtype)
+        displaced = numpy.empty(frame.shape)
+        exchange = equal
+        for (place_values, place_counts) in zip(lowest, lowest_counts):
+            numpy.less(carried, place_values, out=exchange)
+            numpy.maximum(place_values, carried, out=displaced)
+            numpy.minimum(place_values, carried, out=place_values)
+            (carried, displaced) = (displaced, carried)
+            displaced_counts = numpy.where(exchange, place_counts, carried_counts)
+            numpy.copyto(place_counts, carried_counts, where=exchange)
+            carried_counts = displaced_counts
+
+    # Sum of the given number of lowest values of each pixel, counting repeated values as often as they occur,
+    # from its lowest distinct values and their counts
+
+    @classmethod
+    def sum_of_lowest(cls, lowest: ndarray, lowest_counts: ndarray, number_of_values: int) -> ndarray:
+        total = numpy.zeros(lowest.shape[1:])
+        remaining = numpy.full(lowest.shape[1:], number_of_values, dtype=numpy.int64)
+        for (place_values, place_counts) in zip(lowest, lowest_counts):
+            taken = numpy.minimum(remaining, place_counts)
+            total += place_values * taken
+            remaining -= taken
+        return total
+
+    # Mean of each pixel's values, of which there are the given number with the given sums, without the
+    # given number (the number of places) of lowest distinct values and of highest, as
+    # ImageMath.mean_without_tied_extremes computes it from the whole stack.  If some values are neither,
+    # none need be kept but those.  Otherwise every value is one of those kept:  the column's distinct values,
+    # in order, are the lowest followed by those of the highest (in decreasing order) that are higher than
+    # all the lowest, and are clipped by the smaller number that leaves something, as by the stack method.
+
+    @classmethod
+    def mean_without_tied_extremes(cls, sums: ndarray, number_of_values: int,
+                                   lowest: ndarray, lowest_counts: ndarray,
+                                   highest: ndarray, highest_counts: ndarray) -> ndarray:
+        number_dropped_values = len(lowest)
+        lowest_used = lowest_counts > 0
+        largest_lowest = numpy.max(numpy.where(lowest_used, lowest, -cls.UNUSED_VALUE), axis=0)
+        highest_new = highest_counts > 0
+        highest_new &= highest > largest_lowest
+        distinct_count = numpy.count_nonzero(lowest_used, axis=0) + numpy.count_nonzero(highest_new, axis=0)
+        extremes_sum = numpy.zeros(sums.shape)
+        extremes_count = numpy.zeros(sums.shape, dtype=numpy.int64)
+        for (values, counts, used) in [(lowest, lowest_counts, lowest_used), (highest, highest_counts, highest_new)]:
+            for (place_values, place_counts, place_used) in zip(values, counts, used):
+                numpy.add(extremes_sum, place_values * place_counts, out=extremes_sum, where=place_used)
+                numpy.add(extremes_count, place_counts, out=extremes_count, where=place_used)
+        middle_count = number_of_values - extremes_count
+        result = numpy.divide(sums - extremes_sum, middle_count, where=middle_count > 0, out=numpy.zeros(sums.shape))
+
+        # The pixels with no values between the lowest and highest kept:  as many as leave something of the
+        # distinct values are clipped from each end (the rank of the place of each distinct value from the end
+        # it is in is the place number)
+        all_kept = middle_count == 0
+        drop = numpy.minimum((distinct_count - 1) // 2, number_dropped_values)
+        kept_sum = numpy.zeros(sums.shape)
+        kept_count = numpy.zeros(sums.shape, dtype=numpy.int64)
+        for (values, counts, used) in [(lowest, lowest_counts, lowest_used), (highest, highest_counts, highest_new)]:
+            for (place, (place_values, place_counts, place_used)) in enumerate(zip(values, counts, used)):
+                place_kept = all_kept & place_used
+                place_kept &= place >= drop
+                place_kept &= place <= distinct_count - 1 - drop
+                numpy.add(kept_sum, place_values * place_counts, out=kept_sum, where=place_kept)
+                numpy.add(kept_count, place_counts, out=kept_count, where=place_kept)
+        numpy.divide(kept_sum, kept_count, out=result, where=all_kept)
+        return result
+
+    # Sigma-clipped mean of the given files, clipping values further than the given z-score from the mean,
+    # exactly as ImageMath.sigma_clip_stack does with the whole stack, but reading the files twice rather
+    # than holding them, so only a few frame-sized arrays are in memory.
+    #
+    # The first pass finds each pixel's mean, and an estimate of its standard deviation updated frame by frame
+    # with Welford's method.  The second tests each value against the threshold, and adds those kept into a
+    # running sum and count.  But the data is whole numbers, whose z-scores are quite often exactly the
+    # threshold, and whether the stack method keeps such a value depends on the rounding of its standard
+    # deviation, summed from the squared deviations frame by frame.  So the second pass sums those too, as the
+    # stack method does, and a value too close to the threshold for the estimate to decide is held back (the
+    # value and the number of times it occurs, on each side of the mean) until the end, then tested as the stack
+    # method tests it.  The results are then identical.
+    #   A pixel with more than one such value on a side (which only data that isn't whole numbers is likely to
+    # have) has its undecided values tested in a third reading of the files;  columns that lose all their
+    # values are min-max clipped, as by the stack method, from another.  These read only the pixels concerned,
+    # and are skipped if there are none.
+    #
+    #   Exceptions thrown:
+    #       IncompatibleSizes       The files, or the calibration image, are not all the same dimensions
+    #       SessionCancelled        The session was cancelled
+
+    @classmethod
+    def combine_sigma_clip(cls, file_names: [str], sigma_threshold: float, dtype: numpy.dtype,
+                           data_model: DataModel, calibrator: Calibrator,
+                           console: Console, session_controller: SessionController) -> ndarray:
+        number_of_files = len(file_names)
+        read_ahead = cls.open_stream(file_names, dtype, data_model, calibrator, console, session_controller)
+        frame_shape = read_ahead.get_frame_shape()
+        count_type = numpy.min_scalar_type(number_of_files)
+
+        (column_means, running_sum_of_squares) = cls.means_and_sums_of_squares(read_ahead, calibrator,
+                                                                               number_of_files, console)
+        estimated_stdevs = cls.standard_deviations(running_sum_of_squares, number_of_files)
+
+        console.message("Calculating z-scores and means of data within threshold", 0)
+        lowest_undecided = sigma_threshold * (1.0 - cls.SIGMA_UNDECIDED_MARGIN)
+        highest_undecided = sigma_threshold * (1.0 + cls.SIGMA_UNDECIDED_MARGIN)
+        kept_sums = numpy.zeros(frame_shape)
+        kept_counts = numpy.zeros(frame_shape, dtype=count_type)
+        sum_of_squares = numpy.zeros(frame_shape)
+        # Values held back, below and above the mean, and the number of times each has occurred
+        held_values = numpy.zeros((2,) + frame_shape)
+        held_counts = numpy.zeros((2,) + frame_shape, dtype=count_type)
+        unresolved = numpy.zeros(frame_shape, dtype=bool)
+        kept = numpy.empty(frame_shape, dtype=bool)
+        undecided = numpy.empty(frame_shape, dtype=bool)
+        deviations = numpy.empty(frame_shape)
+        step = numpy.empty(frame_shape)
+        for (_, frame) in cls.calibrated_frames(read_ahead, calibrator, number_of_files, console):
+            numpy.subtract(frame, column_means, out=deviations)
+            numpy.multiply(deviations, deviations, out=step)
+            sum_of_squares += step
+            numpy.absolute(deviations, out=deviations)
+            numpy.divide(deviations, estimated_stdevs, out=deviations)
+            numpy.less(deviations, lowest_undecided, out=kept)
+            numpy.add(kept_sums, frame, out=kept_sums, where=kept)
+            kept_counts += kept
+            numpy.less_equal(deviations, highest_undecided, out=undecided)
+            undecided ^= kept
+            pixels = numpy.flatnonzero(undecided)
+            if len(pixels) > 0:
+                cls.hold_undecided(held_values.reshape((2, -1)), held_counts.reshape((2, -1)),
+                                   unresolved.reshape(-1), pixels,
+                                   frame.reshape(-1)[pixels], column_means.reshape(-1)[pixels])
+        del step, undecided
+        column_stdevs = cls.standard_deviations(sum_of_squares, number_of_files)
+
+        # Test the held values, with the standard deviations the stack method uses, as it tests them
+        for side in range(2):
+            numpy.subtract(held_values[side], column_means, out=deviations)
+            numpy.absolute(deviations, out=deviations)
+            numpy.divide(deviations, column_stdevs, out=deviations)
+            numpy.less_equal(deviations, sigma_threshold, out=kept)
+            kept &= held_counts[side] > 0
+            kept &= ~unresolved
+            numpy.add(kept_sums, held_values[side] * held_counts[side], out=kept_sums, where=kept)
+            numpy.add(kept_counts, held_counts[side], out=kept_counts, where=kept, casting="unsafe")
+        del held_values, held_counts, deviations, kept
+        if numpy.any(unresolved):
+            console.message("Testing values close to the threshold again", 0)
+            (unresolved_sums, unresolved_counts) = \
+                cls.sums_of_undecided(read_ahead, calibrator, number_of_files, unresolved, column_means,
+                                      estimated_stdevs, column_stdevs, sigma_threshold, console)
+            kept_sums[unresolved] += unresolved_sums
+            kept_counts[unresolved] += unresolved_counts.astype(count_type)
+        del column_means, estimated_stdevs, column_stdevs
+
+        total_pixels = number_of_files * kept_counts.size
+        number_masked = total_pixels - int(numpy.sum(kept_counts, dtype=numpy.int64))
+        console.message(f"Discarded {number_masked:,} pixels of {total_pixels:,} "
+                        f"({100.0 * number_masked / total_pixels:.3f}% of data)", 0)
+        eliminated_columns_map = kept_counts == 0
+        result = numpy.divide(kept_sums, kept_counts, out=kept_sums, where=~eliminated_columns_map)
+        if numpy.any(eliminated_columns_map):
+            console.message("Some columns lost all their values; min-max clipping those columns.", 0)
+            result[eliminated_columns_map] = cls.min_max_clip_columns(read_ahead, calibrator, number_of_files,
+                                                                      eliminated_columns_map, 2, console)
+        read_ahead.report(console)
+        return result.round()
+
+    # A first pass over the files:  each pixel's mean, as numpy.mean computes it from the whole stack, and an
+    # estimate of the sum of the squares of its values' deviations from the mean, updated frame by frame by
+    # Welford's method, which keeps its accuracy however many frames there are
+
+    @classmethod
+    def means_and_sums_of_squares(cls, read_ahead: FrameReadAhead, calibrator: Calibrator, number_of_files: int,
+                                  console: Console) -> (ndarray, ndarray):
+        console.message("Calculating means and standard deviations", 0)
+        frame_shape = read_ahead.get_frame_shape()
+        sums = numpy.zeros(frame_shape)
+        running_means = numpy.zeros(frame_shape)
+        running_sum_of_squares = numpy.zeros(frame_shape)
+        deviations = numpy.empty(frame_shape)
+        step = numpy.empty(frame_shape)
+        for (index, frame) in cls.calibrated_frames(read_ahead, calibrator, number_of_files, console):
+            sums += frame
+            numpy.subtract(frame, running_means, out=deviations)
+            numpy.divide(deviations, index + 1, out=step)
+            running_means += step
+            numpy.subtract(frame, running_means, out=step)
+            step *= deviations
+            running_sum_of_squares += step
+        return numpy.divide(sums, number_of_files, out=sums), running_sum_of_squares
+
+    # Population standard deviations from the given sums of squared deviations (which are replaced by them)
+    # of the given number of values.  A column whose values are all the same has no deviation, and none of its
+    # values should be rejected, so it is given a huge standard deviation and hence tiny z-scores.
+
+    @classmethod
+    def standard_deviations(cls, sum_of_squares: ndarray, number_of_values: int) -> ndarray:
+        numpy.divide(sum_of_squares, number_of_values, out=sum_of_squares)
+        numpy.sqrt(sum_of_squares, out=sum_of_squares)
+        sum_of_squares[sum_of_squares == 0.0] = sys.float_info.max
+        return sum_of_squares
+
+    # Hold back the given values, of the given pixels (indices into the flattened frame), whose z-scores are
+    # too close to the threshold to decide yet:  count it again if it is the one already held on its side of
+    # the given means, or hold it if none is.  A pixel with a different value already held on that side
+    # is marked as unresolved.
+
+    @classmethod
+    def hold_undecided(cls, held_values: ndarray, held_counts: ndarray, unresolved: ndarray,
+                       pixels: ndarray, values: ndarray, means: ndarray):
+        sides = (values > means).astype(numpy.intp)
+        first = held_counts[sides, pixels] == 0
+        held_values[sides[first], pixels[first]] = values[first]
+        counted = held_values[sides, pixels] == values
+        held_counts[sides[counted], pixels[counted]] += 1
+        unresolved[pixels[~counted]] = True
+
+    # Sums and counts of the values of the pixels in the given map that were undecided in the second pass of
+    # combine_sigma_clip (their z-scores from the estimated standard deviations, computed exactly as there,
+    # are close to the threshold) and are within the threshold using the stack method's standard deviations:
+    # the files are read again, for just those pixels
+
+    @classmethod
+    def sums_of_undecided(cls, read_ahead: FrameReadAhead, calibrator: Calibrator, number_of_files: int,
+                          pixels_map: ndarray, column_means: ndarray, estimated_stdevs: ndarray,
+                          column_stdevs: ndarray, sigma_threshold: float, console: Console) -> (ndarray, ndarray):
+        means = column_means[pixels_map]
+        estimated = estimated_stdevs[pixels_map]
+        exact = column_stdevs[pixels_map]
+        sums = numpy.zeros(means.shape)
+        counts = numpy.zeros(means.shape, dtype=numpy.int64)
+        for (_, frame) in cls.calibrated_frames(read_ahead, calibrator, number_of_files, console):
+            values = frame[pixels_map]
+            distances = numpy.absolute(values - means)
+            estimated_z_scores = distances / estimated
+            kept = estimated_z_scores >= sigma_threshold * (1.0 - cls.SIGMA_UNDECIDED_MARGIN)
+            kept &= estimated_z_scores <= sigma_threshold * (1.0 + cls.SIGMA_UNDECIDED_MARGIN)
+            kept &= distances / exact <= sigma_threshold
+            numpy.add(sums, values, out=sums, where=kept)
+            counts += kept
+        return sums, counts
+
+    # Min-max clipped means, dropping the given number of values and their ties from each end, as
+    # ImageMath.repair_columns computes them, of the columns selected by the given (rows, columns) map,
+    # rounded:  the files are read again, and running lowest and highest distinct values kept for
+    # just those columns.
+
+    @classmethod
+    def min_max_clip_columns(cls, read_ahead: FrameReadAhead, calibrator: Calibrator, number_of_files: int,
+                             columns_map: ndarray, number_dropped_values: int, console: Console) -> ndarray:
+        number_of_columns = int(numpy.count_nonzero(columns_map))
+        sums = numpy.zeros(number_of_columns)
+        (lowest, lowest_counts) = cls.new_lowest_distinct(number_dropped_values, (number_of_columns,),
+                                                          number_of_files)
+        (negated_highest, negated_highest_counts) = cls.new_lowest_distinct(number_dropped_values,
+                                                                            (number_of_columns,), number_of_files)
+        for (_, frame) in cls.calibrated_frames(read_ahead, calibrator, number_of_files, console):
+            values = frame[columns_map]
+            sums += values
+            cls.add_to_lowest_distinct(lowest, lowest_counts, values)
+            cls.add_to_lowest_distinct(negated_highest, negated_highest_counts, numpy.negative(values))
+        return cls.mean_without_tied_extremes(sums, number_of_files, lowest, lowest_counts,
+                                              numpy.negative(negated_highest), negated_highest_counts).round()
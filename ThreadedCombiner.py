@@ -0,0 +1,104 @@
+#
+#   Combines a strip of the image stack on several threads at once, each thread combining a tile
+#   (a range of the strip's rows) with the usual combine method.  The numpy reductions that do the
+#   bulk of the combining (mean, sort and partition, comparisons) release the interpreter lock while
+#   they run, so the threads really do run at the same time on separate cores.
+#
+#   This does the same job as ParallelCombiner, with the same methods, but with none of its costs:
+#   there are no processes to start, nothing needs to be in shared memory, and the threads can use
+#   the session controller directly - so it works as well from the GUI's worker thread as from the
+#   command line.  Its limit is the parts of the combining that are plain Python and so hold the lock.
+#
+#   With one thread, the tile is simply combined in the calling thread.
+#
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional, Callable
+
+import numpy
+from numpy import ndarray
+
+import MasterMakerExceptions
+from Console import Console
+from ConsoleSilent import ConsoleSilent
+from SessionController import SessionController
+
+
+class ThreadedCombiner:
+
+    def __init__(self, thread_count: int, console: Console, session_controller: SessionController):
+        assert thread_count > 0
+        self._thread_count = thread_count
+        self._console = console
+        self._session_controller = session_controller
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Tiles submitted to the threads by the last combine_tiles, so any not started can be cancelled
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Allocate the (rows, columns) array of double-precision results, or (rows, planes, columns) if more
+    # than one plane of results is asked for (see ImageMath.reduce_in_strips)
+
+    def new_result_array(self, shape: tuple) -> ndarray:
+        return numpy.empty(shape)
+
+    # Allocate a (files, rows, columns) strip
+
+    def new_strip_array(self, shape: (int, int, int), dtype) -> ndarray:
+        return numpy.empty(shape, dtype=dtype)
+
+    # Combine the given strip, which starts at the given row of the result, into the result, by
+    # splitting it into tiles combined at the same time by the threads.  The given tile-combining
+    # function is called as combine_tile(combine_method, parameters, tile, console, session_controller).
+    # The console is shared by the threads and keeps an indentation level, so when there are several
+    # threads their tiles are combined with no console output.
+    #
+    #   Exceptions thrown:
+    #       SessionCancelled        The session was cancelled
+    #       (and any raised by combine_tile in a thread)
+
+    def combine_tiles(self, combine_tile: Callable, combine_method: int, parameters: tuple,
+                      strip: ndarray, result: ndarray, first_row: int):
+        (_, strip_rows, _) = strip.shape
+        if self._thread_count == 1:
+            result[first_row:first_row + strip_rows] = combine_tile(combine_method, parameters, strip,
+                                                                    self._console, self._session_controller)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._thread_count, thread_name_prefix="combine")
+        tile_count = min(self._thread_count, strip_rows)
+        tile_bounds = [(index * strip_rows) // tile_count for index in range(tile_count + 1)]
+        self._futures = [self._executor.submit(self.combine_tile_in_thread, combine_tile, combine_method,
+                                               parameters, strip, tile_bounds[index], tile_bounds[index + 1],
+                                               result, first_row)
+                         for index in range(tile_count)]
+        # The combine code checks for cancellation itself, so just wait for all the tiles to finish
+        # (or give up) before looking at the outcome, so none is still using the strip afterwards
+        wait(self._futures)
+        if self._session_controller.thread_cancelled():
+            raise MasterMakerExceptions.SessionCancelled
+        for future in self._futures:
+            # Re-raises, here, any exception raised in the thread
+            future.result()
+
+    def combine_tile_in_thread(self, combine_tile: Callable, combine_method: int, parameters: tuple,
+                               strip: ndarray, first_tile_row: int, end_tile_row: int,
+                               result: ndarray, first_result_row: int):
+        result[first_result_row + first_tile_row:first_result_row + end_tile_row] = \
+            combine_tile(combine_method, parameters, strip[:, first_tile_row:end_tile_row],
+                         ConsoleSilent(), self._session_controller)
+
+    # Stop the threads.  Any tiles not yet started are abandoned.
+
+    def close(self):
+        if self._executor is not None:
+            # Abandon any tiles not yet started (shutdown's cancel_futures needs Python 3.9)
+            for future in self._futures:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._futures = []